@@ -0,0 +1,166 @@
+"""
+Histórico de revisões dos capítulos (SQLite): cada gravação de capítulo vira uma revisão numerada.
+
+/data/history.db
+    revisions(book_id, chapter_id, n, ts, title, source, chars, hash, kind, data)
+
+Só a última revisão fica no armazenamento de capítulos (é o que listagens, busca e RAG leem); aqui
+ficam todas, comprimidas com zlib:
+    kind='full'   texto inteiro (a 1ª revisão e uma a cada HISTORY_KEYFRAME_EVERY)
+    kind='delta'  diferença por linhas contra a revisão anterior, em JSON:
+                  [início, fim] copia as linhas [início:fim) da anterior; "texto" insere o texto
+Ler a revisão n custa no máximo HISTORY_KEYFRAME_EVERY deltas a partir do último texto inteiro.
+"""
+import os
+import json
+import time
+import zlib
+import difflib
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(DATA_DIR, "history.db"))
+HISTORY_KEYFRAME_EVERY = int(os.getenv("HISTORY_KEYFRAME_EVERY", "20"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS revisions (
+    book_id     TEXT NOT NULL,
+    chapter_id  TEXT NOT NULL,
+    n           INTEGER NOT NULL,
+    ts          REAL NOT NULL,
+    title       TEXT NOT NULL,
+    source      TEXT NOT NULL DEFAULT '',    -- save | update | expand | import | snapshot | restore | original
+    chars       INTEGER NOT NULL,
+    hash        TEXT NOT NULL,
+    kind        TEXT NOT NULL,               -- full | delta
+    data        BLOB NOT NULL,
+    PRIMARY KEY (book_id, chapter_id, n)
+);
+"""
+
+
+def text_hash(title: str, text: str) -> str:
+    return hashlib.sha1(f"{title}\x1f{text}".encode("utf-8")).hexdigest()[:16]
+
+
+def make_delta(old: str, new: str) -> List:
+    a, b = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    ops: List = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(old: str, ops: List) -> str:
+    a = old.splitlines(keepends=True)
+    return "".join("".join(a[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+class ChapterHistory:
+    def __init__(self, db_path: str = HISTORY_DB_PATH, keyframe_every: int = HISTORY_KEYFRAME_EVERY):
+        self.db_path = db_path
+        self.keyframe_every = max(1, keyframe_every)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # escrita
+    # ------------------------------------------------------------------
+    def record(self, book_id: str, chapter_id: str, title: str, text: str, source: str = "") -> Optional[int]:
+        """Grava uma nova revisão; None se o texto/título são iguais aos da última (nada muda)."""
+        h = text_hash(title, text)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")    # numeração sem corrida entre workers
+        try:
+            last = conn.execute(
+                "SELECT n, hash FROM revisions WHERE book_id = ? AND chapter_id = ? ORDER BY n DESC LIMIT 1",
+                (book_id, chapter_id)).fetchone()
+            if last and last["hash"] == h:
+                conn.rollback()
+                return None
+            n = last["n"] + 1 if last else 1
+            kind, payload = "full", text
+            if last and (n - 1) % self.keyframe_every:
+                ops = make_delta(self._text(conn, book_id, chapter_id, last["n"]), text)
+                delta = json.dumps(ops, ensure_ascii=False)
+                if len(delta) < len(text):
+                    kind, payload = "delta", delta
+            conn.execute(
+                "INSERT INTO revisions (book_id, chapter_id, n, ts, title, source, chars, hash, kind, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (book_id, chapter_id, n, time.time(), title, source, len(text), h, kind,
+                 zlib.compress(payload.encode("utf-8"))),
+            )
+            conn.commit()
+            return n
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def forget(self, book_id: str, chapter_id: str) -> int:
+        """Apaga todas as revisões do capítulo (ex.: restore de snapshot desfeito)."""
+        conn = self._conn()
+        with conn:
+            return conn.execute("DELETE FROM revisions WHERE book_id = ? AND chapter_id = ?",
+                                (book_id, chapter_id)).rowcount
+
+    # ------------------------------------------------------------------
+    # leitura
+    # ------------------------------------------------------------------
+    def _text(self, conn: sqlite3.Connection, book_id: str, chapter_id: str, n: int) -> Optional[str]:
+        base = conn.execute(
+            "SELECT MAX(n) FROM revisions WHERE book_id = ? AND chapter_id = ? AND n <= ? AND kind = 'full'",
+            (book_id, chapter_id, n)).fetchone()[0]
+        if base is None:
+            return None
+        text = None
+        for r in conn.execute(
+                "SELECT kind, data FROM revisions WHERE book_id = ? AND chapter_id = ? AND n BETWEEN ? AND ? "
+                "ORDER BY n", (book_id, chapter_id, base, n)):
+            payload = zlib.decompress(r["data"]).decode("utf-8")
+            text = payload if r["kind"] == "full" else apply_delta(text, json.loads(payload))
+        return text
+
+    def has_history(self, book_id: str, chapter_id: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM revisions WHERE book_id = ? AND chapter_id = ? LIMIT 1",
+                                    (book_id, chapter_id)).fetchone() is not None
+
+    def list(self, book_id: str, chapter_id: str) -> List[Dict]:
+        """Revisões do capítulo, mais recente primeiro (sem o texto)."""
+        return [
+            dict(r) for r in self._conn().execute(
+                "SELECT n, ts, title, source, chars, hash, kind, LENGTH(data) AS stored_bytes FROM revisions "
+                "WHERE book_id = ? AND chapter_id = ? ORDER BY n DESC", (book_id, chapter_id))
+        ]
+
+    def get(self, book_id: str, chapter_id: str, n: int) -> Optional[Dict]:
+        conn = self._conn()
+        r = conn.execute(
+            "SELECT n, ts, title, source, chars, hash, kind FROM revisions WHERE book_id = ? AND chapter_id = ? AND n = ?",
+            (book_id, chapter_id, n)).fetchone()
+        if not r:
+            return None
+        return {**dict(r), "text": self._text(conn, book_id, chapter_id, n)}
+
+    def latest(self, book_id: str, chapter_id: str) -> Optional[int]:
+        return self._conn().execute("SELECT MAX(n) FROM revisions WHERE book_id = ? AND chapter_id = ?",
+                                    (book_id, chapter_id)).fetchone()[0]
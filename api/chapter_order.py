@@ -0,0 +1,107 @@
+"""
+Ordem narrativa dos capítulos de cada livro (os IDs são UUIDs: não dizem nada sobre a ordem).
+
+Arquivo: /data/order/<book_id>.json
+    {book_id, order: [chapter_id, ...], version, updated_at}
+
+Capítulos que ainda não estão na lista (salvos antes deste arquivo existir, gravados por fora da API)
+entram no fim, do mais antigo para o mais novo, e a lista é gravada assim — a ordem não muda mais
+sozinha depois disso. Capítulos apagados somem da lista na próxima leitura.
+"""
+import os
+import json
+import threading
+from datetime import datetime
+from typing import Dict, List
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+ORDER_DIR = os.path.join(DATA_DIR, "order")
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def _lock(book_id: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(book_id, threading.Lock())
+
+
+def _path(book_id: str) -> str:
+    return os.path.join(ORDER_DIR, f"{book_id}.json")
+
+
+def load(book_id: str) -> Dict:
+    try:
+        with open(_path(book_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"book_id": book_id, "order": [], "version": 0}
+
+
+def _save(state: Dict):
+    os.makedirs(ORDER_DIR, exist_ok=True)
+    state["version"] = state.get("version", 0) + 1
+    state["updated_at"] = datetime.now().isoformat()
+    path = _path(state["book_id"])
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _merge(order: List[str], mtimes: Dict[str, float]) -> List[str]:
+    known = [cid for cid in order if cid in mtimes]
+    seen = set(known)
+    rest = sorted((cid for cid in mtimes if cid not in seen), key=lambda cid: (mtimes[cid], cid))
+    return known + rest
+
+
+def resolve(book_id: str, mtimes: Dict[str, float]) -> List[str]:
+    """
+    Ordem atual dos capítulos existentes. mtimes: {chapter_id: mtime} de todos os capítulos no
+    armazenamento (decide onde entram os que ainda não estavam na lista).
+    """
+    state = load(book_id)
+    order = _merge(state["order"], mtimes)
+    if order != state["order"]:
+        with _lock(book_id):
+            state = load(book_id)
+            order = _merge(state["order"], mtimes)
+            if order != state["order"]:
+                state["order"] = order
+                _save(state)
+    return order
+
+
+def set_order(book_id: str, order: List[str], mtimes: Dict[str, float]) -> List[str]:
+    """
+    Regrava a ordem inteira. IDs desconhecidos → KeyError; repetidos → ValueError.
+    Capítulos existentes que ficaram de fora vão para o fim.
+    """
+    missing = [cid for cid in order if cid not in mtimes]
+    if missing:
+        raise KeyError(", ".join(missing))
+    if len(set(order)) != len(order):
+        raise ValueError("capítulo repetido na ordem")
+    with _lock(book_id):
+        state = load(book_id)
+        state["order"] = _merge(order, mtimes)
+        _save(state)
+        return state["order"]
+
+
+def move(book_id: str, chapter_id: str, position: int, mtimes: Dict[str, float]) -> List[str]:
+    """Move um capítulo para a posição indicada (0 = primeiro)."""
+    if chapter_id not in mtimes:
+        raise KeyError(chapter_id)
+    with _lock(book_id):
+        state = load(book_id)
+        order = [cid for cid in _merge(state["order"], mtimes) if cid != chapter_id]
+        order.insert(max(0, min(position, len(order))), chapter_id)
+        state["order"] = order
+        _save(state)
+        return order
+
+
+def version(book_id: str) -> int:
+    return load(book_id).get("version", 0)
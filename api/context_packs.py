@@ -0,0 +1,124 @@
+"""
+Pacotes de contexto por capítulo: o que o RAG põe no prompt sobre cada capítulo, já pronto.
+
+Arquivo: /data/packs/<book_id>/<chapter_id>.json
+    {chapter_id, title, stamp, hash, preview, chunks: [[início, fim, trecho], ...],
+     summary, summary_hash, entities, tokens, updated_at}
+
+O pacote é montado quando o capítulo é salvo/atualizado (o texto é normalizado uma vez só, ali) e
+o resumo/personagens entram quando o LLM termina (set_summary). `stamp` é o mtime:tamanho do
+capítulo no armazenamento: quem lê compara com o stamp atual e refaz o pacote se o capítulo mudou
+por fora da API. `chunks` segue os trechos do índice vetorial, para que o trecho que casou com a
+busca também venha pronto.
+"""
+import os
+import re
+import json
+import shutil
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+PACK_DIR = os.path.join(DATA_DIR, "packs")
+PREVIEW_CHARS = 600
+CHARS_PER_TOKEN = 4          # estimativa para português (sem carregar o tokenizer do modelo)
+_CACHE_MAX = 4096
+
+_cache: Dict[Tuple[str, str], Dict] = {}
+_lock = threading.Lock()
+
+
+def _path(book_id: str, chapter_id: str) -> str:
+    return os.path.join(PACK_DIR, book_id, f"{chapter_id}.json")
+
+
+def preview(text: str, limit: int = PREVIEW_CHARS) -> str:
+    """Espaços colapsados, no máximo `limit` caracteres (sem percorrer o texto inteiro)."""
+    head = text[:limit * 4]
+    out = re.sub(r"\s+", " ", head)
+    if len(out) < limit and len(head) < len(text):
+        out = re.sub(r"\s+", " ", text)
+    return out[:limit]
+
+
+def estimate_tokens(*parts: str) -> int:
+    return sum(len(p) for p in parts) // CHARS_PER_TOKEN + 1
+
+
+def build(chapter_id: str, title: str, text: str, stamp: Optional[str], text_hash: str,
+          spans: Iterable[Tuple[int, int]], summary: str = "", summary_hash: Optional[str] = None,
+          entities: Optional[List[str]] = None) -> Dict:
+    return {
+        "chapter_id": chapter_id,
+        "title": title,
+        "stamp": stamp,
+        "hash": text_hash,
+        "preview": preview(text),
+        "chunks": [[a, b, preview(text[a:b])] for a, b in spans],
+        "summary": summary,
+        "summary_hash": summary_hash,
+        "entities": list(entities or []),
+        "tokens": estimate_tokens(title, text),
+        "updated_at": datetime.now().isoformat(),
+    }
+
+
+def excerpt(pack: Dict, span: Optional[List[int]] = None) -> Optional[str]:
+    """Trecho do pacote: o do span que casou na busca vetorial ou, sem span, o começo do capítulo."""
+    if not span:
+        return pack["preview"]
+    for a, b, text in pack["chunks"]:
+        if a == span[0] and b == span[1]:
+            return text
+    return None
+
+
+def _remember(book_id: str, chapter_id: str, pack: Dict):
+    with _lock:
+        _cache.pop((book_id, chapter_id), None)
+        if len(_cache) >= _CACHE_MAX:
+            _cache.pop(next(iter(_cache)))
+        _cache[(book_id, chapter_id)] = pack
+
+
+def load(book_id: str, chapter_id: str) -> Optional[Dict]:
+    with _lock:
+        pack = _cache.get((book_id, chapter_id))
+    if pack is not None:
+        return pack
+    try:
+        with open(_path(book_id, chapter_id), "r", encoding="utf-8") as f:
+            pack = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    _remember(book_id, chapter_id, pack)
+    return pack
+
+
+def save(book_id: str, pack: Dict):
+    path = _path(book_id, pack["chapter_id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(pack, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    _remember(book_id, pack["chapter_id"], pack)
+
+
+def set_summary(book_id: str, chapter_id: str, summary: str, summary_hash: str, entities: List[str]) -> bool:
+    """Grava resumo/personagens num pacote existente (False se o capítulo ainda não tem pacote)."""
+    pack = load(book_id, chapter_id)
+    if pack is None:
+        return False
+    pack = {**pack, "summary": summary, "summary_hash": summary_hash, "entities": list(entities),
+            "updated_at": datetime.now().isoformat()}
+    save(book_id, pack)
+    return True
+
+
+def drop_book(book_id: str):
+    with _lock:
+        for key in [k for k in _cache if k[0] == book_id]:
+            del _cache[key]
+    shutil.rmtree(os.path.join(PACK_DIR, book_id), ignore_errors=True)
@@ -0,0 +1,246 @@
+"""
+Índice de entidades (personagens, locais) por livro, montado a partir do que o LLM já extrai.
+
+Arquivo: /data/entities/<book_id>.json
+    entities:  {chave: {name, type, aliases, role, description, chapters: {chapter_id: title}}}
+    aliases:   {alias normalizado: chave}
+    relationships: [{a, b, type, description, chapters}]
+    merges:    {alias normalizado: chave}   (fusões manuais; sobrevivem a regravações)
+
+Fusão de apelidos: "ana" e "Ana" são a mesma entidade (sem acento/maiúsculas), e um nome de uma
+palavra só ("Ana") é absorvido pelo nome completo ("Ana Souza") quando só existe uma "Ana ..." no livro.
+"""
+import os
+import re
+import json
+import threading
+import unicodedata
+from datetime import datetime
+from typing import Dict, List, Optional
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+ENTITY_DIR = os.path.join(DATA_DIR, "entities")
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def norm(name: str) -> str:
+    """Nome → chave de comparação (sem acento, minúsculo, espaços simples)."""
+    s = unicodedata.normalize("NFKD", name or "")
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s'-]", " ", s.lower())).strip()
+
+
+def _first_token(name: str) -> str:
+    tokens = norm(name).split()
+    return tokens[0] if tokens else ""
+
+
+def _lock(book_id: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(book_id, threading.Lock())
+
+
+def _path(book_id: str) -> str:
+    return os.path.join(ENTITY_DIR, f"{book_id}.json")
+
+
+def load(book_id: str) -> Dict:
+    try:
+        with open(_path(book_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"book_id": book_id, "entities": {}, "aliases": {}, "relationships": [], "merges": {}, "version": 0}
+
+
+def _save(index: Dict):
+    os.makedirs(ENTITY_DIR, exist_ok=True)
+    index["version"] = index.get("version", 0) + 1
+    index["updated_at"] = datetime.now().isoformat()
+    path = _path(index["book_id"])
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def restore(book_id: str, index: Dict):
+    """Substitui o índice do livro por um vindo de snapshot (possivelmente de outro livro/nó)."""
+    with _lock(book_id):
+        _save({**index, "book_id": book_id})
+
+
+def resolve(index: Dict, name: str) -> Optional[str]:
+    """Nome ou apelido → chave da entidade."""
+    n = norm(name)
+    for key in (index.get("merges", {}).get(n), index["aliases"].get(n)):
+        if key and key in index["entities"]:
+            return key
+    return None
+
+
+def _find_or_create(index: Dict, name: str, etype: str) -> str:
+    n = norm(name)
+    key = resolve(index, name)
+    if key:
+        return key
+
+    tokens = n.split()
+    if not tokens:
+        raise ValueError(f"nome de entidade vazio: {name!r}")
+    same_type = {k: e for k, e in index["entities"].items() if e["type"] == etype}
+    if len(tokens) == 1:
+        # "Ana" → única "Ana ..." já conhecida
+        fulls = [k for k, e in same_type.items() if _first_token(e["name"]) == n]
+        if len(fulls) == 1:
+            index["aliases"][n] = fulls[0]
+            index["entities"][fulls[0]]["aliases"].append(name)
+            return fulls[0]
+    else:
+        # "Ana Souza" chega depois de "Ana": o nome completo vira o canônico
+        short = [k for k, e in same_type.items() if norm(e["name"]) == tokens[0]]
+        others = [k for k, e in same_type.items() if len(norm(e["name"]).split()) > 1
+                  and _first_token(e["name"]) == tokens[0]]
+        if len(short) == 1 and not others:
+            key = short[0]
+            ent = index["entities"][key]
+            ent["aliases"].append(ent["name"])
+            ent["name"] = name
+            index["aliases"][n] = key
+            return key
+
+    # entidade fundida manualmente que ficou sem capítulos volta com a mesma chave
+    key = index.get("merges", {}).get(n) or n
+    index["entities"][key] = {"name": name, "type": etype, "aliases": [], "role": "", "description": "", "chapters": {}}
+    index["aliases"][n] = key
+    return key
+
+
+def _drop_chapter(index: Dict, chapter_id: str, types: Optional[set] = None):
+    for ent in index["entities"].values():
+        if types is None or ent["type"] in types:
+            ent["chapters"].pop(chapter_id, None)
+    for rel in index["relationships"]:
+        if types is None and chapter_id in rel["chapters"]:
+            rel["chapters"].remove(chapter_id)
+    index["relationships"] = [r for r in index["relationships"] if r["chapters"]]
+    orphans = [k for k, e in index["entities"].items() if not e["chapters"]]
+    for k in orphans:
+        del index["entities"][k]
+    index["aliases"] = {a: k for a, k in index["aliases"].items() if k in index["entities"]}
+
+
+def entities_from_summary(summary) -> Dict[str, List[Dict]]:
+    """Entidades do dict de BookMetadata (save) ou do resumo estruturado (update/batch)."""
+    out = {"entities": [], "relationships": []}
+    if not isinstance(summary, dict) or summary.get("parse_failed"):
+        return out
+    if "plot_summary" in summary:
+        for c in summary.get("main_characters") or []:
+            out["entities"].append({**c, "type": "character", "role": c.get("role") or "principal"})
+        for c in summary.get("supporting_characters") or []:
+            out["entities"].append({**c, "type": "character"})
+        for l in summary.get("locations") or []:
+            out["entities"].append({**l, "type": "location"})
+        out["relationships"] = summary.get("relationships") or []
+    else:
+        out["entities"] += [{"name": str(p), "type": "character"} for p in summary.get("personagens") or []]
+        out["entities"] += [{"name": str(p), "type": "location"} for p in summary.get("locais") or []]
+    # "...", "?" e afins: sem nenhuma letra/dígito não há nome para comparar
+    out["entities"] = [e for e in out["entities"] if norm(str(e.get("name") or ""))]
+    return out
+
+
+def set_chapter(book_id: str, chapter_id: str, title: str, summary, types: Optional[set] = None) -> Optional[Dict]:
+    """
+    Substitui as ocorrências do capítulo pelas entidades do resumo/metadados. None se não havia o que indexar.
+    types limita a substituição a alguns tipos (ex.: {"character"} ao reconstruir só com personagens).
+    """
+    found = entities_from_summary(summary)
+    if not found["entities"]:
+        return None
+    with _lock(book_id):
+        index = load(book_id)
+        _drop_chapter(index, chapter_id, types)
+        for e in found["entities"]:
+            name = str(e["name"]).strip()
+            key = _find_or_create(index, name, e.get("type", "character"))
+            ent = index["entities"][key]
+            ent["chapters"][chapter_id] = title
+            if name != ent["name"] and name not in ent["aliases"]:
+                ent["aliases"].append(name)
+                index["aliases"][norm(name)] = key
+            for field in ("role", "description"):
+                if e.get(field) and not ent.get(field):
+                    ent[field] = str(e[field])
+        for r in found["relationships"]:
+            a, b = r.get("character1"), r.get("character2")
+            ka, kb = resolve(index, a or ""), resolve(index, b or "")
+            if not (ka and kb):
+                continue
+            rel = next((x for x in index["relationships"] if {x["a"], x["b"]} == {ka, kb}), None)
+            if rel is None:
+                rel = {"a": ka, "b": kb, "type": r.get("type", ""), "description": r.get("description", ""), "chapters": []}
+                index["relationships"].append(rel)
+            if chapter_id not in rel["chapters"]:
+                rel["chapters"].append(chapter_id)
+        _save(index)
+        return index
+
+
+def merge(book_id: str, names: List[str], into: Optional[str] = None) -> Dict:
+    """Funde entidades manualmente (ex.: "O Capitão" = "Rui Prado"). Devolve a entidade resultante."""
+    with _lock(book_id):
+        index = load(book_id)
+        keys = [resolve(index, n) for n in names]
+        missing = [n for n, k in zip(names, keys) if not k]
+        if missing:
+            raise KeyError(", ".join(missing))
+        target = resolve(index, into) if into else keys[0]
+        if target not in keys:
+            raise KeyError(into)
+        ent = index["entities"][target]
+        for k in keys:
+            if k == target:
+                continue
+            other = index["entities"].pop(k)
+            ent["chapters"].update(other["chapters"])
+            for alias in [other["name"], *other["aliases"]]:
+                if alias not in ent["aliases"] and alias != ent["name"]:
+                    ent["aliases"].append(alias)
+            for a, kk in list(index["aliases"].items()):
+                if kk == k:
+                    index["aliases"][a] = target
+            for rel in index["relationships"]:
+                rel["a"] = target if rel["a"] == k else rel["a"]
+                rel["b"] = target if rel["b"] == k else rel["b"]
+            for n in [other["name"], *other["aliases"]]:
+                index["merges"][norm(n)] = target
+        index["relationships"] = [r for r in index["relationships"] if r["a"] != r["b"]]
+        _save(index)
+        return {"key": target, **ent}
+
+
+def chapters_for(book_id: str, name: str) -> Optional[Dict]:
+    index = load(book_id)
+    key = resolve(index, name)
+    if not key:
+        return None
+    ent = index["entities"][key]
+    rels = [r for r in index["relationships"] if key in (r["a"], r["b"])]
+    return {"key": key, **ent, "relationships": rels}
+
+
+def mentioned_in(book_id: str, text: str, limit: int = 5) -> List[Dict]:
+    """Entidades citadas num texto (ex.: a pergunta do /ask), por nome ou apelido, sem embeddings."""
+    index = load(book_id)
+    if not index["entities"]:
+        return []
+    haystack = f" {norm(text)} "
+    hits = {}
+    for alias, key in {**index["aliases"], **index.get("merges", {})}.items():
+        if len(alias) >= 2 and f" {alias} " in haystack and key in index["entities"]:
+            hits.setdefault(key, len(alias))
+    ranked = sorted(hits, key=lambda k: -len(index["entities"][k]["chapters"]))
+    return [{"key": k, **index["entities"][k]} for k in ranked[:limit]]
@@ -0,0 +1,242 @@
+"""
+Jobs longos em segundo plano (auditorias, reprocessamentos) com progresso, cancelamento e retomada.
+
+Arquivo: /data/jobs/<job_id>.json
+    {id, kind, book_id, params, status, progress: {total, done, failed}, items: {chave: resultado},
+     result, error, created_at, updated_at}
+
+status: queued → running → done | failed | cancelled
+        running → interrupted (API reiniciou no meio) → running (retomado)
+
+Cada job grava o resultado de cada item assim que ele termina; ao retomar, os itens
+já feitos são pulados. No máximo JOBS_MAX_RUNNING jobs rodam ao mesmo tempo: os demais
+ficam em "queued" até abrir vaga.
+"""
+import os
+import copy
+import json
+import uuid
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+JOB_DIR = os.path.join(DATA_DIR, "jobs")
+JOBS_MAX_RUNNING = int(os.getenv("JOBS_MAX_RUNNING", "1"))
+
+FINAL_STATUSES = {"done", "failed", "cancelled"}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, state: Dict, manager: "JobManager"):
+        self.state = state
+        self._manager = manager
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._superseded = False   # retomado: o arquivo passa a ser do Job novo
+
+    @property
+    def id(self) -> str:
+        return self.state["id"]
+
+    @property
+    def params(self) -> Dict:
+        return self.state["params"]
+
+    @property
+    def book_id(self) -> Optional[str]:
+        return self.state.get("book_id")
+
+    # ---- usado pelo runner ----
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+
+    def set_total(self, total: int):
+        with self._lock:
+            self.state["progress"]["total"] = total
+        self.save()
+
+    def is_done(self, key: str) -> bool:
+        return key in self.state["items"]
+
+    def item_done(self, key: str, result, failed: bool = False):
+        """Registra o resultado de um item (e persiste: é o que permite retomar)."""
+        with self._lock:
+            self.state["items"][key] = result
+            self.state["progress"]["done" if not failed else "failed"] += 1
+        self.save()
+
+    def items(self) -> Dict:
+        with self._lock:
+            return dict(self.state["items"])
+
+    # ---- estado ----
+    def save(self):
+        with self._lock:
+            if self._superseded:
+                return
+            self.state["updated_at"] = datetime.now().isoformat()
+            self._manager._write(self.id, json.dumps(self.state, ensure_ascii=False, indent=2))
+
+    def snapshot(self, with_items: bool = False) -> Dict:
+        with self._lock:
+            out = {k: v for k, v in self.state.items() if k != "items"}
+            out = json.loads(json.dumps(out))
+            if with_items:
+                out["items"] = dict(self.state["items"])
+        return out
+
+
+class JobManager:
+    def __init__(self, root: str = JOB_DIR, max_running: int = JOBS_MAX_RUNNING):
+        self.root = root
+        self.runners: Dict[str, Callable[[Job], Dict]] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._guard = threading.Lock()
+        self._slots = threading.Semaphore(max(1, max_running))
+        self._file_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._recover()
+
+    def register(self, kind: str, runner: Callable[[Job], Dict]):
+        """runner(job) → resultado final (dict). Deve chamar job.check_cancelled() entre itens."""
+        self.runners[kind] = runner
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.root, f"{job_id}.json")
+
+    def _write(self, job_id: str, data: str):
+        path = self._path(job_id)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with self._file_lock:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+    def _recover(self):
+        """Jobs que estavam rodando quando a API caiu ficam como 'interrupted' (retomáveis)."""
+        for name in sorted(os.listdir(self.root)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"[WARN] Job ilegível ignorado ({name}): {e}")
+                continue
+            job = Job(state, self)
+            if state["status"] not in FINAL_STATUSES:
+                state["status"] = "interrupted"
+                job.save()
+                print(f"[INFO] Job {state['id']} ({state['kind']}) interrompido; use /jobs/{state['id']}/resume")
+            self._jobs[state["id"]] = job
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+    def start(self, kind: str, params: Dict, book_id: Optional[str] = None) -> Job:
+        if kind not in self.runners:
+            raise KeyError(kind)
+        now = datetime.now().isoformat()
+        state = {
+            "id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "book_id": book_id,
+            "params": params,
+            "status": "queued",
+            "progress": {"total": 0, "done": 0, "failed": 0},
+            "items": {},
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        job = Job(state, self)
+        with self._guard:
+            self._jobs[job.id] = job
+        job.save()
+        self._launch(job)
+        return job
+
+    def _launch(self, job: Job):
+        threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+
+    def _run(self, job: Job):
+        with self._slots:
+            if job.cancelled():
+                job.state["status"] = "cancelled"
+                job.save()
+                return
+            job.state["status"] = "running"
+            job.state["error"] = None
+            job.save()
+            print(f"[INFO] Job {job.id} ({job.state['kind']}) iniciado")
+            try:
+                result = self.runners[job.state["kind"]](job)
+                job.state["result"] = result
+                job.state["status"] = "cancelled" if job.cancelled() else "done"
+            except JobCancelled:
+                job.state["status"] = "cancelled"
+            except Exception as e:
+                job.state["status"] = "failed"
+                job.state["error"] = str(e)
+                print(f"[ERROR] Job {job.id} falhou: {e}")
+            job.save()
+            print(f"[OK] Job {job.id} terminou: {job.state['status']}")
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._guard:
+            return self._jobs.get(job_id)
+
+    def list(self, kind: Optional[str] = None, book_id: Optional[str] = None) -> List[Dict]:
+        with self._guard:
+            jobs = list(self._jobs.values())
+        out = [j.snapshot() for j in jobs
+               if (not kind or j.state["kind"] == kind) and (not book_id or j.state.get("book_id") == book_id)]
+        return sorted(out, key=lambda s: s["created_at"], reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Pede o cancelamento: itens em andamento terminam, os que não começaram não rodam."""
+        job = self.get(job_id)
+        if job and job.state["status"] not in FINAL_STATUSES:
+            job._cancel.set()
+            if job.state["status"] in ("queued", "interrupted"):
+                job.state["status"] = "cancelled"
+            else:
+                job.state["status"] = "cancelling"
+            job.save()
+        return job
+
+    def resume(self, job_id: str) -> Optional[Job]:
+        """Reinicia um job interrompido/cancelado/falho; os itens já concluídos são pulados."""
+        job = self.get(job_id)
+        if not job:
+            return None
+        if job.state["status"] in ("running", "queued", "cancelling", "done"):
+            raise ValueError(job.state["status"])
+        # o runner antigo pode ainda estar saindo (ou esperando vaga): ele fica com a cópia dele
+        # do estado e para de gravar o arquivo
+        job._cancel.set()
+        with job._lock:
+            job._superseded = True
+            fresh = Job(copy.deepcopy(job.state), self)
+        fresh.state["status"] = "queued"
+        # itens que falharam são tentados de novo
+        failed = [k for k, v in fresh.state["items"].items() if isinstance(v, dict) and v.get("error")]
+        for k in failed:
+            del fresh.state["items"][k]
+        fresh.state["progress"]["failed"] = 0
+        fresh.state["progress"]["done"] = len(fresh.state["items"])
+        with self._guard:
+            self._jobs[job_id] = fresh
+        fresh.save()
+        self._launch(fresh)
+        return fresh
@@ -1,16 +1,43 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
 import os
 import uuid
 import json
 import time
+import hashlib
+import random
+import threading
+import socket
+import asyncio
+import contextvars
+import sqlite3
+import codecs
+import difflib
+import zipfile
+import tarfile
+import gzip
+import io
+import queue
+import tempfile
 from datetime import datetime
 from typing import List, Optional, Dict
 import re
-import glob
 import requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import chromadb
 from chromadb.config import Settings
+from storage import get_storage, split_title, STORAGE_ENGINE
+from search_index import SearchIndex, SearchUnavailableError
+import entity_index
+import chapter_order
+import context_packs
+import vector_index
+from jobs import JobManager
+from usage_store import UsageStore, GROUP_COLUMNS as USAGE_GROUPS
+from chapter_history import ChapterHistory
 
 # ========================
 # Config da API/LLM
@@ -20,8 +47,36 @@ OPENAI_API_KEY  = os.getenv("OPENAI_API_KEY", "sk-local")
 OPENAI_MODEL    = os.getenv("OPENAI_MODEL", "book-llm")
 DATA_DIR        = os.getenv("DATA_DIR", "./data")
 CHAPTER_DIR     = os.path.join(DATA_DIR, "chapters")
+BOOKS_DIR       = os.path.join(DATA_DIR, "books")      # metadados dos livros criados pela UI (<id>.json)
 os.makedirs(CHAPTER_DIR, exist_ok=True)
 
+# Capítulos/sugestões/críticas em um diretório por livro (lê o layout plano antigo até migrar).
+# STORAGE_ENGINE=sqlite guarda tudo em /data/storage.db (WAL + FTS5) e mantém os .md como exportação.
+STORAGE = get_storage(root=CHAPTER_DIR)
+
+# Busca textual: no motor sqlite usa o FTS5 do próprio storage.db (mantido por triggers); no motor fs,
+# um índice FTS5 à parte em /data/search.db, atualizado a cada gravação de capítulo
+SEARCH_IN_STORAGE = getattr(STORAGE, "fts", False)
+SEARCH_INDEX = None if SEARCH_IN_STORAGE else SearchIndex()
+
+# Revisões anteriores dos capítulos (deltas comprimidos em /data/history.db); o armazenamento só tem a última
+HISTORY = ChapterHistory()
+
+# Tamanho máximo (caracteres) do bloco de contexto vindo do índice de entidades
+ENTITY_CONTEXT_MAX_CHARS = int(os.getenv("ENTITY_CONTEXT_MAX_CHARS", "12000"))
+
+# Quantas chamadas de resumo podem estar em voo ao mesmo tempo no vLLM (batch)
+SUMMARY_MAX_IN_FLIGHT = int(os.getenv("SUMMARY_MAX_IN_FLIGHT", "8"))
+
+# Máximo de candidatos (n) por pedido em /expand e /suggest
+GENERATION_MAX_CANDIDATES = int(os.getenv("GENERATION_MAX_CANDIDATES", "8"))
+
+# Saída estruturada: 'guided_json' (extensão do vLLM), 'response_format' (json_schema estilo OpenAI) ou 'off'
+LLM_GUIDED_DECODING     = os.getenv("LLM_GUIDED_DECODING", "guided_json")
+# Backend que recusou guided decoding fica sem ele por este tempo (depois tenta de novo)
+LLM_GUIDED_RETRY_S      = float(os.getenv("LLM_GUIDED_RETRY_S", "600"))
+STRUCTURED_MAX_RETRIES  = int(os.getenv("STRUCTURED_MAX_RETRIES", "1"))
+
 # ========================
 # ChromaDB Setup
 # ========================
@@ -109,18 +164,27 @@ class ChapterIn(BaseModel):
     chapter_id: Optional[str] = None
     title: str
     text: str
+    position: Optional[int] = None     # posição na ordem do livro (None = no fim)
 
 class SuggestionIn(BaseModel):
     book_id: str
     current_chapter_title: str
     current_chapter_text: str
     k: int = 8
+    chapter_id: Optional[str] = None   # capítulo salvo a que a sugestão se refere (consulta por capítulo)
+    use_memory: str = "none"           # mesmos modos do /expand; 'previous' = capítulos anteriores a chapter_id
+    previous_n: Optional[int] = None
+    n: int = 1                         # alternativas geradas numa só requisição ao vLLM
+    best_of: Optional[int] = None      # amostras avaliadas pelo vLLM para escolher as n melhores
+    stream: bool = False               # NDJSON com os tokens conforme chegam (ignora n)
 
 class CritiqueIn(BaseModel):
     book_id: str
     current_chapter_title: str
     current_chapter_text: str
     k: int = 8
+    chapter_id: Optional[str] = None
+    stream: bool = False
 
 # --- Update schema ---
 class ChapterUpdateIn(BaseModel):
@@ -129,6 +193,11 @@ class ChapterUpdateIn(BaseModel):
     title: Optional[str] = None   # se None, mantém o atual
     text: Optional[str] = None    # se None, mantém o atual
 
+class SummarizeBatchIn(BaseModel):
+    book_id: str
+    chapter_ids: Optional[List[str]] = None   # se None, resume o livro inteiro
+    max_in_flight: Optional[int] = None       # limitado por SUMMARY_MAX_IN_FLIGHT
+
 class MetadataExtractionIn(BaseModel):
     book_id: str
     chapter_title: str
@@ -151,40 +220,848 @@ class BookMetadata(BaseModel):
     tone: str
     pacing: str
 
+class ChapterSummary(BaseModel):
+    personagens: List[str]
+    locais: List[str]
+    tempo: str
+    plot_points: List[str]
+    temas: List[str]
+    tom: str
+    ganchos: List[str]
+
+class Idea(BaseModel):
+    title: str
+    logline: str
+    conflict: str
+    twist: str
+    stakes: str
+    pov: str
+    tone: str
+
+class IdeaList(BaseModel):
+    ideas: List[Idea]
+
+# ========================
+# Métricas (contadores em memória, expostos em /metrics)
+# ========================
+METRICS: Dict[str, float] = {}
+_metrics_lock = threading.Lock()
+
+def metric_inc(name: str, value: float = 1):
+    with _metrics_lock:
+        METRICS[name] = METRICS.get(name, 0) + value
+
 # ========================
 # Helpers
 # ========================
-def openai_chat(messages: List[Dict], temperature=0.4, max_tokens=800):
-    """Chama o vLLM direto, sempre. Força UTF-8 no corpo para evitar erros de parse."""
+class LLMUnavailableError(Exception):
+    """vLLM fora do ar (circuit breaker aberto): falha rápido em vez de esperar o timeout."""
+    def __init__(self, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class LLMTimeoutError(Exception):
+    """O orçamento de tempo da operação acabou (incluindo retries)."""
+
+class RequestCancelled(Exception):
+    """O cliente HTTP desconectou no meio da geração; o pedido ao vLLM foi abortado."""
+
+class CancelScope:
+    """
+    Cancelamento de um pedido HTTP. Os streams do vLLM abertos enquanto ele está ativo
+    (ver _cancel_scope) se registram aqui; cancel() aborta todos, de qualquer thread.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._streams = set()
+        self._lock = threading.Lock()
+
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def attach(self, stream: "LLMStream"):
+        with self._lock:
+            self._streams.add(stream)
+        if self._event.is_set():
+            stream.abort()
+
+    def detach(self, stream: "LLMStream"):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            streams = list(self._streams)
+        for stream in streams:
+            stream.abort()
+
+# definido por cancel_on_disconnect nas rotas de IA; a threadpool do FastAPI herda o contexto
+_cancel_scope: contextvars.ContextVar[Optional[CancelScope]] = contextvars.ContextVar("cancel_scope", default=None)
+
+CANCEL_POLL_S = float(os.getenv("CANCEL_POLL_S", "0.5"))
+
+async def cancel_on_disconnect(request: Request):
+    """
+    Dependência das rotas de IA: enquanto o handler roda, verifica a cada CANCEL_POLL_S se o
+    cliente desconectou (aba fechada, timeout da UI). Se sim, aborta as gerações em andamento no
+    vLLM; openai_chat sobe RequestCancelled e nada é salvo.
+    """
+    scope = CancelScope()
+    _cancel_scope.set(scope)
+
+    async def watch():
+        while not await request.is_disconnected():
+            await asyncio.sleep(CANCEL_POLL_S)
+        print(f"[INFO] Cliente desconectou de {request.url.path}; abortando a geração")
+        metric_inc("requests_cancelled")
+        scope.cancel()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        yield scope
+    finally:
+        watcher.cancel()
+
+# ========================
+# Uso de tokens e cotas (ver usage_store)
+# ========================
+# Cada chamada ao vLLM grava quanto gastou e para quem (livro, usuário do header X-User, rota).
+# Antes de despachar uma chamada, o livro e o usuário são conferidos contra a cota de tokens da
+# janela QUOTA_WINDOW_S: quem estourou recebe 429 e não ocupa a GPU dos demais.
+QUOTA_WINDOW_S = float(os.getenv("QUOTA_WINDOW_S", "3600"))
+QUOTA_BOOK_TOKENS = int(os.getenv("QUOTA_BOOK_TOKENS", "0"))     # 0 = sem limite
+QUOTA_USER_TOKENS = int(os.getenv("QUOTA_USER_TOKENS", "0"))
+USAGE_RETENTION_DAYS = float(os.getenv("USAGE_RETENTION_DAYS", "90"))
+
+USAGE = UsageStore()
+if USAGE_RETENTION_DAYS > 0:
+    USAGE.purge(time.time() - USAGE_RETENTION_DAYS * 86400)
+
+class QuotaExceededError(Exception):
+    """Livro ou usuário gastou a cota de tokens da janela atual."""
+    def __init__(self, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class UsageContext:
+    """A quem são atribuídos os tokens das chamadas ao vLLM do pedido atual."""
+    def __init__(self, book_id: str = "", user: str = "", endpoint: str = ""):
+        self.book_id = book_id
+        self.user = user
+        self.endpoint = endpoint
+
+# definido por track_usage nas rotas que chamam o vLLM (e pelos jobs); fora delas: uso interno
+_usage_ctx: contextvars.ContextVar[Optional[UsageContext]] = contextvars.ContextVar("usage_ctx", default=None)
+_INTERNAL_USAGE = UsageContext(endpoint="(interno)")
+
+def _usage_now() -> UsageContext:
+    return _usage_ctx.get() or _INTERNAL_USAGE
+
+def _quota_limit(scope: str, key: str) -> int:
+    override = USAGE.quota_override(scope, key)
+    if override is not None:
+        return override
+    return QUOTA_BOOK_TOKENS if scope == "book" else QUOTA_USER_TOKENS
+
+def _quota_status(scope: str, key: str) -> Dict:
+    limit = _quota_limit(scope, key)
+    used = USAGE.used(scope, key, time.time() - QUOTA_WINDOW_S)
+    return {"scope": scope, "key": key, "limit": limit, "used": used,
+            "remaining": max(0, limit - used) if limit > 0 else None}
+
+def check_quota(op: str):
+    """Chamada antes de despachar ao vLLM: QuotaExceededError se o livro ou o usuário estourou a cota."""
+    ctx = _usage_now()
+    since = time.time() - QUOTA_WINDOW_S
+    for scope, key in (("book", ctx.book_id), ("user", ctx.user)):
+        if not key:
+            continue
+        limit = _quota_limit(scope, key)
+        if limit <= 0:
+            continue
+        used = USAGE.used(scope, key, since)
+        if used < limit:
+            continue
+        # volta a haver cota quando os registros mais antigos saírem da janela
+        freed = USAGE.freed_at(scope, key, since, used - limit + 1)
+        retry_after = (freed + QUOTA_WINDOW_S - time.time()) if freed else QUOTA_WINDOW_S
+        metric_inc(f"quota_rejected.{scope}")
+        who = "do livro" if scope == "book" else "do usuário"
+        raise QuotaExceededError(
+            f"Cota de tokens {who} '{key}' esgotada: {used}/{limit} em {QUOTA_WINDOW_S / 60:.0f} min ('{op}')",
+            retry_after=max(1.0, retry_after),
+        )
+
+async def track_usage(request: Request):
+    """
+    Dependência das rotas que chamam o vLLM: atribui os tokens ao livro (caminho, query ou corpo
+    JSON), ao usuário (header X-User; sem ele só vale a cota do livro) e à rota.
+    """
+    book_id = request.path_params.get("book_id") or request.query_params.get("book_id")
+    if not book_id and request.headers.get("content-type", "").split(";")[0].strip() == "application/json":
+        try:
+            body = await request.json()
+            book_id = body.get("book_id") if isinstance(body, dict) else None
+        except ValueError:
+            pass
+    route = request.scope.get("route")
+    ctx = UsageContext(book_id or "", request.headers.get("X-User", "").strip(),
+                       getattr(route, "path", request.url.path))
+    _usage_ctx.set(ctx)
+    return ctx
+
+def _prompt_chars(messages: List[Dict]) -> int:
+    return sum(len(m.get("content") or "") for m in messages)
+
+def _record_usage(ctx: UsageContext, op: str, backend: str, usage: Optional[Dict],
+                  prompt_chars: int = 0, completion_estimate: int = 0):
+    """Grava o `usage` do vLLM; sem ele (geração abortada), uma estimativa pelo tamanho do prompt."""
+    if usage:
+        prompt, completion, estimated = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), False
+    else:
+        prompt, completion, estimated = prompt_chars // context_packs.CHARS_PER_TOKEN, completion_estimate, True
+    metric_inc(f"llm_prompt_tokens.{op}", prompt)
     try:
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"} if OPENAI_API_KEY else {}
-        
-        payload = {
-            "model": OPENAI_MODEL,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": False
+        USAGE.record(ctx.book_id, ctx.user, ctx.endpoint, op, backend, prompt, completion, estimated=estimated)
+    except sqlite3.Error as e:
+        print(f"[WARN] Uso de tokens não registrado ({op}): {e}")
+
+def _expected_completion_tokens(op: str, max_tokens: int) -> float:
+    """Tamanho médio das respostas já concluídas da operação (ou max_tokens, sem histórico)."""
+    done = METRICS.get(f"llm_completions.{op}", 0)
+    if not done:
+        return max_tokens
+    return min(max_tokens, METRICS.get(f"llm_completion_tokens.{op}", 0) / done)
+
+class CircuitBreaker:
+    """
+    closed → (N falhas seguidas) → open → (cooldown) → half_open → 1 sucesso fecha / 1 falha reabre.
+    No half_open só uma requisição de prova passa por vez.
+    """
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = ""
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.cooldown:
+                    return False
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open":
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def is_available(self) -> bool:
+        """Como allow(), mas sem reservar a requisição de prova (usado para escolher backend)."""
+        with self._lock:
+            if self.state == "open":
+                return time.time() - self.opened_at >= self.cooldown
+            return not (self.state == "half_open" and self._probe_in_flight)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"[OK] Circuit breaker '{self.name}' fechado")
+            self.state = "closed"
+            self.failures = 0
+            self.last_error = ""
+            self._probe_in_flight = False
+
+    def record_failure(self, error: str):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error[:200]
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    print(f"[WARN] Circuit breaker '{self.name}' aberto: {self.last_error}")
+                    metric_inc(f"llm_breaker_opened.{self.name}")
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 0
+        return max(0.0, self.cooldown - (time.time() - self.opened_at))
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_after_s": round(self.retry_after(), 1),
+            "last_error": self.last_error or None,
         }
-        
-        r = requests.post(
-            f"{OPENAI_API_BASE}/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=120
-        )
-        
-        if r.ok:
-            return r.json()["choices"][0]["message"]["content"]
+
+# Orçamento total (s) por operação, incluindo retries. Sobrescreva com LLM_TIMEOUT_<OP>.
+_LLM_DEFAULT_BUDGETS = {
+    "default": 120, "test": 20, "extract": 120, "summarize": 180, "summary_tree": 180,
+    "ideate": 120, "ask": 120, "suggest": 180, "critique": 180, "expand": 240, "continuity": 240,
+}
+LLM_MAX_RETRIES       = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_S      = float(os.getenv("LLM_RETRY_BASE_S", "0.5"))
+LLM_RETRY_MAX_S       = float(os.getenv("LLM_RETRY_MAX_S", "8"))
+LLM_CONNECT_TIMEOUT_S = float(os.getenv("LLM_CONNECT_TIMEOUT_S", "5"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+_RETRYABLE_STATUS = {429, 502, 503, 504}
+
+# ========================
+# Pool de backends vLLM (roteamento + balanceamento)
+# ========================
+# LLM_BACKENDS: lista JSON de servidores OpenAI-compatíveis, ex.:
+#   [{"name": "gpu1", "base": "http://vllm:8000/v1", "model": "book-llm", "weight": 2, "tags": ["large"]},
+#    {"name": "gpu2", "base": "http://vllm-small:8000/v1", "model": "book-llm-small", "tags": ["small"]}]
+# LLM_ROUTES: operação → tag, ex.: {"summarize": "small", "extract": "small", "expand": "large"}
+# Sem LLM_BACKENDS, usa um único backend com OPENAI_API_BASE/OPENAI_MODEL (comportamento antigo).
+LLM_HEALTH_INTERVAL_S = float(os.getenv("LLM_HEALTH_INTERVAL_S", "10"))
+_DEFAULT_LLM_ROUTES = {
+    "summarize": "small", "extract": "small", "summary_tree": "small",
+    "expand": "large", "suggest": "large",
+}
+
+class LLMBackend:
+    def __init__(self, name: str, base: str, model: str, api_key: str = "",
+                 weight: float = 1, tags: Optional[List[str]] = None):
+        self.name = name
+        self.base = base.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.01)
+        self.tags = set(tags or [])
+        self.breaker = CircuitBreaker(name, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN_S)
+        self.outstanding = 0
+        self.healthy = True          # otimista até o primeiro health check
+        self.health_detail = "not checked"
+        self.guided_off_until = 0.0  # recusou guided decoding: sem restrição até este instante
+
+    def guided_ok(self) -> bool:
+        return time.time() >= self.guided_off_until
+
+    def disable_guided(self, detail: str):
+        self.guided_off_until = time.time() + LLM_GUIDED_RETRY_S
+        print(f"[WARN] {self.name} recusou guided decoding, sem ele por {LLM_GUIDED_RETRY_S:.0f}s: {detail[:200]}")
+
+    def headers(self) -> Dict:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    def check_health(self, timeout: float = 5) -> bool:
+        try:
+            r = requests.get(f"{self.base}/models", headers=self.headers(), timeout=timeout)
+            self.healthy = r.status_code == 200
+            self.health_detail = "ready" if self.healthy else f"status {r.status_code}"
+        except Exception as e:
+            self.healthy = False
+            self.health_detail = f"error: {e}"
+        return self.healthy
+
+    def snapshot(self) -> Dict:
+        return {
+            "name": self.name,
+            "base": self.base,
+            "model": self.model,
+            "weight": self.weight,
+            "tags": sorted(self.tags),
+            "healthy": self.healthy,
+            "detail": self.health_detail,
+            "outstanding": self.outstanding,
+            "guided": self.guided_ok(),
+            "breaker": self.breaker.snapshot(),
+        }
+
+class LLMPool:
+    """Least-outstanding-requests ponderado por peso, restrito aos backends saudáveis da rota."""
+    def __init__(self, backends: List[LLMBackend], routes: Dict[str, str]):
+        self.backends = backends
+        self.routes = routes
+        self._lock = threading.Lock()
+
+    def pick(self, op: str, exclude: Optional[set] = None) -> Optional[LLMBackend]:
+        tag = self.routes.get(op)
+        with self._lock:
+            available = [b for b in self.backends
+                         if b.breaker.is_available() and b.name not in (exclude or set())]
+            # nenhum saudável no último health check: tenta assim mesmo e deixa o breaker decidir
+            alive = [b for b in available if b.healthy] or available
+            routed = [b for b in alive if tag in b.tags] if tag else alive
+            # sem backend da tag certa, qualquer um saudável serve (melhor que falhar)
+            for b in sorted(routed or alive, key=lambda b: ((b.outstanding + 1) / b.weight, random.random())):
+                if b.breaker.allow():
+                    b.outstanding += 1
+                    metric_inc(f"llm_requests.{b.name}")
+                    return b
+        return None
+
+    def release(self, backend: LLMBackend):
+        with self._lock:
+            backend.outstanding = max(0, backend.outstanding - 1)
+
+    def retry_after(self) -> float:
+        waits = [b.breaker.retry_after() for b in self.backends if b.breaker.state == "open"]
+        return min(waits) if waits else 0
+
+    def last_error(self) -> str:
+        return "; ".join(f"{b.name}: {b.breaker.last_error or b.health_detail}" for b in self.backends)
+
+    def check_all(self) -> List[Dict]:
+        for b in self.backends:
+            b.check_health()
+        return [b.snapshot() for b in self.backends]
+
+def _load_llm_pool() -> LLMPool:
+    raw = os.getenv("LLM_BACKENDS", "").strip()
+    routes = dict(_DEFAULT_LLM_ROUTES)
+    if os.getenv("LLM_ROUTES"):
+        routes.update(json.loads(os.getenv("LLM_ROUTES")))
+    if not raw:
+        return LLMPool([LLMBackend("default", OPENAI_API_BASE, OPENAI_MODEL, OPENAI_API_KEY)], routes)
+    backends = []
+    for i, cfg in enumerate(json.loads(raw)):
+        backends.append(LLMBackend(
+            name=cfg.get("name", f"backend{i}"),
+            base=cfg["base"],
+            model=cfg.get("model", OPENAI_MODEL),
+            api_key=cfg.get("api_key", OPENAI_API_KEY),
+            weight=cfg.get("weight", 1),
+            tags=cfg.get("tags"),
+        ))
+    print(f"[OK] Pool LLM: {[b.name for b in backends]} rotas={routes}")
+    return LLMPool(backends, routes)
+
+LLM_POOL = _load_llm_pool()
+
+def _llm_health_loop():
+    while True:
+        time.sleep(LLM_HEALTH_INTERVAL_S)
+        try:
+            LLM_POOL.check_all()
+        except Exception as e:
+            print(f"[WARN] Health check do pool LLM falhou: {e}")
+
+threading.Thread(target=_llm_health_loop, name="llm-health", daemon=True).start()
+
+def _llm_budget(op: str) -> float:
+    default = _LLM_DEFAULT_BUDGETS.get(op, _LLM_DEFAULT_BUDGETS["default"])
+    return float(os.getenv(f"LLM_TIMEOUT_{op.upper()}", default))
+
+_GUIDED_ERROR_MARKERS = ("guided", "response_format", "json_schema", "outlines", "xgrammar")
+
+def _guided_unsupported(status: int, body: str) -> bool:
+    """400 causado pelo guided decoding (parâmetro desconhecido/sem backend), e não por prompt/max_tokens."""
+    return status == 400 and any(m in body.lower() for m in _GUIDED_ERROR_MARKERS)
+
+def openai_chat(messages: List[Dict], temperature=0.4, max_tokens=800, json_schema: Optional[Dict] = None,
+                op: str = "default", idempotent: bool = True, n: int = 1, best_of: Optional[int] = None):
+    """
+    Chama o vLLM direto, sempre. Força UTF-8 no corpo para evitar erros de parse.
+    json_schema: se informado, restringe a geração ao schema (guided decoding do vLLM).
+    op: nome da operação → rota no pool (LLM_ROUTES), orçamento de tempo (LLM_TIMEOUT_<OP>) e métricas.
+    idempotent: permite retry com backoff+jitter em 429/502/503/504 e erros de conexão
+    (o retry prefere outro backend do pool).
+    n/best_of: várias amostras do mesmo prompt numa só requisição (o prefill é feito uma vez).
+    Com n > 1 devolve a lista de textos; com n == 1, o texto.
+    Dentro de uma rota com cancel_on_disconnect, a resposta do vLLM vem em streaming (e é juntada
+    aqui): se o cliente desconectar, a geração é abortada e sobe RequestCancelled.
+    """
+    check_quota(op)
+    scope = _cancel_scope.get()
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": scope is not None
+    }
+    if scope is not None:
+        payload["stream_options"] = {"include_usage": True}
+    if n > 1:
+        payload["n"] = n
+    if best_of and best_of > n:
+        payload["best_of"] = best_of
+    # campos de guided decoding: só entram no corpo para backends que ainda os aceitam
+    guided_fields = {}
+    if json_schema and LLM_GUIDED_DECODING == "response_format":
+        guided_fields["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": json_schema.get("title", "output"), "schema": json_schema},
+        }
+    elif json_schema and LLM_GUIDED_DECODING != "off":
+        guided_fields["guided_json"] = json_schema
+
+    deadline = time.time() + _llm_budget(op)
+    backend, r = _llm_post(op, payload, deadline, stream=scope is not None, idempotent=idempotent,
+                           guided_fields=guided_fields)
+    try:
+        if scope is not None:
+            texts = LLMStream(r, backend, op, max_tokens=max_tokens, n=n, release=False,
+                              prompt_chars=_prompt_chars(messages)).collect(deadline)
+            return texts if n > 1 else texts[0]
+        backend.breaker.record_success()
+        body = r.json()
+        choices = sorted(body["choices"], key=lambda c: c.get("index", 0))
+        if body.get("usage"):
+            metric_inc(f"llm_completion_tokens.{op}", body["usage"].get("completion_tokens", 0))
+            metric_inc(f"llm_completions.{op}", len(choices))
+        _record_usage(_usage_now(), op, backend.name, body.get("usage"), _prompt_chars(messages),
+                      sum(len(c["message"]["content"] or "") for c in choices) // context_packs.CHARS_PER_TOKEN)
+        if n > 1:
+            return [c["message"]["content"] for c in choices]
+        return choices[0]["message"]["content"]
+    finally:
+        LLM_POOL.release(backend)
+
+def openai_chat_stream(messages: List[Dict], temperature=0.4, max_tokens=800, op: str = "default"):
+    """
+    Versão em streaming do openai_chat: conecta (com retry enquanto nenhum token chegou) e devolve
+    um LLMStream (iterável de trechos de texto).
+    """
+    check_quota(op)
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    deadline = time.time() + _llm_budget(op)
+    backend, r = _llm_post(op, payload, deadline, stream=True)
+    return LLMStream(r, backend, op, max_tokens=max_tokens, prompt_chars=_prompt_chars(messages))
+
+def _llm_post(op: str, payload: Dict, deadline: float, stream: bool, idempotent: bool = True,
+              guided_fields: Optional[Dict] = None):
+    """
+    POST /chat/completions no pool, comum ao openai_chat e ao openai_chat_stream: escolhe o backend
+    (rota de `op`, preferindo um que ainda não falhou neste pedido), respeita o orçamento até
+    `deadline` e o circuit breaker, e repete com backoff+jitter em 429/502/503/504 e erros de
+    conexão (só se idempotent). 429 não conta como falha do backend (servidor vivo, só ocupado).
+    guided_fields: campos de guided decoding, enviados só a backends que ainda os aceitam.
+    Um 400 que recusa best_of é repetido sem ele.
+    Devolve (backend, resposta 2xx); o backend segue contado como ocupado até LLM_POOL.release.
+    """
+    scope = _cancel_scope.get()
+    attempt = 0
+    failed_backends = set()
+    guided_refused = set()
+    while True:
+        if scope is not None and scope.cancelled():
+            raise RequestCancelled(op)
+        backend = LLM_POOL.pick(op, exclude=failed_backends) or LLM_POOL.pick(op)
+        if backend is None:
+            metric_inc(f"llm_fail_fast.{op}")
+            raise LLMUnavailableError(
+                f"vLLM indisponível (circuit breaker aberto): {LLM_POOL.last_error()}",
+                retry_after=LLM_POOL.retry_after(),
+            )
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            LLM_POOL.release(backend)
+            metric_inc(f"llm_timeouts.{op}")
+            raise LLMTimeoutError(f"Orçamento de {_llm_budget(op):.0f}s esgotado para '{op}'")
+
+        error, retryable = "", False
+        guided = bool(guided_fields) and backend.guided_ok() and backend.name not in guided_refused
+        try:
+            r = requests.post(
+                f"{backend.base}/chat/completions",
+                headers=backend.headers(),
+                json={**payload, **(guided_fields if guided else {}), "model": backend.model},
+                timeout=(min(LLM_CONNECT_TIMEOUT_S, remaining), remaining),
+                stream=stream,
+            )
+        except requests.exceptions.ReadTimeout:
+            # o vLLM consumiu todo o orçamento sem responder: não há tempo para outra tentativa
+            LLM_POOL.release(backend)
+            backend.breaker.record_failure("read timeout")
+            metric_inc(f"llm_timeouts.{op}")
+            raise LLMTimeoutError(f"vLLM não respondeu em {_llm_budget(op):.0f}s ('{op}')")
+        except requests.exceptions.RequestException as e:
+            LLM_POOL.release(backend)
+            error, retryable = f"conexão: {e}", True
+            backend.breaker.record_failure(error)
         else:
-            raise Exception(f"vLLM retornou {r.status_code}: {r.text}")
-            
-    except Exception as e:
-        print(f"[DEBUG] openai_chat retornou: {str(e)}")
-        raise e
+            if r.ok:
+                # respondeu agora: vale mais que o último health check
+                backend.healthy, backend.health_detail = True, "ready"
+                return backend, r
+            body = r.text
+            r.close()
+            LLM_POOL.release(backend)
+            if guided and _guided_unsupported(r.status_code, body):
+                # este backend não tem guided decoding → repete nele sem restrição (o parse/reparo cobre)
+                backend.breaker.record_success()
+                backend.disable_guided(body)
+                guided_refused.add(backend.name)
+                continue
+            if r.status_code == 400 and "best_of" in payload and "best_of" in body:
+                # engine V1 do vLLM não aceita best_of → repete só com n (as n amostras continuam)
+                backend.breaker.record_success()
+                print(f"[WARN] {backend.name} recusou best_of, repetindo só com n: {body[:200]}")
+                payload = {k: v for k, v in payload.items() if k != "best_of"}
+                continue
+            error = f"vLLM ({backend.name}) retornou {r.status_code}: {body[:500]}"
+            if r.status_code in _RETRYABLE_STATUS:
+                retryable = True
+                if r.status_code != 429:
+                    backend.breaker.record_failure(error)
+            else:
+                backend.breaker.record_success()
+
+        failed_backends.add(backend.name)
+        print(f"[WARN] LLM ({op}, {backend.name}, tentativa {attempt + 1}) falhou: {error}")
+        if not (retryable and idempotent) or attempt >= LLM_MAX_RETRIES:
+            raise Exception(error)
+        # full jitter: espera aleatória em [0, min(teto, base * 2^tentativa)]
+        delay = random.uniform(0, min(LLM_RETRY_MAX_S, LLM_RETRY_BASE_S * (2 ** attempt)))
+        if time.time() + delay >= deadline:
+            raise Exception(error)
+        metric_inc(f"llm_retries.{op}")
+        time.sleep(delay)
+        attempt += 1
+
+class LLMStream:
+    """
+    Trechos de texto de uma geração em streaming do vLLM (SSE "data: {...}").
+    abort() pode ser chamado de outra thread: derruba o socket e o vLLM aborta a geração.
+    Se houver um CancelScope ativo, o stream se registra nele.
+    """
+    def __init__(self, r, backend: "LLMBackend", op: str, max_tokens: int = 800, n: int = 1, release: bool = True,
+                 prompt_chars: int = 0):
+        self.r = r
+        self.backend = backend
+        self.op = op
+        self.max_tokens = max_tokens
+        self.n = n
+        self.release = release           # False quando quem chamou já devolve o backend ao pool
+        self.finished = False
+        self.aborted = False
+        self.error = None                # o vLLM largou o stream antes do [DONE] (não foi cancelamento)
+        self.generated = 0               # trechos recebidos (~ tokens)
+        self.prompt_chars = prompt_chars
+        self.usage = None                # último chunk do vLLM (stream_options.include_usage)
+        self.usage_ctx = _usage_now()
+        self.scope = _cancel_scope.get()
+        if self.scope is not None:
+            self.scope.attach(self)
+
+    def events(self):
+        """(índice da escolha, trecho) conforme chegam."""
+        try:
+            for line in self.r.iter_lines(decode_unicode=True):
+                if self.aborted:
+                    break
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    self.finished = True
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    self.usage = chunk["usage"]
+                    metric_inc(f"llm_completion_tokens.{self.op}", chunk["usage"].get("completion_tokens", 0))
+                    metric_inc(f"llm_completions.{self.op}", self.n)
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        self.generated += 1
+                        yield choice.get("index", 0), delta
+            if self.finished:
+                self.backend.breaker.record_success()
+            elif not self.aborted:
+                self._fail("stream terminou sem [DONE]")
+        except requests.exceptions.RequestException as e:
+            if not self.aborted:
+                self._fail(f"conexão: {e}")
+            raise
+        finally:
+            self.close()
+
+    def _fail(self, error: str):
+        """Falha do vLLM no meio da geração: conta no breaker e vira erro (5xx), não cancelamento."""
+        self.error = error
+        self.backend.breaker.record_failure(error)
+        print(f"[WARN] LLM ({self.op}, {self.backend.name}) interrompeu a geração: {error}")
+
+    def _raise_if_failed(self):
+        if self.error:
+            raise Exception(f"vLLM ({self.backend.name}) interrompeu a geração: {self.error}")
+
+    def __iter__(self):
+        events = self.events()
+        try:
+            for _, delta in events:
+                yield delta
+        finally:
+            events.close()
+        self._raise_if_failed()
+
+    def collect(self, deadline: Optional[float] = None) -> List[str]:
+        """Junta os trechos de cada escolha (openai_chat dentro de uma rota cancelável)."""
+        texts: Dict[int, List[str]] = {}
+        events = self.events()
+        try:
+            for index, delta in events:
+                texts.setdefault(index, []).append(delta)
+                if deadline and time.time() > deadline:
+                    self.abort()
+                    metric_inc(f"llm_timeouts.{self.op}")
+                    raise LLMTimeoutError(f"vLLM não terminou em {_llm_budget(self.op):.0f}s ('{self.op}')")
+        except requests.exceptions.RequestException as e:
+            if not self.aborted:
+                raise Exception(f"conexão: {e}")
+        finally:
+            events.close()
+        self._raise_if_failed()
+        if self.aborted:
+            raise RequestCancelled(self.op)
+        return ["".join(texts.get(i, [])) for i in range(self.n)]
+
+    def abort(self):
+        r = self.r
+        if self.finished or self.aborted or r is None:
+            return
+        self.aborted = True
+        metric_inc(f"llm_stream_aborted.{self.op}")
+        # o que o vLLM ainda teria gerado (e ninguém ia ler)
+        expected = _expected_completion_tokens(self.op, self.max_tokens) * self.n
+        metric_inc(f"llm_tokens_avoided.{self.op}", max(0, round(expected) - self.generated))
+        try:
+            # close() sozinho não acorda a thread bloqueada no recv; shutdown sim (e manda FIN ao vLLM)
+            sock = getattr(getattr(r.raw, "connection", None), "sock", None)
+            if sock is None:
+                # sem keep-alive a conexão já soltou o socket; ele só resta no arquivo da resposta
+                fp = getattr(getattr(r.raw, "_fp", None), "fp", None)
+                sock = getattr(getattr(fp, "raw", None), "_sock", None)
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-def extract_metadata_from_chapter(book_id: str, chapter_title: str, chapter_text: str) -> BookMetadata:
-    """Extrai metadados estruturados do capítulo usando IA"""
+    def close(self):
+        if not self.finished and self.error is None:
+            self.abort()
+        if self.scope is not None:
+            self.scope.detach(self)
+        r, self.r = self.r, None         # pode ser chamado pela thread do stream e pela do pedido
+        if r is not None:
+            r.close()
+            _record_usage(self.usage_ctx, self.op, self.backend.name, self.usage, self.prompt_chars, self.generated)
+            if self.release:
+                LLM_POOL.release(self.backend)
+
+def _as_http_error(e: Exception) -> HTTPException:
+    """Traduz falhas do LLM em status HTTP claros (503 breaker aberto, 504 orçamento esgotado, 429 cota)."""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, LLMUnavailableError):
+        return HTTPException(status_code=503, detail=str(e),
+                             headers={"Retry-After": str(int(e.retry_after) + 1)})
+    if isinstance(e, LLMTimeoutError):
+        return HTTPException(status_code=504, detail=str(e))
+    if isinstance(e, QuotaExceededError):
+        return HTTPException(status_code=429, detail=str(e),
+                             headers={"Retry-After": str(int(e.retry_after) + 1)})
+    if isinstance(e, RequestCancelled):
+        # 499 (convenção do nginx): ninguém vai ler esta resposta, mas fica claro no log
+        return HTTPException(status_code=499, detail="Cliente desconectou; geração abortada")
+    return HTTPException(status_code=500, detail=str(e))
+
+@app.exception_handler(LLMUnavailableError)
+@app.exception_handler(LLMTimeoutError)
+@app.exception_handler(RequestCancelled)
+@app.exception_handler(QuotaExceededError)
+async def _llm_error_handler(request, exc):
+    """Endpoints sem try/except (ask, ideate, expand) também devolvem 503/504/499/429 em vez de 500."""
+    err = _as_http_error(exc)
+    return JSONResponse(status_code=err.status_code, content={"detail": err.detail}, headers=err.headers)
+
+class StructuredOutputError(Exception):
+    """O LLM não devolveu JSON válido para o schema, nem após reparo/retry."""
+    def __init__(self, message: str, raw: str = ""):
+        super().__init__(message)
+        self.raw = raw
+
+def _json_candidates(raw: str):
+    """Texto original, sem cercas de código, e o trecho entre o primeiro '{' e o último '}'."""
+    text = raw.strip()
+    yield text
+    fenced = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    yield fenced
+    m = re.search(r"\{.*\}", fenced, re.DOTALL)
+    if m:
+        yield m.group(0)
+        # vírgula sobrando antes de } ou ] é o erro mais comum de modelos pequenos
+        yield re.sub(r",\s*([}\]])", r"\1", m.group(0))
+
+def _parse_structured(raw: str, model_cls):
+    last_err = None
+    for candidate in _json_candidates(raw):
+        try:
+            data = json.loads(candidate)
+            if isinstance(data, list) and "ideas" in model_cls.model_fields:
+                data = {"ideas": data}
+            return model_cls(**data)
+        except Exception as e:
+            last_err = e
+    raise StructuredOutputError(f"JSON inválido para {model_cls.__name__}: {last_err}", raw)
+
+def llm_structured(messages: List[Dict], model_cls, op: str, temperature=0.3, max_tokens=1500):
+    """
+    Gera JSON restrito ao schema do modelo Pydantic (guided decoding) e valida.
+    Em falha: reparo local barato e depois até STRUCTURED_MAX_RETRIES pedidos de correção ao LLM.
+    """
+    schema = model_cls.model_json_schema()
+    raw = openai_chat(messages, temperature=temperature, max_tokens=max_tokens, json_schema=schema, op=op)
+    for attempt in range(STRUCTURED_MAX_RETRIES + 1):
+        try:
+            return _parse_structured(raw, model_cls)
+        except StructuredOutputError as e:
+            metric_inc(f"structured_parse_failures.{op}")
+            print(f"[WARN] Parse estruturado falhou ({op}, tentativa {attempt + 1}): {e}")
+            if attempt == STRUCTURED_MAX_RETRIES:
+                metric_inc(f"structured_gave_up.{op}")
+                raise
+            metric_inc(f"structured_retries.{op}")
+            repair = messages + [
+                {"role": "assistant", "content": raw[:4000]},
+                {"role": "user", "content": (
+                    f"A resposta acima não é JSON válido para o schema ({e}). "
+                    "Responda APENAS com o JSON corrigido, sem texto adicional."
+                )},
+            ]
+            raw = openai_chat(repair, temperature=0.0, max_tokens=max_tokens, json_schema=schema, op=op)
+
+def _placeholder_metadata(book_id: str) -> BookMetadata:
+    return BookMetadata(
+        book_id=book_id,
+        title=book_id.replace("_", " ").title(),
+        genre="Não identificado",
+        target_audience="Não identificado",
+        main_characters=[],
+        supporting_characters=[],
+        locations=[],
+        themes=[],
+        plot_summary="Não foi possível extrair resumo",
+        world_building={},
+        timeline="Não identificado",
+        relationships=[],
+        conflicts=[],
+        tone="Não identificado",
+        pacing="Não identificado"
+    )
+
+def try_extract_metadata(book_id: str, chapter_title: str, chapter_text: str) -> Optional[BookMetadata]:
+    """Extrai metadados estruturados do capítulo usando IA; None se o LLM não produzir JSON válido"""
     
     prompt = f"""
     Analise o seguinte capítulo e extraia metadados estruturados em formato JSON.
@@ -231,63 +1108,26 @@ def extract_metadata_from_chapter(book_id: str, chapter_title: str, chapter_text
     """
     
     try:
-        response = openai_chat([
+        return llm_structured([
             {"role": "system", "content": "Você é um assistente especializado em análise literária e extração de metadados estruturados. Sempre retorne JSON válido."},
             {"role": "user", "content": prompt}
-        ], temperature=0.3, max_tokens=1500)
-        
-        # Tenta extrair o JSON da resposta
-        import re
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(0)
-            metadata_dict = json.loads(json_str)
-            return BookMetadata(**metadata_dict)
-        else:
-            raise Exception("JSON não encontrado na resposta")
-            
+        ], BookMetadata, op="extract", temperature=0.3, max_tokens=1500)
     except Exception as e:
         print(f"[ERROR] Erro ao extrair metadados: {str(e)}")
-        # Retorna metadados básicos em caso de erro
-        return BookMetadata(
-            book_id=book_id,
-            title=book_id.replace("_", " ").title(),
-            genre="Não identificado",
-            target_audience="Não identificado",
-            main_characters=[],
-            supporting_characters=[],
-            locations=[],
-            themes=[],
-            plot_summary="Não foi possível extrair resumo",
-            world_building={},
-            timeline="Não identificado",
-            relationships=[],
-            conflicts=[],
-            tone="Não identificado",
-            pacing="Não identificado"
-        )
+        return None
+
+def extract_metadata_from_chapter(book_id: str, chapter_title: str, chapter_text: str) -> BookMetadata:
+    """Extrai metadados estruturados do capítulo usando IA (placeholder em caso de erro)"""
+    return try_extract_metadata(book_id, chapter_title, chapter_text) or _placeholder_metadata(book_id)
 
 # ========================
 # Helpers de caminho/leitura/sumário
 # ========================
-def _chapter_path(book_id: str, chapter_id: str) -> str:
-    return os.path.join(CHAPTER_DIR, f"{book_id}__{chapter_id}.md")
-
 def read_chapter(book_id: str, chapter_id: str) -> Dict:
-    path = _chapter_path(book_id, chapter_id)
-    if not os.path.exists(path):
+    ch = STORAGE.read_chapter(book_id, chapter_id)
+    if ch is None:
         raise HTTPException(status_code=404, detail="Capítulo não encontrado")
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
-    # título = primeira linha iniciando com "# "
-    title = "Capítulo"
-    first = content.splitlines()[0] if content else ""
-    if first.startswith("# "):
-        title = first[2:].strip()
-        text = content[len(first):].lstrip()
-    else:
-        text = content
-    return {"title": title, "text": text, "path": path}
+    return ch
 
 def summary_to_text(title: str, summary: Dict) -> str:
     return (
@@ -300,60 +1140,84 @@ def summary_to_text(title: str, summary: Dict) -> str:
         f"Temas: {summary.get('temas')}\n"
     )
 
-def save_chapter(book_id: str, chapter_id: str, title: str, text: str):
-    """Salva capítulo em arquivo local"""
-    path = os.path.join(CHAPTER_DIR, f"{book_id}__{chapter_id}.md")
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(f"# {title}\n\n{text}\n")
+def _record_revision(book_id: str, chapter_id: str, title: str, text: str, source: str):
+    try:
+        HISTORY.record(book_id, chapter_id, title, text, source)
+    except sqlite3.Error as e:
+        # o capítulo em si está salvo; só essa versão fica fora do histórico
+        print(f"[WARN] Revisão não registrada para {book_id}:{chapter_id}: {e}")
+
+def save_chapter(book_id: str, chapter_id: str, title: str, text: str, position: Optional[int] = None,
+                 index_vectors: bool = True, source: str = "save"):
+    """
+    Salva capítulo em arquivo local (e atualiza o histórico de revisões, o pacote de contexto, o índice
+    de busca e a ordem do livro). source: quem gravou, registrado na revisão (save, update, expand...).
+    index_vectors=False deixa os embeddings para depois (importação: feitos em lote no job).
+    """
+    if not HISTORY.has_history(book_id, chapter_id):
+        # capítulo anterior ao histórico: o texto que vai ser sobrescrito vira a revisão 1
+        old = STORAGE.read_chapter(book_id, chapter_id)
+        if old is not None:
+            _record_revision(book_id, chapter_id, old["title"], old["text"], "original")
+    path = STORAGE.write_chapter(book_id, chapter_id, title, text)
+    _record_revision(book_id, chapter_id, title, text, source)
+    _store_context_pack(book_id, chapter_id, title, text)
+    if position is None:
+        _list_chapter_ids(book_id)     # capítulo novo entra no fim da ordem
+    else:
+        chapter_order.move(book_id, chapter_id, position, _chapter_mtimes(book_id))
+    if index_vectors:
+        _update_vector_index(book_id, chapter_id, title, text)
+    if SEARCH_INDEX is not None:
+        try:
+            SEARCH_INDEX.upsert(book_id, chapter_id, title, text)
+        except (SearchUnavailableError, sqlite3.Error) as e:
+            # o capítulo já está salvo; a busca se recupera no próximo /search/{book_id}/reindex
+            print(f"[WARN] Índice de busca não atualizado para {book_id}:{chapter_id}: {e}")
     return path
 
-def save_suggestions(book_id: str, chapter_id: str, title: str, suggestions: str):
+def save_suggestions(book_id: str, chapter_id: str, title: str, suggestions: str, source_chapter_id: Optional[str] = None):
     """Salva sugestões em arquivo local"""
-    safe_title = title.replace(' ', '_').replace(':', '_').replace('/', '_').replace('\\', '_')
-    filename = f"sugest_{safe_title}__{chapter_id}.md"
-    path = os.path.join(CHAPTER_DIR, filename)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(f"# Sugestões para: {title}\n\n")
-        f.write(f"**Livro:** {book_id}\n")
-        f.write(f"**Capítulo:** {title}\n")
-        f.write(f"**Data:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        f.write("## Sugestões Geradas pela IA\n\n")
-        f.write(suggestions)
-    return path
+    content = (
+        f"# Sugestões para: {title}\n\n"
+        f"**Livro:** {book_id}\n"
+        f"**Capítulo:** {title}\n"
+        f"**Data:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+        "## Sugestões Geradas pela IA\n\n"
+        f"{suggestions}"
+    )
+    return STORAGE.save_artifact(book_id, "suggestion", chapter_id, title, content, chapter_id=source_chapter_id)
 
-def save_critique(book_id: str, chapter_id: str, title: str, critique: str):
+def save_critique(book_id: str, chapter_id: str, title: str, critique: str, source_chapter_id: Optional[str] = None):
     """Salva crítica em arquivo local"""
-    safe_title = title.replace(' ', '_').replace(':', '_').replace('/', '_').replace('\\', '_')
-    filename = f"critica_{safe_title}__{chapter_id}.md"
-    path = os.path.join(CHAPTER_DIR, filename)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(f"# Crítica para: {title}\n\n")
-        f.write(f"**Livro:** {book_id}\n")
-        f.write(f"**Capítulo:** {title}\n")
-        f.write(f"**Data:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        f.write("## Análise da IA\n\n")
-        f.write(critique)
-    return path
+    content = (
+        f"# Crítica para: {title}\n\n"
+        f"**Livro:** {book_id}\n"
+        f"**Capítulo:** {title}\n"
+        f"**Data:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+        "## Análise da IA\n\n"
+        f"{critique}"
+    )
+    return STORAGE.save_artifact(book_id, "critique", chapter_id, title, content, chapter_id=source_chapter_id)
 
-def upsert_to_chroma(book_id: str, chapter_id: str, title: str, text: str, summary: Dict) -> bool:
+def upsert_to_chroma(book_id: str, chapter_id: str, title: str, text: str, summary: Optional[Dict]) -> bool:
     """Upsert no Chroma com embeddings (cliente HTTP)."""
     if not (CHROMA_AVAILABLE and HAVE_CHROMA_CLIENT and COLLECTION):
         # Sem cliente → considere ok para não travar o fluxo
         print(f"[INFO] (skip) Chroma indisponível, seguindo sem indexar {book_id}:{chapter_id}")
         return True
     try:
-        summary_text = summary_to_text(title, summary) if isinstance(summary, dict) else str(summary)
-        docs = [summary_text, text]
+        ids = [f"{book_id}:{chapter_id}:full"]
+        docs = [text]
+        metadatas = [{"book_id": book_id, "chapter_id": chapter_id, "title": title, "type": "chapter"}]
+        # Resumo que falhou no parse não vira memória (seria lixo recuperado depois)
+        if summary and not (isinstance(summary, dict) and summary.get("parse_failed")):
+            ids.insert(0, f"{book_id}:{chapter_id}:summary")
+            docs.insert(0, summary_to_text(title, summary) if isinstance(summary, dict) else str(summary))
+            metadatas.insert(0, {"book_id": book_id, "chapter_id": chapter_id, "title": title, "type": "summary"})
 
         # Sem embeddings por enquanto - apenas texto
-        COLLECTION.upsert(
-            ids=[f"{book_id}:{chapter_id}:summary", f"{book_id}:{chapter_id}:full"],
-            documents=docs,
-            metadatas=[
-                {"book_id": book_id, "chapter_id": chapter_id, "title": title, "type": "summary"},
-                {"book_id": book_id, "chapter_id": chapter_id, "title": title, "type": "chapter"},
-            ],
-        )
+        COLLECTION.upsert(ids=ids, documents=docs, metadatas=metadatas)
         print(f"[OK] upsert Chroma: {book_id}:{chapter_id}")
         return True
     except Exception as e:
@@ -377,11 +1241,11 @@ def summarize_chapter(title: str, text: str) -> Dict:
         "content": f"Título: {title}\n\nTexto: {text}",
     }
     
-    out = openai_chat([sys, user], temperature=0.2, max_tokens=2000)
     try:
-        data = json.loads(out)
-    except Exception:
-        data = {
+        return llm_structured([sys, user], ChapterSummary, op="summarize", temperature=0.2, max_tokens=2000).model_dump()
+    except StructuredOutputError as e:
+        # parse_failed: o resumo não vai para o Chroma nem para a árvore de resumos
+        return {
             "personagens": [],
             "locais": [],
             "tempo": "",
@@ -389,9 +1253,24 @@ def summarize_chapter(title: str, text: str) -> Dict:
             "temas": [],
             "tom": "",
             "ganchos": [],
-            "raw": out,
+            "raw": e.raw,
+            "parse_failed": True,
         }
-    return data
+
+def _chapter_mtimes(book_id: str) -> Dict[str, float]:
+    return {cid: float(stamp.split(":")[0]) for cid, stamp in STORAGE.chapter_stamps(book_id).items()}
+
+def _list_chapter_ids(book_id: str) -> List[str]:
+    """IDs dos capítulos de um livro, na ordem narrativa (ver chapter_order)."""
+    return chapter_order.resolve(book_id, _chapter_mtimes(book_id))
+
+def _summarize_and_index(book_id: str, chapter_id: str) -> Dict:
+    """Resume um capítulo salvo e faz upsert no Chroma (unidade de trabalho do batch)."""
+    ch = read_chapter(book_id, chapter_id)
+    summary = summarize_chapter(ch["title"], ch["text"])
+    chroma_ok = upsert_to_chroma(book_id, chapter_id, ch["title"], ch["text"], summary)
+    index_chapter_summary(book_id, chapter_id, ch["title"], summary)
+    return {"title": ch["title"], "summary": summary, "chroma_saved": chroma_ok}
 
 def get_chromadb_health_string():
     """Retorna o status do ChromaDB"""
@@ -405,6 +1284,405 @@ def get_chromadb_health_string():
         return "degraded"
     return "disconnected"
 
+# ========================
+# Árvore de resumos (capítulo → arco → livro)
+# ========================
+# Persistida em /data/summaries/<book_id>.json. As folhas são os resumos de capítulo
+# (summarize_chapter / extract_metadata_from_chapter); os arcos agrupam SUMMARY_ARC_SIZE
+# capítulos e a sinopse resume os arcos. Cada nó guarda o hash dos filhos, então só
+# o que mudou é regerado no LLM.
+SUMMARY_DIR = os.path.join(DATA_DIR, "summaries")
+SUMMARY_ARC_SIZE = int(os.getenv("SUMMARY_ARC_SIZE", "8"))
+os.makedirs(SUMMARY_DIR, exist_ok=True)
+
+_summary_tree_locks: Dict[str, threading.Lock] = {}
+_summary_tree_locks_guard = threading.Lock()
+
+def _summary_tree_lock(book_id: str) -> threading.Lock:
+    with _summary_tree_locks_guard:
+        return _summary_tree_locks.setdefault(book_id, threading.Lock())
+
+def _summary_tree_path(book_id: str) -> str:
+    return os.path.join(SUMMARY_DIR, f"{book_id}.json")
+
+def load_summary_tree(book_id: str) -> Dict:
+    path = _summary_tree_path(book_id)
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[WARN] Árvore de resumos corrompida para {book_id}: {e}")
+    return {"book_id": book_id, "version": 0, "chapters": {}, "arcs": [], "synopsis": None}
+
+def _save_summary_tree(tree: Dict):
+    path = _summary_tree_path(tree["book_id"])
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(tree, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+def _hash_text(*parts: str) -> str:
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def _summary_leaf_text(title: str, summary) -> str:
+    """Texto compacto da folha, aceitando o resumo estruturado ou o dict de BookMetadata."""
+    if isinstance(summary, dict) and "plot_summary" in summary:
+        chars = ", ".join(c.get("name", "") for c in summary.get("main_characters", []) if c.get("name"))
+        return (
+            f"Título: {title}\n"
+            f"Personagens: {chars}\n"
+            f"Resumo: {summary.get('plot_summary')}\n"
+            f"Conflitos: {summary.get('conflicts')}\n"
+        )
+    if isinstance(summary, dict):
+        return summary_to_text(title, summary)
+    return f"Título: {title}\n{summary}"
+
+def _summary_characters(summary) -> List[str]:
+    """Nomes de personagens do resumo estruturado ou do dict de BookMetadata."""
+    if not isinstance(summary, dict):
+        return []
+    if "plot_summary" in summary:
+        people = summary.get("main_characters", []) + summary.get("supporting_characters", [])
+        return [c.get("name", "").strip() for c in people if c.get("name", "").strip()]
+    return [str(p).strip() for p in summary.get("personagens") or [] if str(p).strip()]
+
+def update_summary_tree_chapter(book_id: str, chapter_id: str, title: str, summary):
+    """Atualiza a folha do capítulo; os nós acima são refeitos em refresh_summary_tree."""
+    if not summary or (isinstance(summary, dict) and summary.get("parse_failed")):
+        return
+    text = _summary_leaf_text(title, summary)
+    with _summary_tree_lock(book_id):
+        tree = load_summary_tree(book_id)
+        tree["chapters"][chapter_id] = {
+            "title": title,
+            "text": text,
+            "hash": _hash_text(text),
+            "characters": _summary_characters(summary),
+            "updated_at": datetime.now().isoformat(),
+        }
+        _save_summary_tree(tree)
+    context_packs.set_summary(book_id, chapter_id, text, _hash_text(text), _summary_characters(summary))
+
+def index_chapter_summary(book_id: str, chapter_id: str, title: str, summary):
+    """Guarda o que o LLM extraiu do capítulo: folha da árvore de resumos + entidades (personagens/locais)."""
+    update_summary_tree_chapter(book_id, chapter_id, title, summary)
+    try:
+        entity_index.set_chapter(book_id, chapter_id, title, summary)
+    except Exception as e:
+        print(f"[WARN] Índice de entidades não atualizado para {book_id}:{chapter_id}: {e}")
+
+def _summarize_arc(book_id: str, index: int, leaves: List[Dict]) -> str:
+    sys = {
+        "role": "system",
+        "content": (
+            "Você é um editor literário. Condense os resumos de capítulos abaixo em um resumo do ARCO "
+            "(até 250 palavras): eventos principais em ordem, evolução dos personagens e pontas soltas. PT-BR."
+        ),
+    }
+    body = "\n\n".join(f"### {leaf['title']}\n{leaf['text']}" for leaf in leaves)
+    user = {"role": "user", "content": f"Livro: {book_id} — Arco {index + 1}\n\n{body}"}
+    return openai_chat([sys, user], temperature=0.2, max_tokens=700, op="summary_tree")
+
+def _summarize_book(book_id: str, arcs: List[Dict]) -> str:
+    sys = {
+        "role": "system",
+        "content": (
+            "Você é um editor literário. Escreva a SINOPSE do livro inteiro (até 400 palavras) a partir dos "
+            "resumos de arco: trama principal, arcos dos personagens, conflitos em aberto. PT-BR."
+        ),
+    }
+    body = "\n\n".join(f"### Arco {a['index'] + 1}\n{a['summary']}" for a in arcs)
+    user = {"role": "user", "content": f"Livro: {book_id}\n\n{body}"}
+    return openai_chat([sys, user], temperature=0.2, max_tokens=900, op="summary_tree")
+
+def refresh_summary_tree(book_id: str, force: bool = False) -> Dict:
+    """Regera só os arcos cujos capítulos mudaram e, se preciso, a sinopse do livro."""
+    with _summary_tree_lock(book_id):
+        tree = load_summary_tree(book_id)
+        existing = set(_list_chapter_ids(book_id))
+        # capítulos apagados do disco saem da árvore
+        tree["chapters"] = {cid: leaf for cid, leaf in tree["chapters"].items() if cid in existing}
+        order = [cid for cid in _list_chapter_ids(book_id) if cid in tree["chapters"]]
+
+        old_arcs = {a["hash"]: a for a in tree.get("arcs", [])}
+        arcs, changed = [], False
+        for index, start in enumerate(range(0, len(order), SUMMARY_ARC_SIZE)):
+            ids = order[start:start + SUMMARY_ARC_SIZE]
+            leaves = [tree["chapters"][cid] for cid in ids]
+            h = _hash_text(*[leaf["hash"] for leaf in leaves])
+            prev = old_arcs.get(h)
+            if prev and not force:
+                arcs.append({**prev, "index": index})
+                continue
+            arcs.append({
+                "index": index,
+                "chapter_ids": ids,
+                "hash": h,
+                "summary": _summarize_arc(book_id, index, leaves),
+            })
+            changed = True
+
+        synopsis = tree.get("synopsis")
+        syn_hash = _hash_text(*[a["hash"] for a in arcs]) if arcs else ""
+        if not arcs:
+            changed = changed or synopsis is not None or bool(tree.get("arcs"))
+            synopsis = None
+        elif force or not synopsis or synopsis.get("hash") != syn_hash:
+            synopsis = {"hash": syn_hash, "text": _summarize_book(book_id, arcs)}
+            changed = True
+
+        if changed or len(arcs) != len(tree.get("arcs", [])):
+            tree["arcs"] = arcs
+            tree["synopsis"] = synopsis
+            tree["version"] = int(tree.get("version", 0)) + 1
+            tree["updated_at"] = datetime.now().isoformat()
+            _save_summary_tree(tree)
+            print(f"[OK] Árvore de resumos atualizada: {book_id} (v{tree['version']}, {len(arcs)} arcos)")
+        return tree
+
+def _refresh_summary_tree_safe(book_id: str):
+    """Versão para BackgroundTasks: falha do LLM não derruba nada, a árvore só fica desatualizada."""
+    if _usage_ctx.get() is None:
+        _usage_ctx.set(UsageContext(book_id, "", "(segundo plano)"))
+    try:
+        refresh_summary_tree(book_id)
+    except Exception as e:
+        print(f"[WARN] Falha ao atualizar árvore de resumos de {book_id}: {e}")
+
+def _fmt_summary_tree(book_id: str) -> str:
+    """Contexto global de tamanho limitado: sinopse + um bloco por arco."""
+    tree = load_summary_tree(book_id)
+    if not tree.get("synopsis") and not tree.get("arcs"):
+        return ""
+    titles = {cid: leaf["title"] for cid, leaf in tree["chapters"].items()}
+    blocks = []
+    if tree.get("synopsis"):
+        blocks.append(f"## SINOPSE DO LIVRO\n{tree['synopsis']['text']}")
+    for arc in tree.get("arcs", []):
+        first = titles.get(arc["chapter_ids"][0], arc["chapter_ids"][0])
+        last = titles.get(arc["chapter_ids"][-1], arc["chapter_ids"][-1])
+        blocks.append(f"## ARCO {arc['index'] + 1} ({first} → {last})\n{arc['summary']}")
+    return "\n\n".join(blocks)
+
+# ========================
+# Pacotes de contexto por capítulo (ver context_packs)
+# ========================
+# Montados quando o capítulo é salvo: o RAG só concatena prévia, trecho e personagens já prontos,
+# sem reler nem normalizar o texto inteiro dos capítulos a cada pedido.
+def _make_context_pack(book_id: str, chapter_id: str, title: str, text: str, stamp: Optional[str]) -> Dict:
+    leaf = load_summary_tree(book_id).get("chapters", {}).get(chapter_id) or {}
+    pack = context_packs.build(
+        chapter_id, title, text, stamp, _hash_text(title, text.strip()), vector_index.chunk_spans(text),
+        summary=leaf.get("text", ""), summary_hash=leaf.get("hash"), entities=leaf.get("characters"),
+    )
+    context_packs.save(book_id, pack)
+    return pack
+
+def _store_context_pack(book_id: str, chapter_id: str, title: str, text: str):
+    """Chamado ao salvar; se falhar, o pacote é refeito na primeira leitura."""
+    try:
+        _make_context_pack(book_id, chapter_id, title, text, STORAGE.chapter_stamps(book_id).get(chapter_id))
+    except Exception as e:
+        print(f"[WARN] Pacote de contexto não gerado para {book_id}:{chapter_id}: {e}")
+
+def _context_packs(book_id: str, chapter_ids: List[str]) -> Dict[str, Dict]:
+    """Pacotes dos capítulos pedidos; os que faltam ou ficaram velhos (stamp diferente) são refeitos."""
+    stamps = STORAGE.chapter_stamps(book_id)
+    out = {}
+    for cid in chapter_ids:
+        if cid in out or cid not in stamps:
+            continue
+        pack = context_packs.load(book_id, cid)
+        if pack and pack.get("stamp") == stamps[cid]:
+            metric_inc("context_pack_hits")
+        else:
+            metric_inc("context_pack_misses")
+            ch = STORAGE.read_chapter(book_id, cid)
+            if not ch:
+                continue
+            pack = _make_context_pack(book_id, cid, ch["title"], ch["text"], stamps[cid])
+        out[cid] = pack
+    return out
+
+# ========================
+# Janela de capítulos anteriores (contexto 'previous')
+# ========================
+# Para continuar a história, o contexto mais útil costuma ser o que veio logo antes: resumos dos
+# N capítulos anteriores (folhas da árvore de resumos) + o texto integral do último deles. Sai
+# mais barato que a busca por embeddings; o texto montado fica em cache por posição e vale
+# enquanto a ordem, os textos e os resumos desses capítulos não mudarem.
+CONTEXT_PREVIOUS_N = int(os.getenv("CONTEXT_PREVIOUS_N", "3"))
+CONTEXT_LAST_CHAPTER_CHARS = int(os.getenv("CONTEXT_LAST_CHAPTER_CHARS", "12000"))
+_WINDOW_CACHE_MAX = 256
+
+_window_cache: Dict[tuple, tuple] = {}
+_window_lock = threading.Lock()
+
+def _fmt_previous_chapters(book_id: str, before: Optional[str] = None, n: int = CONTEXT_PREVIOUS_N) -> str:
+    """Janela dos n capítulos anteriores a `before` (ou ao fim do livro, se None/desconhecido)."""
+    if n <= 0:
+        return ""
+    order = _list_chapter_ids(book_id)
+    end = order.index(before) if before in order else len(order)
+    ids = order[max(0, end - n):end]
+    if not ids:
+        return ""
+    packs = _context_packs(book_id, ids)
+    first = end - len(ids)
+    key = (first, tuple((cid, (packs.get(cid) or {}).get("stamp"), (packs.get(cid) or {}).get("summary_hash"))
+                        for cid in ids))
+    cache_key = (book_id, before if before in order else "", n)
+    with _window_lock:
+        cached = _window_cache.get(cache_key)
+    if cached and cached[0] == key:
+        metric_inc("context_window_hits")
+        return cached[1]
+    metric_inc("context_window_misses")
+
+    blocks = []
+    for pos, cid in enumerate(ids[:-1], start=first + 1):
+        pack = packs.get(cid)
+        if pack:
+            body = pack["summary"].strip() or f"{pack['preview']}…"   # sem resumo: o começo do capítulo
+            blocks.append(f"### {pos}. {pack['title']}\n{body}")
+    parts = []
+    if blocks:
+        parts.append("## CAPÍTULOS ANTERIORES (resumos, em ordem)\n" + "\n\n".join(blocks))
+    last = STORAGE.read_chapter(book_id, ids[-1])
+    if last:
+        text = last["text"]
+        if len(text) > CONTEXT_LAST_CHAPTER_CHARS:
+            text = "…" + text[-CONTEXT_LAST_CHAPTER_CHARS:]   # o fim é o que a continuação precisa
+        parts.append(f"## CAPÍTULO ANTERIOR ({end}. {last['title']})\n{text}")
+    out = "\n\n".join(parts)
+    with _window_lock:
+        if len(_window_cache) >= _WINDOW_CACHE_MAX:
+            _window_cache.pop(next(iter(_window_cache)))
+        _window_cache[cache_key] = (key, out)
+    return out
+
+def _warm_previous_window(book_id: str):
+    """BackgroundTasks: deixa pronta a janela do fim do livro (o próximo capítulo a escrever)."""
+    try:
+        _fmt_previous_chapters(book_id)
+    except Exception as e:
+        print(f"[WARN] Janela de capítulos anteriores não pré-calculada para {book_id}: {e}")
+
+# ========================
+# Montagem de prompts (prefixo estável por livro → prefix caching do vLLM)
+# ========================
+# O vLLM só reaproveita KV-cache de prefixos idênticos byte a byte. Por isso toda chamada
+# sobre um livro começa com o mesmo preâmbulo (papel + metadados + sinopse + personagens),
+# que só muda quando a árvore de resumos ou o cadastro do livro mudam. Instruções da
+# operação, contexto recuperado e pergunta vêm depois, na mensagem do usuário.
+PROMPT_PREAMBLE_VERSION = "v1"
+BOOKS_META_DIR = os.path.join(DATA_DIR, "books")
+PREAMBLE_MAX_CHARACTERS = int(os.getenv("PREAMBLE_MAX_CHARACTERS", "30"))
+
+_BASE_ROLE = (
+    "Você é o copiloto de escrita deste livro: coautor, co-roteirista e editor atento à continuidade. "
+    "Respeite os fatos, personagens e o tom estabelecidos abaixo. Responda sempre em português brasileiro."
+)
+
+_preamble_cache: Dict[str, tuple] = {}
+_preamble_lock = threading.Lock()
+
+def _mtime_ns(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def _book_display_name(book_id: str) -> str:
+    try:
+        with open(os.path.join(BOOKS_META_DIR, f"{book_id}.json"), "r", encoding="utf-8") as f:
+            return json.load(f).get("name") or book_id
+    except Exception:
+        return book_id
+
+def _character_sheet(tree: Dict) -> str:
+    counts: Dict[str, int] = {}
+    for leaf in tree.get("chapters", {}).values():
+        for name in set(leaf.get("characters", [])):
+            counts[name] = counts.get(name, 0) + 1
+    # ordem determinística: mesmo conteúdo → mesmos bytes
+    ranked = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:PREAMBLE_MAX_CHARACTERS]
+    return "\n".join(f"- {name} (aparece em {n} capítulo(s))" for name, n in ranked)
+
+def book_preamble(book_id: Optional[str]) -> str:
+    """Mensagem de sistema estável e versionada do livro (cacheada até a árvore/cadastro mudar)."""
+    if not book_id:
+        return _BASE_ROLE
+    key = (_mtime_ns(_summary_tree_path(book_id)), _mtime_ns(os.path.join(BOOKS_META_DIR, f"{book_id}.json")))
+    with _preamble_lock:
+        cached = _preamble_cache.get(book_id)
+        if cached and cached[0] == key:
+            metric_inc("preamble_cache_hits")
+            return cached[1]
+    metric_inc("preamble_cache_misses")
+    tree = load_summary_tree(book_id)
+    parts = [_BASE_ROLE, f"## LIVRO\nID: {book_id}\nNome: {_book_display_name(book_id)}"]
+    if tree.get("synopsis"):
+        parts.append(f"## SINOPSE\n{tree['synopsis']['text']}")
+    sheet = _character_sheet(tree)
+    if sheet:
+        parts.append(f"## PERSONAGENS\n{sheet}")
+    body = "\n\n".join(parts)
+    text = f"[preâmbulo {PROMPT_PREAMBLE_VERSION} · {_hash_text(body)}]\n{body}"
+    with _preamble_lock:
+        _preamble_cache[book_id] = (key, text)
+    return text
+
+def build_messages(book_id: Optional[str], task: str, volatile: str) -> List[Dict]:
+    """[preâmbulo estável do livro] + [tarefa + contexto volátil + pergunta]."""
+    return [
+        {"role": "system", "content": book_preamble(book_id)},
+        {"role": "user", "content": f"## TAREFA\n{task}\n\n{volatile}"},
+    ]
+
+def _prompt_preview(messages: List[Dict]) -> str:
+    return "\n\n".join(f"[{m['role'].upper()}]\n{m['content']}" for m in messages)
+
+def _parse_prometheus(text: str) -> Dict[str, float]:
+    """Soma as séries de cada métrica (ignora labels) do formato texto do Prometheus."""
+    out: Dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        try:
+            name_labels, value = line.rsplit(" ", 1)
+            name = name_labels.split("{", 1)[0]
+            out[name] = out.get(name, 0.0) + float(value)
+        except ValueError:
+            continue
+    return out
+
+def prefix_cache_stats() -> List[Dict]:
+    """Hit rate do prefix cache de cada backend, lido do /metrics do vLLM."""
+    stats = []
+    for b in LLM_POOL.backends:
+        root = b.base[:-3] if b.base.endswith("/v1") else b.base
+        entry = {"backend": b.name}
+        try:
+            r = requests.get(f"{root}/metrics", headers=b.headers(), timeout=5)
+            r.raise_for_status()
+            m = _parse_prometheus(r.text)
+            # V1 engine: contadores de queries/hits; V0: gauge de hit rate
+            queries = m.get("vllm:prefix_cache_queries_total", m.get("vllm:gpu_prefix_cache_queries_total"))
+            hits = m.get("vllm:prefix_cache_hits_total", m.get("vllm:gpu_prefix_cache_hits_total"))
+            if queries:
+                entry.update(queries=queries, hits=hits or 0.0, hit_rate=round((hits or 0.0) / queries, 4))
+            elif "vllm:gpu_prefix_cache_hit_rate" in m:
+                entry["hit_rate"] = round(m["vllm:gpu_prefix_cache_hit_rate"], 4)
+            else:
+                entry["detail"] = "métricas de prefix cache não encontradas (ative --enable-prefix-caching)"
+        except Exception as e:
+            entry["error"] = str(e)
+        stats.append(entry)
+    return stats
+
 # ========================
 # Endpoints
 # ========================
@@ -417,23 +1695,32 @@ def health_check():
         "timestamp": datetime.now().isoformat()
     }
 
-@app.get("/ready")
-def ready():
-    """Endpoint para verificar se todos os serviços estão prontos"""
+# /ready é consultado pela UI a cada poucos segundos: o resultado fica em cache por READY_CACHE_TTL_S
+READY_CACHE_TTL_S = float(os.getenv("READY_CACHE_TTL_S", "5"))
+_ready_cache: Dict = {"at": 0.0, "value": None}
+_ready_lock = threading.Lock()
+_ready_chroma = None   # cliente criado só se o CHROMA_CLIENT do startup não existir
+
+def _readiness_chroma_client():
+    global _ready_chroma
+    if HAVE_CHROMA_CLIENT:
+        return CHROMA_CLIENT
+    if _ready_chroma is None:
+        _ready_chroma = chromadb.HttpClient(
+            host=CHROMA_HOST,
+            port=CHROMA_PORT,
+            settings=Settings(anonymized_telemetry=False)
+        )
+    return _ready_chroma
+
+def _check_ready() -> Dict:
     try:
-        # Verifica ChromaDB
+        # Verifica ChromaDB (heartbeat no cliente já existente)
         chroma_ok = False
         chroma_status = "disconnected"
         if CHROMA_AVAILABLE:
             try:
-                # Testa conexão com ChromaDB
-                client = chromadb.HttpClient(
-                    host=CHROMA_HOST,
-                    port=CHROMA_PORT,
-                    settings=Settings(anonymized_telemetry=False)
-                )
-                # Tenta listar collections (teste simples)
-                client.list_collections()
+                _readiness_chroma_client().heartbeat()
                 chroma_ok = True
                 chroma_status = "ready"
             except Exception as e:
@@ -441,19 +1728,21 @@ def ready():
         else:
             chroma_status = "not configured"
         
-        # Verifica vLLM
-        llm_ok = False
-        llm_detail = "checking..."
-        try:
-            # Testa se o vLLM está respondendo
-            r = requests.get(f"{OPENAI_API_BASE.replace('/v1', '')}/v1/models", timeout=5)
-            if r.status_code == 200:
-                llm_ok = True
-                llm_detail = "ready"
-            else:
-                llm_detail = f"status {r.status_code}"
-        except Exception as e:
-            llm_detail = f"error: {str(e)}"
+        # Verifica vLLM (todos os backends do pool; pronto se ao menos um atende).
+        # Com mais de um backend, o health loop já mantém o estado atualizado.
+        if len(LLM_POOL.backends) > 1:
+            backends = [b.snapshot() for b in LLM_POOL.backends]
+        else:
+            backends = LLM_POOL.check_all()
+        usable = [b for b in backends if b["healthy"] and b["breaker"]["state"] != "open"]
+        llm_ok = bool(usable)
+        if llm_ok:
+            llm_detail = "ready"
+        elif any(b["healthy"] for b in backends):
+            # /v1/models responde, mas as gerações estão falhando (ex.: recarga de modelo)
+            llm_detail = "circuit breaker aberto"
+        else:
+            llm_detail = "; ".join(f"{b['name']}: {b['detail']}" for b in backends)
         
         # Sistema está pronto se ambos os serviços estiverem ok
         ready = chroma_ok and llm_ok
@@ -466,7 +1755,8 @@ def ready():
             },
             "llm": {
                 "ok": llm_ok,
-                "detail": llm_detail
+                "detail": llm_detail,
+                "backends": backends
             },
             "timestamp": datetime.now().isoformat()
         }
@@ -478,25 +1768,477 @@ def ready():
             "chroma": {"ok": False, "status": "error"},
             "llm": {"ok": False, "detail": "error"}
         }
+
+@app.get("/ready")
+def ready(fresh: bool = False):
+    """Endpoint para verificar se todos os serviços estão prontos (cache de READY_CACHE_TTL_S; fresh=true ignora)"""
+    with _ready_lock:
+        age = time.time() - _ready_cache["at"]
+        if fresh or _ready_cache["value"] is None or age >= READY_CACHE_TTL_S:
+            _ready_cache["value"] = _check_ready()
+            _ready_cache["at"] = time.time()
+            age = 0.0
+        return {**_ready_cache["value"], "cache_age_s": round(age, 2)}
+
+@app.get("/llm/backends")
+def llm_backends():
+    """Estado do pool de backends vLLM (saúde, requisições em voo, breaker) e rotas por operação"""
+    return {"backends": [b.snapshot() for b in LLM_POOL.backends], "routes": LLM_POOL.routes}
+
+@app.get("/llm/prefix-cache")
+def llm_prefix_cache():
+    """Hit rate do prefix cache do vLLM (por backend) e uso do cache local de preâmbulos"""
+    with _metrics_lock:
+        local = {k: METRICS.get(k, 0) for k in ("preamble_cache_hits", "preamble_cache_misses")}
+    return {
+        "preamble_version": PROMPT_PREAMBLE_VERSION,
+        "backends": prefix_cache_stats(),
+        "preamble_cache": local,
+    }
+
+@app.get("/metrics")
+def metrics():
+    """Contadores internos (falhas de parse estruturado, retries etc.)"""
+    with _metrics_lock:
+        counters = dict(sorted(METRICS.items()))
+    return {"counters": counters, "timestamp": datetime.now().isoformat()}
+
+class QuotaIn(BaseModel):
+    scope: str                      # book | user
+    key: str                        # book_id ou valor do header X-User
+    tokens: Optional[int] = None    # None remove a exceção (volta ao padrão); 0 = sem limite
+
+def _parse_when(value: Optional[str], name: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data inválida em '{name}' (use ISO 8601): {value}")
+
+@app.get("/usage")
+def usage_report(group_by: str = "book,endpoint", hours: float = 24, since: Optional[str] = None,
+                 until: Optional[str] = None, book_id: Optional[str] = None, user: Optional[str] = None,
+                 endpoint: Optional[str] = None):
+    """Tokens gastos no vLLM, agrupados (book, user, endpoint, op, backend, hour, day) na janela pedida."""
+    groups = [g.strip() for g in group_by.split(",") if g.strip()]
+    invalid = [g for g in groups if g not in USAGE_GROUPS]
+    if invalid:
+        raise HTTPException(status_code=400,
+                            detail=f"Agrupamento inválido: {', '.join(invalid)} (use {', '.join(USAGE_GROUPS)})")
+    start = _parse_when(since, "since") or time.time() - hours * 3600
+    end = _parse_when(until, "until")
+    rows = USAGE.summary(groups, since=start, until=end, book_id=book_id, user_id=user, endpoint=endpoint)
+    totals = {k: sum(r[k] for r in rows) for k in ("calls", "prompt_tokens", "completion_tokens", "total_tokens")}
+    return {
+        "since": datetime.fromtimestamp(start).isoformat(),
+        "until": datetime.fromtimestamp(end).isoformat() if end else None,
+        "group_by": groups,
+        "totals": totals,
+        "rows": rows,
+    }
+
+@app.get("/usage/quotas")
+def usage_quotas(book_id: Optional[str] = None, user: Optional[str] = None):
+    """Cotas (padrão + exceções) e, se pedido, quanto o livro/usuário já gastou na janela atual."""
+    status = []
+    if book_id:
+        status.append(_quota_status("book", book_id))
+    if user:
+        status.append(_quota_status("user", user))
+    return {
+        "window_s": QUOTA_WINDOW_S,
+        "defaults": {"book": QUOTA_BOOK_TOKENS, "user": QUOTA_USER_TOKENS},
+        "overrides": USAGE.quota_overrides(),
+        "status": status,
+    }
+
+@app.put("/usage/quotas")
+def set_usage_quota(payload: QuotaIn):
+    """Define (ou remove, com tokens=null) a cota de um livro ou usuário específico."""
+    if payload.scope not in ("book", "user"):
+        raise HTTPException(status_code=400, detail="scope deve ser 'book' ou 'user'")
+    if payload.tokens is not None and payload.tokens < 0:
+        raise HTTPException(status_code=400, detail="tokens não pode ser negativo")
+    USAGE.set_quota(payload.scope, payload.key, payload.tokens)
+    return _quota_status(payload.scope, payload.key)
+
+def _book_version(book_id: str) -> str:
+    """Muda sempre que um capítulo, sugestão ou crítica do livro muda (sem ler conteúdo)."""
+    stamps = STORAGE.chapter_stamps(book_id)
+    return _hash_text(json.dumps(stamps, sort_keys=True), json.dumps(STORAGE.counts(book_id), sort_keys=True),
+                      str(chapter_order.version(book_id)))
+
+def _book_names() -> Dict[str, str]:
+    names = {}
+    try:
+        for fn in os.listdir(BOOKS_DIR):
+            if fn.endswith(".json"):
+                with open(os.path.join(BOOKS_DIR, fn), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                names[meta["id"]] = meta.get("name", meta["id"])
+    except FileNotFoundError:
+        pass
+    except (OSError, json.JSONDecodeError, KeyError) as e:
+        print(f"[WARN] Metadados de livros ilegíveis: {e}")
+    return names
+
+def _library_version() -> str:
+    """Muda quando um livro é criado/renomeado/removido ou a versão de algum livro muda."""
+    meta = {}
+    try:
+        with os.scandir(BOOKS_DIR) as it:
+            for e in it:
+                if e.name.endswith(".json"):
+                    st = e.stat()
+                    meta[e.name[:-5]] = f"{st.st_mtime:.6f}:{st.st_size}"
+    except FileNotFoundError:
+        pass
+    books = {bid: _book_version(bid) for bid in sorted(set(meta) | set(STORAGE.list_books()))}
+    return _hash_text(json.dumps(meta, sort_keys=True), json.dumps(books, sort_keys=True))
+
+@app.get("/books")
+def list_books():
+    """Livros (metadados da UI + livros com capítulos) com contagens e versão, sem ler capítulos."""
+    names = _book_names()
+    books = []
+    for bid in sorted(set(names) | set(STORAGE.list_books())):
+        books.append({
+            "id": bid,
+            "name": names.get(bid) or bid.replace("_", " ").replace("-", " ").title(),
+            **STORAGE.counts(bid),
+            "version": _book_version(bid),
+        })
+    return {"books": books}
+
+@app.get("/books/version")
+def library_version():
+    """Versão da lista de livros: a UI só refaz GET /books quando ela muda."""
+    return {"version": _library_version()}
+
+@app.get("/books/{book_id}/version")
+def book_version(book_id: str):
+    """Versão barata do livro: a UI só refaz listagens em cache quando ela muda."""
+    return {"book_id": book_id, "version": _book_version(book_id)}
+
 @app.get("/chapters/{book_id}")
 def list_chapters(book_id: str):
-    import glob
-    import os
-    base = "/data/chapters"
-    files = sorted(glob.glob(os.path.join(base, f"{book_id}__*.md")))
+    """
+    Lista leve (título, tamanho, data), sem o texto, na ordem narrativa do livro;
+    o conteúdo vem de /chapter/{book_id}/{chapter_id}.
+    """
+    position = {cid: i for i, cid in enumerate(_list_chapter_ids(book_id))}
     out = []
-    for fp in files:
-        try:
-            with open(fp, "r", encoding="utf-8") as f:
-                content = f.read()
-            # título = primeira linha '# ' ou 1ª linha não vazia
-            first = next((ln.strip() for ln in content.splitlines() if ln.strip()), "")
-            title = first[2:].strip() if first.startswith("# ") else (first[:120] or "Capítulo")
-            chap_id = os.path.basename(fp).split("__", 1)[1].removesuffix(".md")
-            out.append({"id": chap_id, "title": title, "file_path": fp})
-        except Exception:
-            pass
-    return {"book_id": book_id, "chapters": out}
+    for ch in STORAGE.list_chapters(book_id):
+        out.append({"id": ch["id"], "title": ch["title"], "file_path": ch["path"],
+                    "size": ch.get("size"), "modified": ch.get("mtime"),
+                    "position": position.get(ch["id"], len(position))})
+    out.sort(key=lambda c: c["position"])
+    return {"book_id": book_id, "version": _book_version(book_id), "chapters": out}
+
+class ChapterOrderIn(BaseModel):
+    order: List[str]                   # IDs na ordem narrativa; os que faltarem vão para o fim
+
+class ChapterMoveIn(BaseModel):
+    chapter_id: str
+    position: int                      # 0 = primeiro capítulo
+
+def _order_response(book_id: str, order: List[str]) -> Dict:
+    titles = {ch["id"]: ch["title"] for ch in STORAGE.list_chapters(book_id)}
+    return {"book_id": book_id, "version": chapter_order.version(book_id),
+            "chapters": [{"position": i, "id": cid, "title": titles.get(cid, cid)} for i, cid in enumerate(order)]}
+
+@app.get("/books/{book_id}/order")
+def get_chapter_order(book_id: str):
+    """Ordem narrativa dos capítulos (usada pelo contexto 'previous', arcos e auditoria)."""
+    return _order_response(book_id, _list_chapter_ids(book_id))
+
+def _after_reorder(book_id: str, background_tasks: BackgroundTasks):
+    # arcos agrupam capítulos vizinhos: mudou a ordem, mudam os arcos
+    background_tasks.add_task(_refresh_summary_tree_safe, book_id)
+    background_tasks.add_task(_warm_previous_window, book_id)
+
+@app.put("/books/{book_id}/order")
+def put_chapter_order(book_id: str, payload: ChapterOrderIn, background_tasks: BackgroundTasks):
+    try:
+        order = chapter_order.set_order(book_id, payload.order, _chapter_mtimes(book_id))
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Capítulo(s) não encontrado(s): {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _after_reorder(book_id, background_tasks)
+    return _order_response(book_id, order)
+
+@app.post("/books/{book_id}/order/move")
+def move_chapter(book_id: str, payload: ChapterMoveIn, background_tasks: BackgroundTasks):
+    try:
+        order = chapter_order.move(book_id, payload.chapter_id, payload.position, _chapter_mtimes(book_id))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Capítulo não encontrado")
+    _after_reorder(book_id, background_tasks)
+    return _order_response(book_id, order)
+
+# Histórico de revisões: registrado antes de /chapter/{book_id}/{chapter_id}, que também casaria com
+# /chapter/{chapter_id}/history
+@app.get("/chapter/{chapter_id}/history")
+def chapter_history(chapter_id: str, book_id: str):
+    """Revisões do capítulo, da mais recente para a mais antiga (sem o texto)."""
+    revisions = HISTORY.list(book_id, chapter_id)
+    if not revisions and not STORAGE.locate_chapter(book_id, chapter_id):
+        raise HTTPException(status_code=404, detail="Capítulo não encontrado")
+    for r in revisions:
+        r["saved_at"] = datetime.fromtimestamp(r.pop("ts")).isoformat(timespec="seconds")
+    return {
+        "book_id": book_id,
+        "chapter_id": chapter_id,
+        "count": len(revisions),
+        "chars": sum(r["chars"] for r in revisions),
+        "stored_bytes": sum(r["stored_bytes"] for r in revisions),
+        "revisions": revisions,
+    }
+
+@app.get("/chapter/{chapter_id}/revision/{n}")
+def chapter_revision(chapter_id: str, n: int, book_id: str, diff: bool = False):
+    """Texto da revisão n; diff=true inclui o diff (unificado) contra a revisão anterior."""
+    rev = HISTORY.get(book_id, chapter_id, n)
+    if not rev:
+        raise HTTPException(status_code=404, detail=f"Revisão {n} não encontrada")
+    rev["saved_at"] = datetime.fromtimestamp(rev.pop("ts")).isoformat(timespec="seconds")
+    out = {"book_id": book_id, "chapter_id": chapter_id, **rev, "latest": n == HISTORY.latest(book_id, chapter_id)}
+    if diff:
+        prev = HISTORY.get(book_id, chapter_id, n - 1) if n > 1 else None
+        before = f"# {prev['title']}\n\n{prev['text']}".splitlines() if prev else []
+        after = f"# {rev['title']}\n\n{rev['text']}".splitlines()
+        out["diff"] = "\n".join(difflib.unified_diff(before, after, f"revisão {n - 1}", f"revisão {n}", lineterm=""))
+    return out
+
+@app.post("/chapter/{chapter_id}/revision/{n}/restore", dependencies=[Depends(track_usage)])
+def restore_chapter_revision(chapter_id: str, n: int, book_id: str, background_tasks: BackgroundTasks):
+    """Volta o capítulo para a revisão n (gravada como uma revisão nova: o histórico não é reescrito)."""
+    rev = HISTORY.get(book_id, chapter_id, n)
+    if not rev:
+        raise HTTPException(status_code=404, detail=f"Revisão {n} não encontrada")
+    payload = ChapterUpdateIn(book_id=book_id, chapter_id=chapter_id, title=rev["title"], text=rev["text"])
+    return {**_update_chapter(payload, background_tasks, source="restore"), "restored_from": n}
+
+@app.get("/chapter/{book_id}/{chapter_id}")
+def get_chapter(book_id: str, chapter_id: str):
+    ch = read_chapter(book_id, chapter_id)
+    return {"book_id": book_id, "id": chapter_id, "title": ch["title"], "content": ch["text"],
+            "file_path": ch["path"], "size": len(ch["text"])}
+
+@app.get("/storage/status")
+def storage_status():
+    """Layout de armazenamento: livros e se ainda há arquivos no layout plano (pré-migração)."""
+    books = STORAGE.list_books()
+    return {
+        "engine": STORAGE_ENGINE,
+        "root": STORAGE.root,
+        "legacy_present": STORAGE.legacy_present,
+        "books": {b: STORAGE.counts(b) for b in books},
+    }
+
+def _ensure_search_index(book_id: str):
+    """Livros salvos antes do índice existir são indexados na primeira busca."""
+    if not SEARCH_INDEX.is_indexed(book_id):
+        n = SEARCH_INDEX.rebuild_book(book_id, STORAGE.list_chapters(book_id, with_text=True))
+        print(f"[OK] Índice de busca criado para {book_id}: {n} capítulo(s)")
+
+@app.get("/search/{book_id}")
+def search_book(book_id: str, q: str, page: int = 1, page_size: int = 20, offsets: bool = False):
+    """
+    Busca textual nos capítulos do livro (sem LLM).
+    Sem acento/maiúsculas; "frase exata" entre aspas; prefixo com * (farol*).
+    offsets=true inclui as posições de cada ocorrência no texto do capítulo (lê o capítulo inteiro).
+    """
+    if page < 1 or not (1 <= page_size <= 100):
+        raise HTTPException(status_code=400, detail="page >= 1 e page_size entre 1 e 100")
+    try:
+        if not SEARCH_IN_STORAGE:
+            _ensure_search_index(book_id)
+        t0 = time.perf_counter()
+        if SEARCH_IN_STORAGE:
+            out = STORAGE.search_chapters(book_id, q, page=page, page_size=page_size, with_offsets=offsets)
+        else:
+            out = SEARCH_INDEX.search(book_id, q, page=page, page_size=page_size, with_offsets=offsets)
+    except SearchUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Consulta inválida: {e}")
+    return {"book_id": book_id, "query": q, **out, "took_ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+@app.post("/search/{book_id}/reindex")
+def reindex_search(book_id: str):
+    """Refaz o índice de busca do livro a partir do armazenamento."""
+    if SEARCH_IN_STORAGE:
+        # documents_fts acompanha o storage.db por triggers: não há o que refazer
+        return {"book_id": book_id, "indexed": len(STORAGE.list_chapter_ids(book_id))}
+    try:
+        n = SEARCH_INDEX.rebuild_book(book_id, STORAGE.list_chapters(book_id, with_text=True))
+    except SearchUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"book_id": book_id, "indexed": n}
+
+class EntityMergeIn(BaseModel):
+    names: List[str]                 # nomes/apelidos a fundir
+    into: Optional[str] = None       # nome canônico (padrão: o primeiro)
+
+@app.get("/entities/{book_id}")
+def list_entities(book_id: str, type: Optional[str] = None, q: Optional[str] = None):
+    """Personagens/locais do livro com apelidos e nº de capítulos (índice montado nos saves, sem LLM)."""
+    index = entity_index.load(book_id)
+    qn = entity_index.norm(q) if q else None
+    out = []
+    for key, ent in index["entities"].items():
+        if type and ent["type"] != type:
+            continue
+        if qn and not any(qn in entity_index.norm(n) for n in [ent["name"], *ent["aliases"]]):
+            continue
+        out.append({"key": key, "name": ent["name"], "type": ent["type"], "aliases": ent["aliases"],
+                    "role": ent.get("role", ""), "chapter_count": len(ent["chapters"])})
+    out.sort(key=lambda e: (-e["chapter_count"], e["name"]))
+    return {"book_id": book_id, "version": index.get("version", 0), "entities": out}
+
+@app.get("/entities/{book_id}/{name}/chapters")
+def entity_chapters(book_id: str, name: str, include_text: bool = False):
+    """Capítulos em que a entidade aparece (aceita nome ou apelido), na ordem do livro."""
+    ent = entity_index.chapters_for(book_id, name)
+    if not ent:
+        raise HTTPException(status_code=404, detail=f"Entidade não encontrada: {name}")
+    order = {cid: i for i, cid in enumerate(_list_chapter_ids(book_id))}
+    chapters = []
+    for cid in sorted(ent["chapters"], key=lambda c: order.get(c, len(order))):
+        item = {"chapter_id": cid, "title": ent["chapters"][cid]}
+        if include_text:
+            ch = STORAGE.read_chapter(book_id, cid)
+            item["text"] = ch["text"] if ch else None
+        chapters.append(item)
+    return {
+        "book_id": book_id,
+        "name": ent["name"],
+        "type": ent["type"],
+        "aliases": ent["aliases"],
+        "relationships": ent["relationships"],
+        "chapters": chapters,
+    }
+
+@app.post("/entities/{book_id}/merge")
+def merge_entities(book_id: str, payload: EntityMergeIn):
+    """Funde apelidos que o índice não reconheceu sozinho (ex.: "O Capitão" e "Rui Prado")."""
+    if len(payload.names) < 2:
+        raise HTTPException(status_code=400, detail="Informe ao menos dois nomes")
+    try:
+        ent = entity_index.merge(book_id, payload.names, payload.into)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Entidade não encontrada: {e.args[0]}")
+    return {"book_id": book_id, "entity": ent}
+
+@app.post("/entities/{book_id}/rebuild")
+def rebuild_entities(book_id: str):
+    """Reconstrói o índice a partir dos personagens já guardados na árvore de resumos (sem chamar o LLM)."""
+    tree = load_summary_tree(book_id)
+    n = 0
+    for cid, leaf in tree.get("chapters", {}).items():
+        if leaf.get("characters"):
+            entity_index.set_chapter(book_id, cid, leaf.get("title", ""), {"personagens": leaf["characters"]},
+                                     types={"character"})
+            n += 1
+    return {"book_id": book_id, "chapters_indexed": n, "entities": len(entity_index.load(book_id)["entities"])}
+
+@app.get("/vectors/{book_id}")
+def vector_index_stats(book_id: str, sync: bool = False):
+    """Estado do índice vetorial local do livro (linhas, lápides, listas IVF)."""
+    if sync:
+        if not _get_embed_model():
+            raise HTTPException(status_code=503, detail="Modelo de embeddings indisponível")
+        _sync_vector_index(book_id)
+    return vector_index.get_index(book_id).stats()
+
+@app.post("/vectors/{book_id}/compact")
+def compact_vector_index(book_id: str):
+    """Remove as lápides do arquivo de vetores (também ocorre sozinho acima de VECTOR_COMPACT_RATIO)."""
+    removed = vector_index.get_index(book_id).compact()
+    return {"removed_rows": removed, **vector_index.get_index(book_id).stats()}
+
+@app.post("/vectors/{book_id}/rebuild")
+def rebuild_vector_index(book_id: str):
+    """Apaga e refaz o índice vetorial do livro (ex.: depois de trocar o modelo de embeddings)."""
+    if not _get_embed_model():
+        raise HTTPException(status_code=503, detail="Modelo de embeddings indisponível")
+    vector_index.drop_index(book_id)
+    return _sync_vector_index(book_id).stats()
+
+@app.get("/packs/{book_id}")
+def list_context_packs(book_id: str):
+    """Pacotes de contexto do livro (na ordem dos capítulos): tokens estimados, trechos, se já têm resumo."""
+    packs = _context_packs(book_id, _list_chapter_ids(book_id))
+    items = [{"chapter_id": cid, "title": p["title"], "tokens": p["tokens"], "chunks": len(p["chunks"]),
+              "has_summary": bool(p["summary"]), "entities": p["entities"], "updated_at": p["updated_at"]}
+             for cid, p in packs.items()]
+    return {"book_id": book_id, "count": len(items), "tokens": sum(i["tokens"] for i in items), "packs": items}
+
+@app.post("/packs/{book_id}/rebuild")
+def rebuild_context_packs(book_id: str):
+    """Refaz os pacotes do livro (ex.: depois de mudar VECTOR_CHUNK_CHARS/VECTOR_CHUNK_OVERLAP)."""
+    context_packs.drop_book(book_id)
+    return list_context_packs(book_id)
+
+RETRIEVE_BATCH_MAX_QUERIES = int(os.getenv("RETRIEVE_BATCH_MAX_QUERIES", "256"))
+
+class RetrieveBatchIn(BaseModel):
+    book_id: str
+    queries: List[str]
+    k: int = 8
+    per_chapter: bool = True         # False: trechos soltos (vários do mesmo capítulo)
+    include_text: bool = False       # devolve o texto de cada trecho
+
+@app.post("/retrieve/batch")
+def retrieve_batch(payload: RetrieveBatchIn):
+    """Top-K de várias consultas num livro: um único encode em lote e um único produto de matrizes."""
+    if not payload.queries:
+        raise HTTPException(status_code=400, detail="Informe ao menos uma consulta")
+    if len(payload.queries) > RETRIEVE_BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"Máximo de {RETRIEVE_BATCH_MAX_QUERIES} consultas por chamada")
+    if not _get_embed_model():
+        raise HTTPException(status_code=503, detail="Modelo de embeddings indisponível")
+    t0 = time.time()
+    idx = _sync_vector_index(payload.book_id)
+    qvs = _embed_texts(payload.queries)
+    batches = idx.search_batch(qvs, k=max(1, payload.k), per_chapter=payload.per_chapter)
+
+    texts = {}
+    results = []
+    for query, hits in zip(payload.queries, batches):
+        for h in hits:
+            if payload.include_text:
+                if h["chapter_id"] not in texts:
+                    ch = STORAGE.read_chapter(payload.book_id, h["chapter_id"])
+                    texts[h["chapter_id"]] = ch["text"] if ch else ""
+                h["text"] = texts[h["chapter_id"]][h["span"][0]:h["span"][1]]
+        results.append({"query": query, "hits": hits})
+    return {"book_id": payload.book_id, "k": payload.k, "elapsed_ms": round((time.time() - t0) * 1000, 1),
+            "results": results}
+
+@app.get("/artifacts/{book_id}")
+def list_artifacts(book_id: str, kind: str = "suggestion", chapter_id: Optional[str] = None,
+                   q: Optional[str] = None, limit: int = 20):
+    """Sugestões/críticas salvas de um livro (mais recentes primeiro), por capítulo ou por texto."""
+    if kind not in ("suggestion", "critique"):
+        raise HTTPException(status_code=400, detail="kind deve ser 'suggestion' ou 'critique'")
+    if q:
+        return {"book_id": book_id, "kind": kind, "results": STORAGE.search(book_id, q, kinds=[kind], limit=limit)}
+    items = STORAGE.list_artifacts(book_id, kind, chapter_id=chapter_id, limit=limit)
+    return {"book_id": book_id, "kind": kind, "results": items}
+
+@app.post("/storage/migrate")
+def storage_migrate(dry_run: bool = False):
+    """
+    Move os arquivos `book__cap.md`, `sugest_*` e `critica_*` da raiz para um diretório por livro.
+    Roda com a API no ar: cada arquivo é movido com os.replace e a leitura cai no layout antigo enquanto isso.
+    """
+    report = STORAGE.migrate(dry_run=dry_run)
+    print(f"[OK] Migração de armazenamento: {report['moved']} arquivo(s), dry_run={dry_run}")
+    return report
 
 @app.get("/chroma/status")
 async def chroma_status_endpoint():
@@ -674,66 +2416,51 @@ async def clear_chromadb():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/chroma/vectorize-existing")
-async def vectorize_existing_chapters():
+@app.post("/chroma/vectorize-existing", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
+def vectorize_existing_chapters():
     """
-    Vetoriza apenas arquivos padrão `book_id__chapter_id.md`.
-    Ignora `sugest_*` e `critica_*`.
+    Vetoriza todos os capítulos de todos os livros (layout por livro e plano).
+    Sugestões e críticas não entram.
     """
     try:
         if not CHROMA_AVAILABLE:
             raise HTTPException(status_code=503, detail="ChromaDB não disponível")
 
-        chapters_dir = "/data/chapters"
-        if not os.path.exists(chapters_dir):
-            raise HTTPException(status_code=404, detail="Diretório de capítulos não encontrado")
-
-        import glob
-        all_files = glob.glob(f"{chapters_dir}/*.md")
-        total = len(all_files)
+        all_chapters = [(book_id, ch) for book_id in STORAGE.list_books()
+                        for ch in STORAGE.list_chapters(book_id, with_text=True)]
+        total = len(all_chapters)
         vectorized_count = 0
         errors = []
+        touched_books = set()
 
-        pat = re.compile(r"^(.+?)__([^.]+)\.md$", re.IGNORECASE)
-
-        for file_path in all_files:
+        caller = _usage_now()
+        for book_id, ch in all_chapters:
+            file_path, chapter_id = ch["path"], ch["id"]
             fn = os.path.basename(file_path)
-
-            # Ignora sugestões/críticas
-            if fn.startswith(("sugest_", "critica_")):
-                continue
-
-            m = pat.match(fn)
-            if not m:
-                # nome fora do padrão → ignora
-                continue
-
-            book_id, chapter_id = m.group(1), m.group(2)
+            _usage_ctx.set(UsageContext(book_id, caller.user, caller.endpoint))   # tokens na conta de cada livro
 
             try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-
-                lines = content.splitlines()
-                title = "Capítulo"
-                if lines and lines[0].startswith("# "):
-                    title = lines[0][2:].strip()
-                    text = "\n".join(lines[1:]).lstrip()
-                else:
-                    text = content
+                title, text = ch["title"], ch["text"]
 
                 # metadados mínimos (ou use extract_metadata_from_chapter se preferir)
                 summary = summarize_chapter(title, text)
 
                 chroma_ok = upsert_to_chroma(book_id, chapter_id, title, text, summary)
+                index_chapter_summary(book_id, chapter_id, title, summary)
+                touched_books.add(book_id)
                 if chroma_ok:
                     vectorized_count += 1
                 else:
                     errors.append(f"Falha ao vetorizar {book_id}:{chapter_id}")
 
+            except RequestCancelled:
+                raise
             except Exception as e:
                 errors.append(f"Erro ao processar {fn}: {e}")
 
+        for book_id in touched_books:
+            _refresh_summary_tree_safe(book_id)
+
         return {
             "success": True,
             "message": "Vetorização concluída.",
@@ -743,35 +2470,24 @@ async def vectorize_existing_chapters():
         }
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
 
-@app.post("/debug/metadata-extraction")
-async def debug_metadata_extraction(book_id: str, chapter_id: str):
+@app.post("/debug/metadata-extraction", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
+def debug_metadata_extraction(book_id: str, chapter_id: str):
     """Debug da extração de metadados para um capítulo específico"""
     try:
         # Lê o capítulo
-        chapter_path = os.path.join("/data/chapters", f"{book_id}__{chapter_id}.md")
-        if not os.path.exists(chapter_path):
-            raise HTTPException(status_code=404, detail="Capítulo não encontrado")
-        
-        with open(chapter_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        # Extrai título e texto
-        lines = content.splitlines()
-        title = "Capítulo"
-        if lines and lines[0].startswith("# "):
-            title = lines[0][2:].strip()
-            text = "\n".join(lines[1:]).lstrip()
-        else:
-            text = content
+        ch = read_chapter(book_id, chapter_id)
+        title, text = ch["title"], ch["text"]
         
         # Tenta extrair metadados
         try:
             metadata = extract_metadata_from_chapter(book_id, title, text)
             metadata_dict = metadata.dict()
             extraction_success = True
+        except RequestCancelled:
+            raise
         except Exception as e:
             metadata_dict = {"error": str(e)}
             extraction_success = False
@@ -784,13 +2500,13 @@ async def debug_metadata_extraction(book_id: str, chapter_id: str):
             "text_preview": text[:500] + "..." if len(text) > 500 else text,
             "extraction_success": extraction_success,
             "metadata": metadata_dict,
-            "raw_content_length": len(content)
+            "raw_content_length": len(text)
         }
         
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
-@app.post("/test-llm")
+@app.post("/test-llm", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
 def test_llm():
     """Endpoint de teste para verificar se o LLM está funcionando"""
     try:
@@ -803,7 +2519,7 @@ def test_llm():
             "content": "Olá, como você está? Responda em português brasileiro."
         }
         
-        response = openai_chat([sys, user], temperature=0.7, max_tokens=100)
+        response = openai_chat([sys, user], temperature=0.7, max_tokens=100, op="test")
         
         return {
             "success": True,
@@ -817,8 +2533,8 @@ def test_llm():
             "message": "Erro ao testar LLM"
         }
 
-@app.post("/chapter/save")
-async def save_chapter_endpoint(chapter: ChapterIn):
+@app.post("/chapter/save", dependencies=[Depends(track_usage)])
+async def save_chapter_endpoint(chapter: ChapterIn, background_tasks: BackgroundTasks):
     """Salva um capítulo e extrai metadados"""
     try:
         # Gera ID único se não fornecido
@@ -826,13 +2542,20 @@ async def save_chapter_endpoint(chapter: ChapterIn):
             chapter.chapter_id = str(uuid.uuid4())
         
         # Salva o capítulo
-        save_chapter(chapter.book_id, chapter.chapter_id, chapter.title, chapter.text)
+        save_chapter(chapter.book_id, chapter.chapter_id, chapter.title, chapter.text, position=chapter.position)
         
-        # Extrai metadados
-        metadata = extract_metadata_from_chapter(chapter.book_id, chapter.title, chapter.text)
+        # Extrai metadados (None se o LLM não devolveu JSON válido)
+        extracted = try_extract_metadata(chapter.book_id, chapter.title, chapter.text)
+        metadata = extracted or _placeholder_metadata(chapter.book_id)
+        summary = extracted.dict() if extracted else None
         
         # Salva no ChromaDB usando a nova função upsert
-        chroma_ok = upsert_to_chroma(chapter.book_id, chapter.chapter_id, chapter.title, chapter.text, metadata.dict())
+        chroma_ok = upsert_to_chroma(chapter.book_id, chapter.chapter_id, chapter.title, chapter.text, summary)
+
+        # Árvore de resumos (folha agora, arcos/sinopse em background) + índice de entidades
+        index_chapter_summary(chapter.book_id, chapter.chapter_id, chapter.title, summary)
+        background_tasks.add_task(_refresh_summary_tree_safe, chapter.book_id)
+        background_tasks.add_task(_warm_previous_window, chapter.book_id)
         
         if chroma_ok:
             print(f"[INFO] Capítulo salvo no ChromaDB: {chapter.book_id}:{chapter.chapter_id}")
@@ -843,15 +2566,20 @@ async def save_chapter_endpoint(chapter: ChapterIn):
             "success": True,
             "chapter_id": chapter.chapter_id,
             "metadata": metadata.dict(),
+            "metadata_extracted": extracted is not None,
             "message": "Capítulo salvo com sucesso e metadados extraídos"
         }
         
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
-@app.put("/chapter/update")
-async def chapter_update(payload: ChapterUpdateIn):
+@app.put("/chapter/update", dependencies=[Depends(track_usage)])
+async def chapter_update(payload: ChapterUpdateIn, background_tasks: BackgroundTasks):
     """Atualiza (sobrescreve) um capítulo existente, reescrevendo o mesmo arquivo e fazendo upsert no Chroma."""
+    return _update_chapter(payload, background_tasks, source="update")
+
+def _update_chapter(payload: ChapterUpdateIn, background_tasks: BackgroundTasks, source: str) -> Dict:
+    """Regrava o capítulo (nova revisão no histórico) e refaz resumo, Chroma e árvore de resumos."""
     try:
         # Lê o capítulo atual para manter campos não enviados
         current = read_chapter(payload.book_id, payload.chapter_id)
@@ -859,29 +2587,117 @@ async def chapter_update(payload: ChapterUpdateIn):
         new_text  = payload.text  if payload.text  is not None else current["text"]
 
         # Regrava o arquivo
-        path = _chapter_path(payload.book_id, payload.chapter_id)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(f"# {new_title}\n\n{new_text}\n")
+        path = save_chapter(payload.book_id, payload.chapter_id, new_title, new_text, source=source)
 
-        # Regera resumo/metadados
-        summary = summarize_chapter(new_title, new_text)
+        # Regera resumo/metadados (arquivo já foi salvo: LLM fora do ar só adia a indexação do resumo)
+        try:
+            summary = summarize_chapter(new_title, new_text)
+        except (LLMUnavailableError, LLMTimeoutError, QuotaExceededError) as e:
+            print(f"[WARN] Resumo adiado para {payload.book_id}:{payload.chapter_id}: {e}")
+            summary = None
 
         # Upsert no Chroma
         chroma_ok = upsert_to_chroma(payload.book_id, payload.chapter_id, new_title, new_text, summary)
 
+        # Árvore de resumos: só o arco deste capítulo (e a sinopse) são regerados; entidades do capítulo idem
+        index_chapter_summary(payload.book_id, payload.chapter_id, new_title, summary)
+        background_tasks.add_task(_refresh_summary_tree_safe, payload.book_id)
+        background_tasks.add_task(_warm_previous_window, payload.book_id)
+
         return {
             "chapter_id": payload.chapter_id,
+            "revision": HISTORY.latest(payload.book_id, payload.chapter_id),
             "saved_path": path,
-            "summary": summary if isinstance(summary, dict) else str(summary),
+            "summary": summary if isinstance(summary, dict) or summary is None else str(summary),
             "chroma_saved": chroma_ok,
             "message": "Capítulo atualizado com sucesso"
         }
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
-@app.post("/metadata/extract")
+@app.post("/chapters/summarize-batch", dependencies=[Depends(track_usage)])
+def summarize_batch(payload: SummarizeBatchIn):
+    """
+    Resume vários capítulos (ou o livro inteiro) em paralelo, aproveitando o batching contínuo do vLLM.
+    Devolve NDJSON: uma linha por capítulo assim que ele termina e uma linha final com o total.
+    """
+    chapter_ids = payload.chapter_ids or _list_chapter_ids(payload.book_id)
+    if not chapter_ids:
+        raise HTTPException(status_code=404, detail="Nenhum capítulo encontrado para este livro")
+    in_flight = max(1, min(payload.max_in_flight or SUMMARY_MAX_IN_FLIGHT, SUMMARY_MAX_IN_FLIGHT))
+
+    def stream():
+        t0 = time.time()
+        done, failed = 0, 0
+        pool = ThreadPoolExecutor(max_workers=in_flight)
+        try:
+            # cada thread leva uma cópia do contexto (atribuição de tokens ao livro/usuário)
+            futures = {pool.submit(contextvars.copy_context().run, _summarize_and_index, payload.book_id, cid): cid
+                       for cid in chapter_ids}
+            for fut in as_completed(futures):
+                cid = futures[fut]
+                try:
+                    res = fut.result()
+                    done += 1
+                    line = {"chapter_id": cid, "success": True, **res}
+                except HTTPException as e:
+                    failed += 1
+                    line = {"chapter_id": cid, "success": False, "error": e.detail}
+                except Exception as e:
+                    failed += 1
+                    line = {"chapter_id": cid, "success": False, "error": str(e)}
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+            if done:
+                _refresh_summary_tree_safe(payload.book_id)
+            yield json.dumps({
+                "done": True,
+                "book_id": payload.book_id,
+                "total": len(chapter_ids),
+                "summarized": done,
+                "failed": failed,
+                "max_in_flight": in_flight,
+                "elapsed_s": round(time.time() - t0, 2),
+            }, ensure_ascii=False) + "\n"
+        finally:
+            # cliente desconectou no meio → não dispara os resumos que ainda não começaram
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/summary-tree/{book_id}")
+def get_summary_tree(book_id: str):
+    """Árvore de resumos persistida do livro (capítulos → arcos → sinopse)"""
+    tree = load_summary_tree(book_id)
+    return {
+        "book_id": book_id,
+        "version": tree.get("version", 0),
+        "updated_at": tree.get("updated_at"),
+        "chapters_count": len(tree.get("chapters", {})),
+        "synopsis": (tree.get("synopsis") or {}).get("text"),
+        "arcs": [
+            {"index": a["index"], "chapter_ids": a["chapter_ids"], "summary": a["summary"]}
+            for a in tree.get("arcs", [])
+        ],
+    }
+
+@app.post("/summary-tree/{book_id}/rebuild", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
+def rebuild_summary_tree(book_id: str, force: bool = False):
+    """Refaz arcos/sinopse desatualizados (ou todos, com force=true)"""
+    try:
+        tree = refresh_summary_tree(book_id, force=force)
+        return {
+            "success": True,
+            "book_id": book_id,
+            "version": tree.get("version", 0),
+            "arcs": len(tree.get("arcs", [])),
+            "has_synopsis": bool(tree.get("synopsis")),
+        }
+    except Exception as e:
+        raise _as_http_error(e)
+
+@app.post("/metadata/extract", dependencies=[Depends(track_usage)])
 async def extract_metadata_endpoint(request: MetadataExtractionIn):
     """Extrai metadados de um capítulo específico"""
     try:
@@ -898,7 +2714,7 @@ async def extract_metadata_endpoint(request: MetadataExtractionIn):
         }
         
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
 @app.get("/metadata/book/{book_id}")
 async def get_book_metadata(book_id: str):
@@ -950,76 +2766,145 @@ async def get_book_metadata(book_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/suggest")
+def _ndjson_stream(chunks: LLMStream, on_done):
+    """NDJSON para a UI: {"delta": "..."} a cada trecho e, no fim, {"done": true, ...on_done(texto)}."""
+    parts = []
+    try:
+        for delta in chunks:
+            parts.append(delta)
+            yield json.dumps({"delta": delta}, ensure_ascii=False) + "\n"
+        if chunks.aborted:
+            return
+        yield json.dumps({"done": True, **on_done("".join(parts))}, ensure_ascii=False) + "\n"
+    except Exception as e:
+        if not chunks.aborted:
+            yield json.dumps({"error": str(getattr(e, "detail", e))}, ensure_ascii=False) + "\n"
+    finally:
+        chunks.close()
+
+def _stream_response(chunks: LLMStream, on_done) -> StreamingResponse:
+    """
+    Resposta NDJSON. Se o cliente desconectar (aba fechada, "Cancelar" na UI), o vLLM é abortado
+    na hora e on_done não roda — nada é salvo para ninguém.
+    """
+    lines = _ndjson_stream(chunks, on_done)
+
+    async def body():
+        try:
+            async for line in iterate_in_threadpool(lines):
+                yield line
+        finally:
+            # o gerador pode ter ficado parado entre dois trechos: fecha aqui (devolve o backend ao pool)
+            chunks.close()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def _length_range(length: Optional[str]):
+    """'500-800 palavras' → (500, 800); '800 palavras' → (640, 960); sem números → None."""
+    nums = [int(x) for x in re.findall(r"\d+", length or "")]
+    if len(nums) >= 2:
+        return min(nums[:2]), max(nums[:2])
+    if nums:
+        return int(nums[0] * 0.8), int(nums[0] * 1.2)
+    return None
+
+def _score_candidate(text: str, length: Optional[str] = None) -> Dict:
+    """Nota barata (0-1), sem LLM: aderência ao tamanho pedido e pouca repetição de trigramas."""
+    words = re.findall(r"\w+", text.lower())
+    trigrams = list(zip(words, words[1:], words[2:]))
+    parts = {"repetition_score": round(len(set(trigrams)) / len(trigrams), 3) if trigrams else 1.0}
+    rng = _length_range(length)
+    if rng:
+        lo, hi = rng
+        miss = lo - len(words) if len(words) < lo else max(0, len(words) - hi)
+        parts["length_score"] = round(max(0.0, 1 - miss / max(lo, 1)), 3)
+    return {"words": len(words), "score": round(sum(parts.values()) / len(parts), 3), **parts}
+
+def _generate_candidates(messages: List[Dict], n: int, best_of: Optional[int], op: str,
+                         length: Optional[str] = None, **kw) -> List[Dict]:
+    """n alternativas numa só chamada (n/best_of do vLLM), ordenadas pela nota."""
+    n = max(1, min(n, GENERATION_MAX_CANDIDATES))
+    if best_of:
+        best_of = min(best_of, GENERATION_MAX_CANDIDATES * 2)
+    texts = openai_chat(messages, op=op, n=n, best_of=best_of, **kw)
+    if n == 1:
+        texts = [texts]
+    ranked = [{"text": t, **_score_candidate(t, length)} for t in texts]
+    return sorted(ranked, key=lambda c: -c["score"])
+
+@app.post("/suggest", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
 def suggest_next(payload: SuggestionIn):
     """Sugere próximos passos baseado no capítulo atual"""
-    print(f"[DEBUG] /suggest chamado com payload: {payload}")
     try:
-        sys = {
-            "role": "system",
-            "content": (
-                "Você é um co-roteirista experiente. Analise o capítulo atual e sugira "
-                "3-5 próximos passos narrativos coerentes. Seja criativo mas mantenha "
-                "a continuidade da história. Responda em português brasileiro."
-            ),
-        }
-        user = {
-            "role": "user",
-            "content": f"Título: {payload.current_chapter_title}\n\nTexto: {payload.current_chapter_text}",
-        }
-        
-        print(f"[DEBUG] Chamando openai_chat com mensagens: {[sys, user]}")
-        suggestions = openai_chat([sys, user], temperature=0.7, max_tokens=2000)
-        print(f"[DEBUG] openai_chat retornou: {suggestions[:100]}...")
-        
-        # Salva as sugestões automaticamente
-        chapter_id = str(uuid.uuid4())
-        suggestions_path = save_suggestions(payload.book_id, chapter_id, payload.current_chapter_title, suggestions)
-        print(f"[INFO] Sugestões salvas em: {suggestions_path}")
+        context = ""
+        if payload.use_memory != "none":
+            context = _build_context(payload.book_id, payload.use_memory, payload.k, False, None, None,
+                                     query=f"{payload.current_chapter_title}\n{payload.current_chapter_text[:1000]}",
+                                     before_chapter_id=payload.chapter_id, previous_n=payload.previous_n)
+        messages = build_messages(
+            payload.book_id,
+            "Como co-roteirista experiente, analise o capítulo atual e sugira 3-5 próximos passos "
+            "narrativos coerentes. Seja criativo mas mantenha a continuidade da história.",
+            (f"## CONTEXTO (Memória)\n{context}\n\n" if context else "")
+            + f"Título: {payload.current_chapter_title}\n\nTexto: {payload.current_chapter_text}",
+        )
         
-        return {
-            "suggestions": suggestions,
-            "book_id": payload.book_id,
-            "chapter_title": payload.current_chapter_title,
-            "suggestions_file": os.path.basename(suggestions_path),
-            "message": "Sugestões geradas e salvas com sucesso"
-        }
+        def finish(suggestions: str, candidates: Optional[List[Dict]] = None) -> Dict:
+            # Salva as sugestões automaticamente
+            chapter_id = str(uuid.uuid4())
+            suggestions_path = save_suggestions(payload.book_id, chapter_id, payload.current_chapter_title,
+                                                suggestions, source_chapter_id=payload.chapter_id)
+            print(f"[INFO] Sugestões salvas em: {suggestions_path}")
+            return {
+                "suggestions": suggestions,
+                "book_id": payload.book_id,
+                "chapter_title": payload.current_chapter_title,
+                "suggestions_file": os.path.basename(suggestions_path),
+                "candidates": candidates if candidates and len(candidates) > 1 else None,
+                "message": "Sugestões geradas e salvas com sucesso"
+            }
+
+        if payload.stream:
+            chunks = openai_chat_stream(messages, temperature=0.7, max_tokens=2000, op="suggest")
+            return _stream_response(chunks, finish)
+
+        candidates = _generate_candidates(messages, payload.n, payload.best_of, op="suggest",
+                                          temperature=0.7, max_tokens=2000)
+        return finish(candidates[0]["text"], candidates)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
-@app.post("/critique")
+@app.post("/critique", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
 def critique_chapter(payload: CritiqueIn):
     """Faz crítica de coerência do capítulo"""
     try:
-        sys = {
-            "role": "system",
-            "content": (
-                "Você é um editor literário experiente. Analise o capítulo atual e "
-                "identifique possíveis problemas de coerência, continuidade ou lógica. "
-                "Seja construtivo e sugira melhorias. Responda em português brasileiro."
-            ),
-        }
-        user = {
-            "role": "user",
-            "content": f"Título: {payload.current_chapter_title}\n\nTexto: {payload.current_chapter_text}",
-        }
-        
-        critique = openai_chat([sys, user], temperature=0.3, max_tokens=2000)
-        
-        # Salva a crítica automaticamente
-        chapter_id = str(uuid.uuid4())
-        critique_path = save_critique(payload.book_id, chapter_id, payload.current_chapter_title, critique)
-        print(f"[INFO] Crítica salva em: {critique_path}")
+        messages = build_messages(
+            payload.book_id,
+            "Como editor literário experiente, analise o capítulo atual e identifique possíveis "
+            "problemas de coerência, continuidade ou lógica. Seja construtivo e sugira melhorias.",
+            f"Título: {payload.current_chapter_title}\n\nTexto: {payload.current_chapter_text}",
+        )
         
-        return {
-            "critique": critique,
-            "book_id": payload.book_id,
-            "chapter_title": payload.current_chapter_title,
-            "critique_file": os.path.basename(critique_path),
-            "message": "Crítica gerada e salva com sucesso"
-        }
+        def finish(critique: str) -> Dict:
+            # Salva a crítica automaticamente
+            chapter_id = str(uuid.uuid4())
+            critique_path = save_critique(payload.book_id, chapter_id, payload.current_chapter_title, critique,
+                                          source_chapter_id=payload.chapter_id)
+            print(f"[INFO] Crítica salva em: {critique_path}")
+            return {
+                "critique": critique,
+                "book_id": payload.book_id,
+                "chapter_title": payload.current_chapter_title,
+                "critique_file": os.path.basename(critique_path),
+                "message": "Crítica gerada e salva com sucesso"
+            }
+
+        if payload.stream:
+            chunks = openai_chat_stream(messages, temperature=0.3, max_tokens=2000, op="critique")
+            return _stream_response(chunks, finish)
+        return finish(openai_chat(messages, temperature=0.3, max_tokens=2000, op="critique"))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _as_http_error(e)
 
 # ========================
 # ====== NOVOS RECURSOS: Perguntar / Idear / Expandir ======
@@ -1039,22 +2924,79 @@ def _get_embed_model():
     return _embed_model
 
 def _read_chapters_fs(book_id: str):
-    """Lê capítulos do FS /data/chapters/<book_id>__*.md"""
-    base = "/data/chapters"
-    files = sorted(glob.glob(os.path.join(base, f"{book_id}__*.md")))
+    """Lê capítulos do armazenamento (diretório do livro ou SQLite, conforme STORAGE_ENGINE)"""
     docs = []
-    for fp in files:
+    try:
+        for ch in STORAGE.list_chapters(book_id, with_text=True):
+            docs.append({"id": ch["id"], "title": ch["title"], "text": ch["text"], "file": ch["path"]})
+    except Exception as e:
+        print(f"[WARN] Falha ao ler capítulos de {book_id}: {e}")
+    return docs
+
+def _embed_texts(texts: List[str]):
+    return _get_embed_model().encode(texts, normalize_embeddings=True, batch_size=32)
+
+def _sync_vector_index(book_id: str) -> "vector_index.VectorIndex":
+    """Deixa o índice vetorial igual ao armazenamento: só capítulos novos/alterados são re-embedados."""
+    idx = vector_index.get_index(book_id)
+    stamps = STORAGE.chapter_stamps(book_id)
+    for cid, stamp in stamps.items():
+        sig, old_stamp = idx.signature(cid)
+        if old_stamp == stamp:
+            continue
+        ch = STORAGE.read_chapter(book_id, cid)
+        if not ch:
+            continue
+        h = _hash_text(ch["title"], ch["text"].strip())
+        if h == sig:
+            idx.touch(cid, stamp)
+        else:
+            idx.upsert(cid, ch["title"], ch["text"], h, _embed_texts, stamp=stamp)
+    for cid in set(idx.meta["chapters"]) - set(stamps):
+        idx.delete(cid)
+    return idx
+
+def _update_vector_index(book_id: str, chapter_id: str, title: str, text: str):
+    """Insere o capítulo salvo no índice vetorial (só se o modelo já estiver carregado; senão fica para a próxima busca)."""
+    if not _embed_model:
+        return
+    try:
+        vector_index.get_index(book_id).upsert(chapter_id, title, text, _hash_text(title, text.strip()), _embed_texts)
+    except Exception as e:
+        print(f"[WARN] Índice vetorial não atualizado para {book_id}:{chapter_id}: {e}")
+
+def _retrieve_top_k(book_id: str, query: str, k: int = 8, with_text: bool = True):
+    """Top-K capítulos do livro: índice vetorial local (IVF por trechos) ou, sem embeddings, ranking por palavras."""
+    return _retrieve_top_k_batch(book_id, [query], k=k, with_text=with_text)[0]
+
+def _retrieve_top_k_batch(book_id: str, queries: List[str], k: int = 8, with_text: bool = True):
+    """
+    Como _retrieve_top_k, para várias consultas: um encode e um produto de matrizes para todas.
+    with_text=False: com o índice vetorial, não lê os capítulos (basta id/título/span para _fmt_context).
+    """
+    if _get_embed_model():
         try:
-            with open(fp, "r", encoding="utf-8") as f:
-                txt = f.read()
-            # título = primeira linha '# ' ou 1ª linha não vazia
-            first = next((ln.strip() for ln in txt.splitlines() if ln.strip()), "")
-            title = first[2:].strip() if first.startswith("# ") else first[:120] or "Capítulo"
-            chapter_id = os.path.basename(fp).split("__", 1)[1].replace(".md", "")
-            docs.append({"id": chapter_id, "title": title, "text": txt, "file": fp})
+            idx = _sync_vector_index(book_id)
+            chapters = {}
+            out = []
+            for hits in idx.search_batch(_embed_texts(queries), k=k):
+                res = []
+                for h in hits:
+                    if not with_text:
+                        res.append({"id": h["chapter_id"], "title": h["title"], "score": h["score"], "span": h["span"]})
+                        continue
+                    if h["chapter_id"] not in chapters:
+                        chapters[h["chapter_id"]] = STORAGE.read_chapter(book_id, h["chapter_id"])
+                    ch = chapters[h["chapter_id"]]
+                    if ch:
+                        res.append({"id": h["chapter_id"], "title": ch["title"], "text": ch["text"],
+                                    "file": ch["path"], "score": h["score"], "span": h["span"]})
+                out.append(res)
+            return out
         except Exception as e:
-            print(f"[WARN] Falha ao ler {fp}: {e}")
-    return docs
+            print(f"[WARN] Índice vetorial indisponível para {book_id}, usando varredura: {e}")
+    docs = _read_chapters_fs(book_id)
+    return [_semantic_top_k(q, docs, k=k) for q in queries]
 
 def _semantic_top_k(query: str, docs, k: int = 8):
     """Top-K por similaridade (se houver embeddings) ou por contagem de palavras-chave."""
@@ -1066,35 +3008,105 @@ def _semantic_top_k(query: str, docs, k: int = 8):
         qv = model.encode([query], normalize_embeddings=True)
         dv = model.encode([ (d["title"] + "\n" + d["text"][:2000]) for d in docs ], normalize_embeddings=True)
         sims = (dv @ qv[0])
-        idx = sorted(range(len(sims)), key=lambda i: sims[i], reverse=True)[:k]
-        out = []
-        for i in idx:
-            d = docs[int(i)]
-            out.append({**d, "score": float(sims[int(i)])})
-        return out
+        return [{**docs[int(i)], "score": float(sims[int(i)])} for i in vector_index.top_k_indices(sims, k)]
     # Fallback: ranking ingênuo por match de termos
     terms = [t for t in re.findall(r"\w{3,}", query.lower())]
     def score(d):
         s = (d["title"] + " " + d["text"][:4000]).lower()
         return sum(s.count(t) for t in terms)
-    scored = sorted(docs, key=score, reverse=True)[:k]
+    scores = np.array([score(d) for d in docs], dtype=np.float32)
+    scored = [docs[int(i)] for i in vector_index.top_k_indices(scores, k)]
     for d in scored:
         d["score"] = 0.0
     return scored
 
-def _fmt_context(hits):
+def _fmt_context(hits, book_id: Optional[str] = None):
+    """Um bloco por capítulo recuperado, montado a partir do pacote de contexto (se houver book_id)."""
+    packs = _context_packs(book_id, [h["id"] for h in hits]) if book_id and hits else {}
     blocks = []
     for h in hits:
-        preview = re.sub(r"\s+", " ", h["text"])[:600]
-        blocks.append(f"- Capítulo {h['id']} — {h['title']}\n  Trecho: {preview}")
+        pack = packs.get(h["id"])
+        # com índice vetorial, o trecho mostrado é o que casou com a consulta
+        preview = context_packs.excerpt(pack, h.get("span")) if pack else None
+        if preview is None:
+            text = h.get("text")
+            if text is None:   # pacote com trechos de outra configuração do índice
+                text = (STORAGE.read_chapter(book_id, h["id"]) or {}).get("text", "") if book_id else ""
+            text = text[h["span"][0]:h["span"][1]] if h.get("span") else text
+            preview = context_packs.preview(text)
+        block = f"- Capítulo {h['id']} — {h['title']}"
+        if pack and pack["entities"]:
+            block += f"\n  Personagens: {', '.join(pack['entities'])}"
+        blocks.append(f"{block}\n  Trecho: {preview}")
     return "\n".join(blocks) if blocks else "(sem contexto recuperado)"
 
+def _mention_excerpts(text: str, names: List[str], window: int = 200, max_n: int = 2) -> List[str]:
+    pat = re.compile("|".join(re.escape(n) for n in sorted(names, key=len, reverse=True) if n), re.IGNORECASE)
+    out, last_end = [], -1
+    for m in pat.finditer(text):
+        if m.start() < last_end:
+            continue
+        a, b = max(0, m.start() - window), min(len(text), m.end() + window)
+        out.append(re.sub(r"\s+", " ", text[a:b]).strip())
+        last_end = b
+        if len(out) >= max_n:
+            break
+    return out
+
+def _fmt_entity_context(book_id: str, query: str, max_chars: int = ENTITY_CONTEXT_MAX_CHARS) -> str:
+    """Personagens/locais citados na pergunta → todos os capítulos em que aparecem (índice, sem embeddings)."""
+    ents = entity_index.mentioned_in(book_id, query or "")
+    if not ents:
+        return ""
+    order = {cid: i for i, cid in enumerate(_list_chapter_ids(book_id))}
+    index = entity_index.load(book_id)
+    blocks, used = [], 0
+    for ent in ents:
+        names = [ent["name"], *ent["aliases"]]
+        head = f"### {ent['name']}" + (f" (também: {', '.join(ent['aliases'])})" if ent["aliases"] else "")
+        lines = [head]
+        if ent.get("role") or ent.get("description"):
+            lines.append(f"{ent.get('role', '')} {ent.get('description', '')}".strip())
+        for rel in index["relationships"]:
+            if ent["key"] in (rel["a"], rel["b"]):
+                other = rel["b"] if rel["a"] == ent["key"] else rel["a"]
+                other_name = index["entities"].get(other, {}).get("name", other)
+                lines.append(f"- Relação com {other_name}: {rel.get('type', '')} {rel.get('description', '')}".rstrip())
+        for cid in sorted(ent["chapters"], key=lambda c: order.get(c, len(order))):
+            ch = STORAGE.read_chapter(book_id, cid)
+            if not ch:
+                continue
+            excerpts = _mention_excerpts(ch["text"], names) or [context_packs.preview(ch["text"], 300)]
+            line = f"- Capítulo {cid} — {ch['title']}: " + " … ".join(excerpts)
+            if used + len(line) > max_chars:
+                lines.append("- (demais capítulos omitidos: limite de contexto)")
+                break
+            lines.append(line)
+            used += len(line)
+        blocks.append("\n".join(lines))
+    return "## PERSONAGENS/LOCAIS CITADOS\n" + "\n\n".join(blocks)
+
 def _build_context(book_id: Optional[str], use_memory: str, k: int,
-                   include_current: bool, current_title: Optional[str], current_text: Optional[str]):
+                   include_current: bool, current_title: Optional[str], current_text: Optional[str],
+                   query: Optional[str] = None, use_entities: bool = False,
+                   before_chapter_id: Optional[str] = None, previous_n: Optional[int] = None):
+    """
+    use_memory: 'none' | 'book' | 'book+current' | 'tree' | 'tree+book' | 'previous' | 'previous+book'.
+    'tree' usa a árvore de resumos (sinopse + arcos): contexto global com tamanho limitado.
+    'previous' usa os capítulos imediatamente anteriores a `before_chapter_id` (ou ao fim do livro).
+    use_entities: acrescenta todos os capítulos em que aparecem os personagens/locais citados em `query`.
+    """
     blocks = []
-    if use_memory in ("book", "book+current") and book_id:
-        hits = _semantic_top_k(current_title or "", _read_chapters_fs(book_id), k=k)
-        blocks.append(_fmt_context(hits))
+    if use_entities and book_id:
+        blocks.append(_fmt_entity_context(book_id, query or ""))
+    if use_memory in ("tree", "tree+book") and book_id:
+        blocks.append(_fmt_summary_tree(book_id))
+    if use_memory in ("book", "book+current", "tree+book", "previous+book") and book_id:
+        hits = _retrieve_top_k(book_id, query or current_title or "", k=k, with_text=False)
+        blocks.append(_fmt_context(hits, book_id))
+    if use_memory in ("previous", "previous+book") and book_id:
+        n = CONTEXT_PREVIOUS_N if previous_n is None else previous_n
+        blocks.append(_fmt_previous_chapters(book_id, before_chapter_id, n))
     if include_current or use_memory == "book+current":
         if current_text:
             blocks.append(f"## CAPÍTULO ATUAL: {current_title or 'Capítulo atual'}\n{current_text}")
@@ -1105,39 +3117,43 @@ class AskIn(BaseModel):
     question: str
     k: int = 8
     use_memory: bool = True
+    use_summary_tree: bool = False   # inclui sinopse + arcos (perguntas sobre o livro todo)
+    use_entities: bool = False       # capítulos em que aparecem os personagens citados na pergunta
     include_current: bool = False
     current_title: str | None = None
     current_text: str | None = None
     show_prompt: bool = False
+    stream: bool = False
 
-@app.post("/ask")
+@app.post("/ask", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
 def ask(inp: AskIn):
     """Pergunta livre ao copiloto, com RAG opcional (FS-based)."""
     # Recupera contexto
     context = ""
-    if inp.use_memory:
-        docs = _read_chapters_fs(inp.book_id)
-        hits = _semantic_top_k(inp.question, docs, k=inp.k)
-        context = _fmt_context(hits)
+    if inp.use_memory or inp.use_summary_tree or inp.use_entities:
+        if inp.use_summary_tree:
+            mode = "tree+book" if inp.use_memory else "tree"
+        else:
+            mode = "book" if inp.use_memory else "none"
+        context = _build_context(inp.book_id, mode, inp.k, False, None, None, query=inp.question,
+                                 use_entities=inp.use_entities)
     # Capítulo atual opcional
     cur_block = ""
     if inp.include_current and inp.current_text:
         cur_t = inp.current_title or "Capítulo atual"
         cur_block = f"\n## CAPÍTULO ATUAL: {cur_t}\n{inp.current_text}\n"
 
-    system = {
-        "role": "system",
-        "content": (
-            "Você é um coautor atento à continuidade. Use ESTRITAMENTE o contexto fornecido "
-            "para responder. Se faltar contexto, diga o que precisa. Responda em PT-BR."
-        )
-    }
-    user = {
-        "role": "user",
-        "content": f"## CONTEXTO (Memória)\n{context}{cur_block}\n\n## PERGUNTA\n{inp.question}"
-    }
-    prompt_preview = f"[SYSTEM]\n{system['content']}\n\n[USER]\n{user['content']}" if inp.show_prompt else None
-    out = openai_chat([system, user], temperature=0.5, max_tokens=1200)
+    messages = build_messages(
+        inp.book_id,
+        "Responda como coautor atento à continuidade. Use ESTRITAMENTE o contexto fornecido "
+        "para responder. Se faltar contexto, diga o que precisa.",
+        f"## CONTEXTO (Memória)\n{context}{cur_block}\n\n## PERGUNTA\n{inp.question}",
+    )
+    prompt_preview = _prompt_preview(messages) if inp.show_prompt else None
+    if inp.stream:
+        chunks = openai_chat_stream(messages, temperature=0.5, max_tokens=1200, op="ask")
+        return _stream_response(chunks, lambda out: {"answer": out, "prompt_preview": prompt_preview})
+    out = openai_chat(messages, temperature=0.5, max_tokens=1200, op="ask")
     return {"answer": out, "prompt_preview": prompt_preview}
 
 class IdeateIn(BaseModel):
@@ -1149,18 +3165,18 @@ class IdeateIn(BaseModel):
     style: str | None = None
     show_prompt: bool = False
 
-@app.post("/ideate")
+@app.post("/ideate", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
 def ideate(inp: IdeateIn):
     """Gera N ideias estruturadas (JSON) a partir de um tema (com memória opcional)."""
     context = ""
     if inp.use_memory and inp.book_id:
-        hits = _semantic_top_k(inp.idea, _read_chapters_fs(inp.book_id), k=inp.k)
-        context = _fmt_context(hits)
+        hits = _retrieve_top_k(inp.book_id, inp.theme, k=inp.k, with_text=False)
+        context = _fmt_context(hits, inp.book_id)
     style = f"\nPreferências/estilo: {inp.style}" if inp.style else ""
     system = {
         "role": "system",
         "content": (
-            "Você é um roteirista. Gere ideias de cenas/capítulos em JSON (lista), sem texto extra. "
+            "Você é um roteirista. Gere ideias de cenas/capítulos em JSON no formato {\"ideas\": [...]}, sem texto extra. "
             "Cada item deve ter: title, logline, conflict, twist, stakes, pov, tone."
         )
     }
@@ -1173,15 +3189,12 @@ def ideate(inp: IdeateIn):
         )
     }
     preview = f"[SYSTEM]\n{system['content']}\n\n[USER]\n{user['content']}" if inp.show_prompt else None
-    raw = openai_chat([system, user], temperature=0.9, max_tokens=1600)
-    ideas = []
     try:
-        ideas = json.loads(raw)
-        if isinstance(ideas, dict):  # caso o modelo retorne {"ideas":[...]}
-            ideas = ideas.get("ideas", [])
-    except Exception:
+        ideas = [it.model_dump() for it in llm_structured([system, user], IdeaList, op="ideate",
+                                                          temperature=0.9, max_tokens=1600).ideas]
+    except StructuredOutputError as e:
         # fallback: lista simples numerada
-        ideas = [{"title": f"Ideia {i+1}", "logline": line.strip()} for i, line in enumerate(raw.split("\n")) if line.strip()]
+        ideas = [{"title": f"Ideia {i+1}", "logline": line.strip()} for i, line in enumerate(e.raw.split("\n")) if line.strip()]
     return {"ideas": ideas, "prompt_preview": preview}
 
 class ExpandIn(BaseModel):
@@ -1189,17 +3202,23 @@ class ExpandIn(BaseModel):
     source: str = "idea"                   # 'idea' | 'chapter'
     idea: Optional[str] = None
     chapter_id: Optional[str] = None
-    use_memory: str = "book"               # 'none' | 'book' | 'book+current'
+    use_memory: str = "book"               # 'none' | 'book' | 'book+current' | 'tree' | 'tree+book' | 'previous' | 'previous+book'
+    previous_n: Optional[int] = None       # capítulos anteriores no modo 'previous' (padrão CONTEXT_PREVIOUS_N)
+    use_entities: bool = False             # + capítulos dos personagens citados na ideia
     include_current: bool = False
     current_title: Optional[str] = None
     current_text: Optional[str] = None
     k: int = 8
     length: str = "500-800 palavras"
-    save_as_chapter: bool = False
+    save_as_chapter: bool = False          # salva o melhor candidato
+    save_as_revision: bool = False         # com source='chapter': a cena vira nova revisão do capítulo (não outro arquivo)
     title: Optional[str] = None
     show_prompt: bool = False
+    n: int = 1                             # cenas alternativas, numa só requisição ao vLLM
+    best_of: Optional[int] = None
+    stream: bool = False                   # NDJSON com os tokens conforme chegam (ignora n)
 
-@app.post("/expand")
+@app.post("/expand", dependencies=[Depends(track_usage), Depends(cancel_on_disconnect)])
 def expand(inp: ExpandIn):
     """
     Escreve uma cena a partir de uma ideia OU capítulo existente, controlando o uso de memória.
@@ -1214,12 +3233,13 @@ def expand(inp: ExpandIn):
         ch = read_chapter(inp.book_id, inp.chapter_id)  # usa helper existente
         base_text = f"[Capítulo {inp.chapter_id} — {ch['title']}]\n{ch['text']}"
 
-    # 2) Memória do livro (RAG)
+    # 2) Memória do livro (RAG e/ou árvore de resumos)
     context = ""
-    if inp.use_memory in ("book", "book+current") and inp.book_id:
-        docs = _read_chapters_fs(inp.book_id)
-        hits = _semantic_top_k(base_text or "expandir cena", docs, k=inp.k)
-        context = _fmt_context(hits)
+    if (inp.use_memory != "none" or inp.use_entities) and inp.book_id:
+        context = _build_context(inp.book_id, inp.use_memory, inp.k, False, None, None,
+                                 query=base_text or "expandir cena", use_entities=inp.use_entities,
+                                 before_chapter_id=inp.chapter_id if inp.source == "chapter" else None,
+                                 previous_n=inp.previous_n)
 
     # 3) Capítulo atual do editor (opcional)
     cur_block = ""
@@ -1227,36 +3247,836 @@ def expand(inp: ExpandIn):
         cur_title = inp.current_title or "Capítulo atual"
         cur_block = f"\n## CAPÍTULO ATUAL: {cur_title}\n{inp.current_text}\n"
 
-    # 4) Prompt final
-    system = {
-        "role": "system",
-        "content": (
-            "Você é um co-roteirista. Escreva uma CENA fluida e cinematográfica, coerente com o contexto. "
-            "Mantenha consistência de personagens e tom. PT-BR."
-        )
-    }
-    user = {
-        "role": "user",
-        "content": (
+    # 4) Prompt final: preâmbulo estável do livro primeiro, depois o que muda a cada pedido
+    messages = build_messages(
+        inp.book_id,
+        "Como co-roteirista, escreva uma CENA fluida e cinematográfica, coerente com o contexto. "
+        "Mantenha consistência de personagens e tom. Entregue apenas a cena, sem metacomentários.",
+        (
             f"## CONTEXTO (Memória)\n{context}"
             f"{cur_block}\n\n"
             f"## BASE\n{base_text}\n\n"
-            f"Diretriz de tamanho: {inp.length}\n"
-            "Entregue apenas a cena, sem metacomentários."
-        )
+            f"Diretriz de tamanho: {inp.length}"
+        ),
+    )
+
+    def finish(scene: str, candidates: Optional[List[Dict]] = None) -> Dict:
+        # 5) Salvar como capítulo, se pedido
+        saved = None
+        if inp.save_as_revision and inp.source == "chapter":
+            title = inp.title or ch["title"]
+            path = save_chapter(inp.book_id, inp.chapter_id, title, scene, source="expand")
+            saved = {"chapter_id": inp.chapter_id, "path": path, "title": title,
+                     "revision": HISTORY.latest(inp.book_id, inp.chapter_id)}
+        elif inp.save_as_chapter and inp.book_id:
+            ch_id = str(uuid.uuid4())[:8]
+            title = inp.title or "Cena gerada"
+            path = save_chapter(inp.book_id, ch_id, title, scene, source="expand")
+            saved = {"chapter_id": ch_id, "path": path, "title": title}
+        return {"scene": scene, "saved": saved,
+                "candidates": candidates if candidates and len(candidates) > 1 else None}
+
+    if inp.stream:
+        chunks = openai_chat_stream(messages, temperature=0.8, max_tokens=2200, op="expand")
+        return _stream_response(chunks, finish)
+    candidates = _generate_candidates(messages, inp.n, inp.best_of, op="expand", length=inp.length,
+                                      temperature=0.8, max_tokens=2200)
+    return finish(candidates[0]["text"], candidates)
+
+# ========================
+# Jobs em segundo plano + auditoria de continuidade
+# ========================
+CONTINUITY_MAX_IN_FLIGHT = int(os.getenv("CONTINUITY_MAX_IN_FLIGHT", "4"))
+_SEVERITY_RANK = {"baixa": 0, "media": 1, "média": 1, "alta": 2}
+
+JOBS = JobManager()
+
+class ContinuityIssue(BaseModel):
+    type: str                        # continuidade | personagem | linha do tempo | lógica | cenário
+    description: str
+    severity: str = "media"          # baixa | media | alta
+    chapters: List[str] = []         # títulos/IDs dos capítulos envolvidos
+
+class ContinuityIssues(BaseModel):
+    issues: List[ContinuityIssue] = []
+
+class ContinuityAuditIn(BaseModel):
+    chapter_ids: Optional[List[str]] = None   # se None, audita o livro inteiro
+    k: int = 4                                # trechos de capítulos anteriores por capítulo
+    max_in_flight: Optional[int] = None       # limitado por CONTINUITY_MAX_IN_FLIGHT
+
+def _audit_chapter(book_id: str, chapter_id: str, earlier_hits: List[Dict]) -> Dict:
+    """Crítica de continuidade de um capítulo contra trechos recuperados dos capítulos anteriores."""
+    ch = read_chapter(book_id, chapter_id)
+    context = _fmt_context(earlier_hits, book_id) if earlier_hits else "(primeiro capítulo: sem capítulos anteriores)"
+    messages = build_messages(
+        book_id,
+        "Como editor de continuidade, compare o capítulo atual com os trechos dos capítulos ANTERIORES "
+        "e liste apenas contradições concretas (fatos, características de personagens, linha do tempo, "
+        "lugares, objetos). Não comente estilo. Se não houver problemas, devolva uma lista vazia.",
+        f"## CAPÍTULOS ANTERIORES (trechos)\n{context}\n\n"
+        f"## CAPÍTULO ATUAL: {ch['title']}\n{ch['text']}",
+    )
+    found = llm_structured(messages, ContinuityIssues, op="continuity", temperature=0.2, max_tokens=1500)
+    issues = []
+    for issue in found.issues:
+        item = issue.model_dump()
+        item["chapters"] = list(dict.fromkeys([chapter_id, *[str(c) for c in item["chapters"] if c]]))
+        issues.append(item)
+    return {"title": ch["title"], "issues": issues}
+
+def _dedupe_issues(issues: List[Dict]) -> List[Dict]:
+    """Junta problemas repetidos (mesmo tipo e descrição quase igual) e une os capítulos."""
+    merged: List[Dict] = []
+    for issue in issues:
+        key = entity_index.norm(issue["description"])
+        for m in merged:
+            if m["type"].lower() == issue["type"].lower() and \
+                    difflib.SequenceMatcher(None, m["_key"], key).ratio() >= 0.85:
+                m["chapters"] = list(dict.fromkeys(m["chapters"] + issue["chapters"]))
+                if _SEVERITY_RANK.get(issue["severity"], 1) > _SEVERITY_RANK.get(m["severity"], 1):
+                    m["severity"] = issue["severity"]
+                m["occurrences"] += 1
+                break
+        else:
+            merged.append({**issue, "_key": key, "occurrences": 1})
+    for m in merged:
+        del m["_key"]
+    return merged
+
+def _continuity_report(book_id: str, issues: List[Dict], titles: Dict[str, str], failed: List[str]) -> str:
+    lines = [f"## Auditoria de continuidade ({len(issues)} problema(s))\n"]
+    for i, issue in enumerate(issues, 1):
+        chapters = ", ".join(titles.get(c, c) for c in issue["chapters"])
+        lines.append(f"### {i}. [{issue['severity']}] {issue['type']}\n{issue['description']}\n\n"
+                     f"**Capítulos:** {chapters}\n")
+    if not issues:
+        lines.append("Nenhuma contradição encontrada.\n")
+    if failed:
+        lines.append(f"**Capítulos não auditados (erro):** {', '.join(titles.get(c, c) for c in failed)}\n")
+    return "\n".join(lines)
+
+def _run_continuity_audit(job) -> Dict:
+    """Runner do job 'continuity': um capítulo por item, no máximo max_in_flight chamadas ao vLLM."""
+    book_id, params = job.book_id, job.params
+    _usage_ctx.set(UsageContext(book_id, params.get("user", ""), "/continuity/{book_id}/audit"))
+    order = _list_chapter_ids(book_id)
+    targets = [c for c in (params.get("chapter_ids") or order) if c in order]
+    job.set_total(len(targets))
+    pending = [c for c in targets if not job.is_done(c)]
+
+    # contexto: uma busca em lote para todos os capítulos pendentes, filtrada para os anteriores
+    position = {cid: i for i, cid in enumerate(order)}
+    k = max(1, params.get("k", 4))
+    queries = []
+    for cid in pending:
+        ch = STORAGE.read_chapter(book_id, cid)
+        queries.append(f"{ch['title']}\n{ch['text'][:2000]}" if ch else cid)
+    hits_by_chapter = {}
+    if pending:
+        for cid, hits in zip(pending, _retrieve_top_k_batch(book_id, queries, k=k * 3)):
+            hits_by_chapter[cid] = [h for h in hits if position.get(h["id"], len(order)) < position[cid]][:k]
+    job.check_cancelled()
+
+    in_flight = max(1, min(params.get("max_in_flight") or CONTINUITY_MAX_IN_FLIGHT, CONTINUITY_MAX_IN_FLIGHT))
+    pool = ThreadPoolExecutor(max_workers=in_flight)
+    try:
+        futures = {pool.submit(contextvars.copy_context().run, _audit_chapter, book_id, cid, hits_by_chapter[cid]): cid
+                   for cid in pending}
+        for fut in as_completed(futures):
+            cid = futures[fut]
+            try:
+                job.item_done(cid, fut.result())
+            except Exception as e:
+                print(f"[WARN] Auditoria de {book_id}:{cid} falhou: {e}")
+                job.item_done(cid, {"error": str(getattr(e, "detail", e))}, failed=True)
+            job.check_cancelled()
+    finally:
+        # cancelado → os capítulos que ainda não começaram não vão para o vLLM
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    items = job.items()
+    done = [c for c in targets if c in items and "error" not in items[c]]
+    failed = [c for c in targets if c in items and "error" in items[c]]
+    titles = {c: items[c].get("title", c) for c in done}
+    issues = _dedupe_issues([i for c in done for i in items[c]["issues"]])
+    issues.sort(key=lambda i: (-_SEVERITY_RANK.get(i["severity"], 1),
+                               min(position.get(c, len(order)) for c in i["chapters"])))
+    report = _continuity_report(book_id, issues, titles, failed)
+    path = save_critique(book_id, f"continuidade_{job.id}", "Auditoria de continuidade", report)
+    print(f"[INFO] Relatório de continuidade salvo em: {path}")
+    return {
+        "issues": issues,
+        "issue_count": len(issues),
+        "chapters_audited": len(done),
+        "chapters_failed": failed,
+        "critique_file": os.path.basename(path),
     }
 
-    scene = openai_chat([system, user], temperature=0.8, max_tokens=2200)
+JOBS.register("continuity", _run_continuity_audit)
+
+@app.post("/continuity/{book_id}/audit", dependencies=[Depends(track_usage)])
+def start_continuity_audit(book_id: str, payload: ContinuityAuditIn = ContinuityAuditIn()):
+    """Inicia a auditoria de continuidade do livro em segundo plano (acompanhe em /jobs/{job_id})."""
+    if not _list_chapter_ids(book_id):
+        raise HTTPException(status_code=404, detail="Nenhum capítulo encontrado para este livro")
+    job = JOBS.start("continuity", {**payload.model_dump(), "user": _usage_now().user}, book_id=book_id)
+    return job.snapshot()
+
+@app.get("/jobs")
+def list_jobs(kind: Optional[str] = None, book_id: Optional[str] = None):
+    return {"jobs": JOBS.list(kind=kind, book_id=book_id)}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, items: bool = False):
+    """Estado do job (progresso, resultado); items=true inclui o resultado de cada item."""
+    job = JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job não encontrado: {job_id}")
+    return job.snapshot(with_items=items)
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = JOBS.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job não encontrado: {job_id}")
+    return job.snapshot()
+
+@app.post("/jobs/{job_id}/resume", dependencies=[Depends(track_usage)])
+def resume_job(job_id: str):
+    """Retoma um job interrompido, cancelado ou com falha; itens já concluídos não são refeitos."""
+    try:
+        job = JOBS.resume(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=f"Job não pode ser retomado no estado '{e.args[0]}'")
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job não encontrado: {job_id}")
+    return job.snapshot()
 
-    # 5) Salvar como capítulo, se pedido
-    saved = None
-    if inp.save_as_chapter and inp.book_id:
-        ch_id = str(uuid.uuid4())[:8]
-        title = inp.title or "Cena gerada"
-        path = save_chapter(inp.book_id, ch_id, title, scene)
-        saved = {"chapter_id": ch_id, "path": path, "title": title}
+# ========================
+# Importação de manuscritos (upload em streaming + job de indexação)
+# ========================
+# O corpo do POST é o próprio arquivo (sem multipart): um Markdown com um capítulo por título
+# "# ", um .zip de .md ou JSONL ({"title", "text", "chapter_id"?} por linha). Cada capítulo é
+# gravado assim que termina de chegar; o upload nunca fica inteiro na memória (o zip vai para
+# um arquivo temporário, porque o índice dele fica no fim). Resumos, Chroma e embeddings ficam
+# para o job "import".
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(200 * 1024 * 1024)))
+IMPORT_MAX_IN_FLIGHT = int(os.getenv("IMPORT_MAX_IN_FLIGHT", str(SUMMARY_MAX_IN_FLIGHT)))
+_IMPORT_FORMATS = {
+    "application/zip": "zip",
+    "application/x-zip-compressed": "zip",
+    "application/jsonl": "jsonl",
+    "application/x-ndjson": "jsonl",
+    "application/x-jsonlines": "jsonl",
+    "text/markdown": "md",
+    "text/x-markdown": "md",
+    "application/gzip": "snapshot",
+    "application/x-gzip": "snapshot",
+}
+_IMPORT_CHAPTER_EXTS = (".md", ".markdown", ".txt")
+
+class ImportTooLarge(Exception):
+    pass
+
+class _MarkdownSplitter:
+    """Recebe linhas e devolve (título, texto) a cada capítulo fechado por um novo título de nível `level`."""
+    def __init__(self, level: int = 1):
+        self.prefix = "#" * level + " "
+        self.title: Optional[str] = None
+        self.lines: List[str] = []
+        self.in_fence = False
+
+    def feed(self, line: str):
+        if line.lstrip().startswith("```"):
+            self.in_fence = not self.in_fence
+        if not self.in_fence and line.startswith(self.prefix):
+            done = self._flush()
+            self.title = line[len(self.prefix):].strip() or "Sem título"
+            return done
+        self.lines.append(line)
+        return None
+
+    def _flush(self):
+        text = "".join(self.lines).strip()
+        title, self.lines = self.title, []
+        if title is None and all(not l.strip() or l.startswith("#") for l in text.splitlines()):
+            return None    # antes do primeiro capítulo só havia títulos (ex.: "# Livro" com heading_level=2)
+        return (title or "Sem título", text)
+
+    def finish(self):
+        return self._flush()
+
+async def _limited_chunks(request: Request):
+    total = 0
+    async for chunk in request.stream():
+        total += len(chunk)
+        if total > IMPORT_MAX_BYTES:
+            raise ImportTooLarge(total)
+        yield chunk
+
+async def _text_lines(chunks, first: bytes = b""):
+    """Linhas (com o \n) de um fluxo de bytes UTF-8, sem juntar o corpo inteiro."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = decoder.decode(first)
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    for line in pending.split("\n"):
+        if line:
+            yield line + "\n"
+
+_CHAPTER_ID_RE = re.compile(r"^[\w-]{1,128}$")
+
+def _valid_chapter_id(chapter_id) -> bool:
+    """IDs vindos de arquivos importados viram nomes de arquivo: nada de barras ou '..'."""
+    return isinstance(chapter_id, str) and bool(_CHAPTER_ID_RE.match(chapter_id))
+
+def _natural_key(name: str):
+    return [int(p) if p.isdigit() else p.lower() for p in re.split(r"(\d+)", name)]
+
+def _zip_chapters(fileobj):
+    """(título, texto) de cada .md do zip, em ordem natural de nome (cap2 antes de cap10)."""
+    with zipfile.ZipFile(fileobj) as zf:
+        members = [m for m in zf.infolist()
+                   if not m.is_dir() and m.filename.lower().endswith(_IMPORT_CHAPTER_EXTS)
+                   and not os.path.basename(m.filename).startswith(".")]
+        for m in sorted(members, key=lambda m: _natural_key(m.filename)):
+            if m.file_size > IMPORT_MAX_BYTES:
+                raise ImportTooLarge(m.file_size)
+            content = zf.read(m).decode("utf-8-sig", errors="replace")
+            if content.startswith("# "):
+                title, text = split_title(content)
+            else:   # sem título no arquivo: o nome dele
+                title, text = os.path.splitext(os.path.basename(m.filename))[0], content
+            yield title, text.strip()
+
+def _import_one(book_id: str, title: str, text: str, chapter_id: Optional[str] = None) -> Dict:
+    chapter_id = chapter_id or str(uuid.uuid4())
+    save_chapter(book_id, chapter_id, title, text, index_vectors=False, source="import")
+    return {"chapter_id": chapter_id, "title": title, "chars": len(text)}
+
+def _import_zip(book_id: str, fileobj, imported: List[Dict]):
+    """Grava cada capítulo do zip (leitura e descompressão fora do event loop); acrescenta em imported."""
+    for title, text in _zip_chapters(fileobj):
+        imported.append(_import_one(book_id, title, text))
+
+def _import_vectors(book_id: str):
+    """Estágio de CPU do job: embeddings de todos os capítulos novos (roda junto com os resumos no vLLM)."""
+    if not _get_embed_model():
+        return
+    try:
+        _sync_vector_index(book_id)
+    except Exception as e:
+        print(f"[WARN] Índice vetorial de {book_id} não atualizado na importação: {e}")
+
+def _run_import(job) -> Dict:
+    """Runner do job 'import': resumo + Chroma + árvore/entidades por capítulo, embeddings em paralelo."""
+    book_id, params = job.book_id, job.params
+    _usage_ctx.set(UsageContext(book_id, params.get("user", ""), "/books/{book_id}/import"))
+    existing = set(STORAGE.chapter_stamps(book_id))
+    targets = [c for c in params["chapter_ids"] if c in existing]
+    job.set_total(len(targets))
+    pending = [c for c in targets if not job.is_done(c)]
+
+    vectors = threading.Thread(target=_import_vectors, args=(book_id,), name=f"import-vectors-{job.id}", daemon=True)
+    vectors.start()
+    in_flight = max(1, min(params.get("max_in_flight") or IMPORT_MAX_IN_FLIGHT, IMPORT_MAX_IN_FLIGHT))
+    pool = ThreadPoolExecutor(max_workers=in_flight)
+    try:
+        futures = {pool.submit(contextvars.copy_context().run, _summarize_and_index, book_id, cid): cid
+                   for cid in pending}
+        for fut in as_completed(futures):
+            cid = futures[fut]
+            try:
+                res = fut.result()
+                job.item_done(cid, {"title": res["title"], "chroma_saved": res["chroma_saved"],
+                                    "summary_ok": not res["summary"].get("parse_failed")})
+            except Exception as e:
+                print(f"[WARN] Importação de {book_id}:{cid} falhou: {e}")
+                job.item_done(cid, {"error": str(getattr(e, "detail", e))}, failed=True)
+            job.check_cancelled()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        vectors.join()
+
+    _refresh_summary_tree_safe(book_id)
+    _warm_previous_window(book_id)
+    items = job.items()
+    return {
+        "chapters_indexed": sum(1 for c in targets if c in items and "error" not in items[c]),
+        "chapters_failed": [c for c in targets if c in items and "error" in items[c]],
+    }
+
+JOBS.register("import", _run_import)
+
+@app.post("/books/{book_id}/import", dependencies=[Depends(track_usage)])
+async def import_book(book_id: str, request: Request, format: str = "auto", heading_level: int = 1,
+                      max_in_flight: Optional[int] = None):
+    """
+    Importa vários capítulos de uma vez (corpo = arquivo .md, .zip ou .jsonl; ver _IMPORT_FORMATS).
+    Os capítulos são gravados durante o upload, no fim da ordem do livro; o resto roda no job devolvido.
+    Um .tar.gz de /books/{id}/export (format=snapshot) restaura o livro inteiro, sem job.
+    """
+    fmt = format if format != "auto" else _IMPORT_FORMATS.get(
+        request.headers.get("content-type", "").split(";")[0].strip().lower(), "auto")
+    if fmt not in ("auto", "md", "zip", "jsonl", "snapshot"):
+        raise HTTPException(status_code=400, detail=f"Formato inválido: {format} (use md, zip, jsonl ou snapshot)")
+    if not 1 <= heading_level <= 6:
+        raise HTTPException(status_code=400, detail="heading_level deve estar entre 1 e 6")
+
+    chunks = _limited_chunks(request)
+    first = b""
+    imported: List[Dict] = []
+    errors: List[str] = []
+    try:
+        if fmt == "auto":   # pelo começo do arquivo
+            async for first in chunks:
+                if first:
+                    break
+            head = first.lstrip()
+            fmt = ("zip" if first.startswith(b"PK\x03\x04") else "snapshot" if first.startswith(b"\x1f\x8b")
+                   else "jsonl" if head.startswith(b"{") else "md")
+        if fmt == "snapshot":
+            if STORAGE.list_chapter_ids(book_id):
+                raise HTTPException(status_code=409, detail=f"O livro '{book_id}' já tem capítulos; "
+                                                            "restaure o snapshot em um livro novo")
+            with tempfile.TemporaryFile() as tmp:
+                tmp.write(first)
+                async for chunk in chunks:
+                    tmp.write(chunk)
+                tmp.seek(0)
+                try:
+                    restored = await run_in_threadpool(_restore_snapshot, book_id, tmp)
+                except (tarfile.TarError, EOFError, OSError, ValueError, KeyError) as e:
+                    raise HTTPException(status_code=400, detail=f"Snapshot inválido: {e}")
+            return {"book_id": book_id, "format": fmt, **restored, "job": None}
+        if fmt == "zip":
+            with tempfile.TemporaryFile() as tmp:
+                tmp.write(first)
+                async for chunk in chunks:
+                    tmp.write(chunk)
+                tmp.seek(0)
+                try:
+                    await run_in_threadpool(_import_zip, book_id, tmp, imported)
+                except zipfile.BadZipFile as e:
+                    raise HTTPException(status_code=400, detail=f"Zip inválido: {e}")
+        elif fmt == "jsonl":
+            n = 0
+            async for line in _text_lines(chunks, first):
+                n += 1
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    text = item["text"]
+                except (ValueError, KeyError, TypeError):
+                    errors.append(f"linha {n}: esperado um objeto JSON com 'text'")
+                    continue
+                title = item.get("title") or "Sem título"
+                cid = item.get("chapter_id")
+                if cid is not None and not _valid_chapter_id(cid):
+                    errors.append(f"linha {n}: chapter_id inválido")
+                    continue
+                imported.append(await run_in_threadpool(_import_one, book_id, title, text, cid))
+        else:
+            splitter = _MarkdownSplitter(heading_level)
+            async for line in _text_lines(chunks, first):
+                done = splitter.feed(line)
+                if done:
+                    imported.append(await run_in_threadpool(_import_one, book_id, *done))
+            done = splitter.finish()
+            if done:
+                imported.append(await run_in_threadpool(_import_one, book_id, *done))
+    except ImportTooLarge:
+        saved = f"; {len(imported)} capítulo(s) gravado(s) antes do limite ficaram sem indexação" if imported else ""
+        raise HTTPException(status_code=413, detail=f"Upload maior que IMPORT_MAX_BYTES ({IMPORT_MAX_BYTES} bytes){saved}")
+
+    if not imported:
+        raise HTTPException(status_code=400, detail="Nenhum capítulo encontrado no arquivo" +
+                            (f" ({errors[0]})" if errors else ""))
+    print(f"[OK] {len(imported)} capítulo(s) importado(s) para {book_id} ({fmt})")
+    params = {"chapter_ids": [c["chapter_id"] for c in imported], "max_in_flight": max_in_flight,
+              "user": _usage_now().user}
+    job = JOBS.start("import", params, book_id=book_id)
+    return {"book_id": book_id, "format": fmt, "chapters": imported, "errors": errors, "job": job.snapshot()}
 
-    return {"scene": scene, "saved": saved}
+# ========================
+# Exportação / snapshot de livros
+# ========================
+# GET /books/{id}/export devolve um .tar.gz com tudo o que o livro acumulou — capítulos, ordem,
+# sugestões, críticas, metadados, árvore de resumos, entidades, registros do Chroma e (opcional) o
+# índice vetorial — gerado em streaming: uma thread escreve o tar numa fila limitada e a resposta
+# esvazia a fila, então a memória não cresce com o tamanho do livro. O mesmo arquivo enviado para
+# POST /books/{id}/import restaura o livro sem chamar o LLM nem recalcular embeddings.
+SNAPSHOT_FORMAT = "book-assistant-snapshot"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COMPRESSLEVEL = int(os.getenv("SNAPSHOT_COMPRESSLEVEL", "6"))
+_SNAPSHOT_CHUNK = 64 * 1024
+_SNAPSHOT_QUEUE_CHUNKS = 16          # ~1 MB em trânsito por exportação
+_SNAPSHOT_CHROMA_PAGE = 256
+_SNAPSHOT_KINDS = {"chapters": "chapter", "suggestions": "suggestion", "critiques": "critique"}
+_SNAPSHOT_DIRS = {kind: directory for directory, kind in _SNAPSHOT_KINDS.items()}
+_SNAPSHOT_MEMBER = re.compile(r"^(chapters|suggestions|critiques)/([^/\\]+)\.md$")
+
+class _ExportAborted(Exception):
+    pass
+
+class _QueueWriter(io.RawIOBase):
+    """Arquivo só de escrita que entrega blocos de ~64 KB numa fila limitada (para quando o cliente sai)."""
+    def __init__(self, q: "queue.Queue", stop: threading.Event):
+        self.q, self.stop, self.buf = q, stop, bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b) -> int:
+        self.buf += b
+        if len(self.buf) >= _SNAPSHOT_CHUNK:
+            self.put(bytes(self.buf))
+            self.buf.clear()
+        return len(b)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise _ExportAborted()
+
+    def finish(self):
+        if self.buf:
+            self.put(bytes(self.buf))
+            self.buf.clear()
+        self.put(None)
+
+def _tar_add(tar: tarfile.TarFile, name: str, data, size: Optional[int] = None, mtime: Optional[float] = None):
+    """data: bytes ou arquivo aberto (size obrigatório)."""
+    if isinstance(data, bytes):
+        data, size = io.BytesIO(data), len(data)
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime or time.time())
+    tar.addfile(info, data)
+
+def _tar_add_json(tar: tarfile.TarFile, name: str, obj):
+    _tar_add(tar, name, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+def _chroma_records(book_id: str, embeddings: bool):
+    """Registros do livro no Chroma, em páginas (resumos já prontos; embeddings se pedidos)."""
+    if not (CHROMA_AVAILABLE and HAVE_CHROMA_CLIENT and COLLECTION):
+        return
+    include = ["documents", "metadatas"] + (["embeddings"] if embeddings else [])
+    offset = 0
+    while True:
+        page = COLLECTION.get(where={"book_id": book_id}, include=include,
+                              limit=_SNAPSHOT_CHROMA_PAGE, offset=offset)
+        ids = page["ids"]
+        if not ids:
+            return
+        embs = page.get("embeddings") if embeddings else None
+        for i, rec_id in enumerate(ids):
+            rec = {"id": rec_id, "document": page["documents"][i], "metadata": page["metadatas"][i]}
+            if embs is not None and embs[i] is not None:
+                rec["embedding"] = [float(x) for x in embs[i]]
+            yield rec
+        if len(ids) < _SNAPSHOT_CHROMA_PAGE:
+            return
+        offset += len(ids)
+
+def _book_meta_path(book_id: str) -> str:
+    return os.path.join(BOOKS_DIR, f"{book_id}.json")
+
+def _write_snapshot(book_id: str, out: _QueueWriter, embeddings: bool):
+    chapter_ids = _list_chapter_ids(book_id)
+    artifacts = {kind: sorted(STORAGE.list_artifacts(book_id, kind), key=lambda a: a["mtime"])
+                 for kind in ("suggestion", "critique")}
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "book_id": book_id,
+        "exported_at": datetime.now().isoformat(),
+        "chapters": len(chapter_ids),
+        "suggestions": len(artifacts["suggestion"]),
+        "critiques": len(artifacts["critique"]),
+        "embeddings": embeddings,
+        # no layout de arquivos o capítulo de origem de sugestões/críticas não é conhecido
+        "artifact_chapters": {},
+    }
+    names = {}
+    for kind, items in artifacts.items():
+        for a in items:
+            name = f"{_SNAPSHOT_DIRS[kind]}/{re.sub(r'^(sugest|critica)_', '', a['file'])}"
+            names[a["path"]] = name
+            if a.get("chapter_id"):
+                manifest["artifact_chapters"][name] = a["chapter_id"]
+
+    gz = gzip.GzipFile(filename="", mode="wb", fileobj=out, compresslevel=SNAPSHOT_COMPRESSLEVEL)
+    with tarfile.open(fileobj=gz, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        _tar_add_json(tar, "manifest.json", manifest)
+        if os.path.exists(_book_meta_path(book_id)):
+            with open(_book_meta_path(book_id), "rb") as f:
+                _tar_add(tar, "book.json", f.read())
+        # resumos antes dos capítulos: na restauração os pacotes de contexto já saem com eles
+        _tar_add_json(tar, "summaries.json", load_summary_tree(book_id))
+        _tar_add_json(tar, "entities.json", entity_index.load(book_id))
+        for cid in chapter_ids:
+            raw = STORAGE.read_chapter_raw(book_id, cid)
+            if raw is not None:
+                _tar_add(tar, f"chapters/{cid}.md", raw.encode("utf-8"))
+        _tar_add_json(tar, "order.json", {"order": chapter_ids})
+        for kind, items in artifacts.items():
+            for a in items:
+                try:
+                    content = STORAGE.read_artifact(a["path"])
+                except FileNotFoundError:
+                    continue
+                _tar_add(tar, names[a["path"]], content.encode("utf-8"), mtime=a["mtime"])
+
+        # Chroma: tamanho do membro só é conhecido no fim → passa por um arquivo temporário
+        with tempfile.TemporaryFile() as tmp:
+            for rec in _chroma_records(book_id, embeddings):
+                tmp.write(json.dumps(rec, ensure_ascii=False).encode("utf-8") + b"\n")
+            if tmp.tell():
+                size = tmp.tell()
+                tmp.seek(0)
+                _tar_add(tar, "chroma.jsonl", tmp, size)
+
+        snap = vector_index.get_index(book_id).snapshot() if embeddings else None
+        if snap:
+            with snap["file"] as rows:
+                _tar_add(tar, "vectors/meta.json", snap["meta"])
+                buf = io.BytesIO()
+                np.save(buf, snap["assign"])
+                _tar_add(tar, "vectors/assign.npy", buf.getvalue())
+                if snap["centroids"] is not None:
+                    buf = io.BytesIO()
+                    np.save(buf, snap["centroids"])
+                    _tar_add(tar, "vectors/centroids.npy", buf.getvalue())
+                # linhas float16 cruas (sem cabeçalho .npy), lidas do disco em blocos
+                _tar_add(tar, "vectors/vectors.f16", rows, snap["nbytes"])
+    gz.close()
+    out.finish()
+
+@app.get("/books/{book_id}/export")
+async def export_book(book_id: str, embeddings: bool = True):
+    """
+    Snapshot do livro (.tar.gz em streaming). embeddings=false deixa de fora o índice vetorial e os
+    embeddings do Chroma (arquivo menor; são recalculados no destino).
+    """
+    if not STORAGE.list_chapter_ids(book_id) and not os.path.exists(_book_meta_path(book_id)):
+        raise HTTPException(status_code=404, detail="Livro não encontrado")
+
+    q: "queue.Queue" = queue.Queue(maxsize=_SNAPSHOT_QUEUE_CHUNKS)
+    stop = threading.Event()
+    out = _QueueWriter(q, stop)
+
+    def produce():
+        try:
+            _write_snapshot(book_id, out, embeddings)
+            print(f"[OK] Snapshot exportado: {book_id}")
+        except _ExportAborted:
+            print(f"[INFO] Exportação de {book_id} interrompida (cliente desconectou)")
+        except Exception as e:
+            print(f"[ERROR] Exportação de {book_id} falhou: {e}")
+            try:
+                out.put(e)
+            except _ExportAborted:
+                pass
+
+    async def body():
+        threading.Thread(target=produce, name=f"export-{book_id}", daemon=True).start()
+        try:
+            while True:
+                item = await run_in_threadpool(q.get)
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item    # corta a resposta: o cliente recebe um .tar.gz incompleto (gzip inválido)
+                yield item
+        finally:
+            stop.set()    # cliente saiu: a thread para no próximo bloco
+
+    filename = f"{book_id}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tar.gz"
+    return StreamingResponse(body(), media_type="application/gzip",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+def _restore_chroma(book_id: str, src_book: str, lines, written: List[str]) -> int:
+    """Grava os registros do Chroma do snapshot; os ids gravados vão para `written` (para desfazer)."""
+    if not (CHROMA_AVAILABLE and HAVE_CHROMA_CLIENT and COLLECTION):
+        return 0
+    restored = 0
+    batch: List[Dict] = []
+
+    def flush():
+        nonlocal restored
+        for with_emb in (True, False):
+            recs = [r for r in batch if ("embedding" in r) == with_emb]
+            if not recs:
+                continue
+            kwargs = {"embeddings": [r["embedding"] for r in recs]} if with_emb else {}
+            ids = [f"{book_id}:{r['id'][len(src_book) + 1:]}" if r["id"].startswith(f"{src_book}:") else r["id"]
+                   for r in recs]
+            written.extend(ids)
+            COLLECTION.upsert(
+                ids=ids,
+                documents=[r["document"] for r in recs],
+                metadatas=[{**(r["metadata"] or {}), "book_id": book_id} for r in recs],
+                **kwargs,
+            )
+            restored += len(recs)
+        batch.clear()
+
+    for line in lines:
+        if line.strip():
+            batch.append(json.loads(line))
+            if len(batch) >= _SNAPSHOT_CHROMA_PAGE:
+                flush()
+    flush()
+    return restored
+
+def _restore_snapshot(book_id: str, fileobj) -> Dict:
+    """
+    Restaura um .tar.gz de /books/{id}/export em `book_id` (lido em sequência, membro a membro).
+    Se falhar no meio, o que já foi gravado é desfeito: o livro volta ao estado anterior (sem
+    capítulos), e uma nova tentativa não esbarra no 409.
+    """
+    files = {}
+    for path in (_book_meta_path(book_id), _summary_tree_path(book_id), entity_index._path(book_id),
+                 chapter_order._path(book_id)):
+        try:
+            with open(path, "rb") as f:
+                files[path] = f.read()
+        except FileNotFoundError:
+            files[path] = None
+    written = {"chapters": [], "artifacts": [], "chroma": []}
+    try:
+        return _restore_snapshot_members(book_id, fileobj, written)
+    except BaseException:
+        _undo_restore(book_id, files, written)
+        raise
+
+def _undo_restore(book_id: str, files: Dict[str, Optional[bytes]], written: Dict[str, List]):
+    """Apaga capítulos, sugestões/críticas, revisões, índices e registros do Chroma de um restore que falhou."""
+    try:
+        for cid in written["chapters"]:
+            STORAGE.delete_chapter(book_id, cid)
+            HISTORY.forget(book_id, cid)
+            if SEARCH_INDEX is not None:
+                try:
+                    SEARCH_INDEX.delete(book_id, cid)
+                except (SearchUnavailableError, sqlite3.Error):
+                    pass   # o próximo /search/{book_id}/reindex limpa
+        for kind, artifact_id in written["artifacts"]:
+            STORAGE.delete_artifact(book_id, kind, artifact_id)
+        context_packs.drop_book(book_id)
+        vector_index.drop_index(book_id)
+        for path, data in files.items():
+            if data is not None:
+                with open(path, "wb") as f:
+                    f.write(data)
+            elif os.path.exists(path):
+                os.remove(path)
+        if written["chroma"]:
+            COLLECTION.delete(ids=written["chroma"])
+        print(f"[INFO] Restore de {book_id} desfeito ({len(written['chapters'])} capítulo(s) removido(s))")
+    except Exception as e:
+        print(f"[ERROR] Não foi possível desfazer o restore de {book_id}: {e}")
+
+def _restore_snapshot_members(book_id: str, fileobj, written: Dict[str, List]) -> Dict:
+    manifest = None
+    chapters: List[Dict] = []
+    errors: List[str] = []
+    restored = {"suggestions": 0, "critiques": 0, "summaries": 0, "entities": 0, "chroma": 0, "vectors": 0}
+    order: List[str] = []
+    vmeta = assign = centroids = None
+
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for m in tar:
+            if not m.isfile():
+                continue
+            f = tar.extractfile(m)
+            if manifest is None:
+                if m.name != "manifest.json":
+                    raise ValueError("manifest.json precisa ser o primeiro arquivo")
+                manifest = json.load(f)
+                if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version", 0) > SNAPSHOT_VERSION:
+                    raise ValueError(f"formato não suportado: {manifest.get('format')} v{manifest.get('version')}")
+                continue
+            src_book = manifest["book_id"]
+
+            if m.name == "book.json":
+                meta = {**json.load(f), "id": book_id}
+                os.makedirs(BOOKS_DIR, exist_ok=True)
+                with open(_book_meta_path(book_id), "w", encoding="utf-8") as out:
+                    json.dump(meta, out, ensure_ascii=False, indent=2)
+            elif m.name == "summaries.json":
+                tree = {**json.load(f), "book_id": book_id}
+                with _summary_tree_lock(book_id):
+                    _save_summary_tree(tree)
+                restored["summaries"] = len(tree.get("chapters", {}))
+            elif m.name == "entities.json":
+                index = json.load(f)
+                entity_index.restore(book_id, index)
+                restored["entities"] = len(index.get("entities", {}))
+            elif m.name == "order.json":
+                order = json.load(f).get("order", [])
+            elif m.name == "chroma.jsonl":
+                restored["chroma"] = _restore_chroma(book_id, src_book, f, written["chroma"])
+            elif m.name == "vectors/meta.json":
+                vmeta = json.load(f)
+            elif m.name == "vectors/assign.npy":
+                assign = np.load(io.BytesIO(f.read()))
+            elif m.name == "vectors/centroids.npy":
+                centroids = np.load(io.BytesIO(f.read()))
+            elif m.name == "vectors/vectors.f16":
+                if vmeta is None or assign is None:
+                    raise ValueError("vectors.f16 antes de vectors/meta.json e assign.npy")
+                # os capítulos já foram gravados: o índice passa a valer para os arquivos novos
+                stamps = STORAGE.chapter_stamps(book_id)
+                for cid in list(vmeta["chapters"]):
+                    if cid in stamps:
+                        vmeta["chapters"][cid]["stamp"] = stamps[cid]
+                    else:
+                        assign[np.asarray(vmeta["chapters"].pop(cid)["rows"], dtype=np.int64)] = -1
+                idx = vector_index.restore(book_id, vmeta, assign, centroids, f, m.size)
+                restored["vectors"] = idx.live_rows()
+            else:
+                match = _SNAPSHOT_MEMBER.match(m.name)
+                if not match or match.group(2).startswith("."):
+                    errors.append(f"{m.name}: ignorado")
+                    continue
+                kind, stem = _SNAPSHOT_KINDS[match.group(1)], match.group(2)
+                content = f.read().decode("utf-8")
+                if kind == "chapter":
+                    if not _valid_chapter_id(stem):
+                        errors.append(f"{m.name}: chapter_id inválido")
+                        continue
+                    title, text = split_title(content)
+                    written["chapters"].append(stem)
+                    save_chapter(book_id, stem, title, text, index_vectors=False, source="snapshot")
+                    chapters.append({"chapter_id": stem, "title": title, "chars": len(text)})
+                else:
+                    title, _, artifact_id = stem.rpartition("__")
+                    artifact_id = artifact_id or uuid.uuid4().hex[:8]
+                    written["artifacts"].append((kind, artifact_id))
+                    STORAGE.save_artifact(book_id, kind, artifact_id, title or stem,
+                                          content, chapter_id=manifest.get("artifact_chapters", {}).get(m.name))
+                    restored[match.group(1)] += 1
+
+    if manifest is None:
+        raise ValueError("arquivo vazio")
+    if order:
+        chapter_order.set_order(book_id, [c for c in order if c in {ch["chapter_id"] for ch in chapters}],
+                                _chapter_mtimes(book_id))
+    print(f"[OK] Snapshot de {manifest['book_id']} restaurado em {book_id}: {len(chapters)} capítulo(s), "
+          f"{restored['vectors']} vetores, {restored['chroma']} registros no Chroma")
+    return {"chapters": chapters, "errors": errors, "restored": restored, "source_book_id": manifest["book_id"]}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,181 @@
+"""
+Índice de busca textual dos capítulos (SQLite FTS5) para o motor fs.
+
+Com STORAGE_ENGINE=sqlite a busca usa o documents_fts do próprio storage.db (mesmo tokenizer, mesmo
+formato de resultado via format_results) e este índice não é criado.
+
+- tokenização unicode61 com remove_diacritics 2: "agua" encontra "água", "Farol" encontra "farol"
+- consultas: palavras soltas (todas obrigatórias), "frases entre aspas", prefixo com * (farol*)
+- atualizado a cada save/update/expand-save; livros antigos são indexados na primeira busca
+"""
+import os
+import re
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", os.path.join(DATA_DIR, "search.db"))
+
+# Marcadores de destaque (caracteres de controle que não aparecem em texto normal)
+HL_OPEN, HL_CLOSE = "\x02", "\x03"
+MAX_OFFSETS = 50
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chapters_fts USING fts5(
+    book_id UNINDEXED, chapter_id UNINDEXED, title, body,
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS indexed_books (
+    book_id     TEXT PRIMARY KEY,
+    indexed_at  REAL NOT NULL
+);
+"""
+
+
+class SearchUnavailableError(RuntimeError):
+    pass
+
+
+def fts_query(query: str) -> str:
+    """Texto do usuário → consulta FTS5 segura. Cada termo vira uma string entre aspas."""
+    terms = []
+    for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query):
+        if phrase:
+            terms.append('"' + phrase.replace('"', "").strip() + '"')
+            continue
+        prefix = word.endswith("*")
+        w = word.rstrip("*").replace('"', "").strip()
+        if w:
+            terms.append(f'"{w}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def _strip_marks(marked: str) -> Tuple[str, List[List[int]]]:
+    """Remove os marcadores e devolve (texto, [[início, fim], ...]) dos trechos destacados."""
+    out, spans, start = [], [], None
+    pos = 0
+    for ch in marked:
+        if ch == HL_OPEN:
+            start = pos
+        elif ch == HL_CLOSE:
+            if start is not None:
+                spans.append([start, pos])
+            start = None
+        else:
+            out.append(ch)
+            pos += 1
+    return "".join(out), spans
+
+
+def format_results(rows, with_offsets: bool) -> List[Dict]:
+    """
+    Linhas (chapter_id, title, score, snip, marked) de uma consulta FTS5 → resultados da API.
+    snip/marked vêm com os marcadores HL_OPEN/HL_CLOSE; marked (o texto inteiro destacado) só
+    quando with_offsets.
+    """
+    results = []
+    for r in rows:
+        snippet, highlights = _strip_marks(r["snip"])
+        item = {
+            "chapter_id": r["chapter_id"],
+            "title": r["title"],
+            "score": round(-r["score"], 4),   # bm25: menor é melhor → invertido
+            "snippet": snippet,
+            "highlights": highlights,          # [início, fim] dentro do snippet
+        }
+        if with_offsets:
+            _, offsets = _strip_marks(r["marked"])
+            item["match_count"] = len(offsets)
+            item["offsets"] = offsets[:MAX_OFFSETS]   # [início, fim] no texto do capítulo
+        results.append(item)
+    return results
+
+
+class SearchIndex:
+    def __init__(self, db_path: str = SEARCH_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.available = True
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        try:
+            conn = self._conn()
+            conn.executescript(_SCHEMA)
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f"[WARN] Busca textual desativada (SQLite sem FTS5?): {e}")
+            self.available = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def _require(self):
+        if not self.available:
+            raise SearchUnavailableError("Busca textual indisponível (SQLite sem FTS5)")
+
+    # ------------------------------------------------------------------
+    # escrita
+    # ------------------------------------------------------------------
+    def upsert(self, book_id: str, chapter_id: str, title: str, text: str):
+        self._require()
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM chapters_fts WHERE book_id = ? AND chapter_id = ?", (book_id, chapter_id))
+            conn.execute("INSERT INTO chapters_fts (book_id, chapter_id, title, body) VALUES (?, ?, ?, ?)",
+                         (book_id, chapter_id, title, text))
+
+    def delete(self, book_id: str, chapter_id: str):
+        self._require()
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM chapters_fts WHERE book_id = ? AND chapter_id = ?", (book_id, chapter_id))
+
+    def is_indexed(self, book_id: str) -> bool:
+        self._require()
+        return self._conn().execute("SELECT 1 FROM indexed_books WHERE book_id = ?", (book_id,)).fetchone() is not None
+
+    def rebuild_book(self, book_id: str, chapters: List[Dict]) -> int:
+        """Reindexa o livro inteiro a partir de [{id, title, text}] (uma transação)."""
+        self._require()
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM chapters_fts WHERE book_id = ?", (book_id,))
+            conn.executemany(
+                "INSERT INTO chapters_fts (book_id, chapter_id, title, body) VALUES (?, ?, ?, ?)",
+                [(book_id, ch["id"], ch["title"], ch["text"]) for ch in chapters],
+            )
+            conn.execute("INSERT OR REPLACE INTO indexed_books (book_id, indexed_at) VALUES (?, ?)",
+                         (book_id, time.time()))
+        return len(chapters)
+
+    # ------------------------------------------------------------------
+    # leitura
+    # ------------------------------------------------------------------
+    def search(self, book_id: str, query: str, page: int = 1, page_size: int = 20,
+               snippet_tokens: int = 24, with_offsets: bool = False) -> Dict:
+        self._require()
+        match = fts_query(query)
+        if not match:
+            return {"total": 0, "page": page, "page_size": page_size, "results": []}
+        conn = self._conn()
+        where = "chapters_fts MATCH ? AND book_id = ?"
+        total = conn.execute(f"SELECT COUNT(*) FROM chapters_fts WHERE {where}", (match, book_id)).fetchone()[0]
+        rows = conn.execute(
+            f"""SELECT chapter_id, title, bm25(chapters_fts, 0, 0, 2.0, 1.0) AS score,
+                       snippet(chapters_fts, 3, ?, ?, '…', ?) AS snip,
+                       {"highlight(chapters_fts, 3, ?, ?)" if with_offsets else "NULL"} AS marked
+                FROM chapters_fts WHERE {where}
+                ORDER BY score LIMIT ? OFFSET ?""",
+            (HL_OPEN, HL_CLOSE, snippet_tokens,
+             *((HL_OPEN, HL_CLOSE) if with_offsets else ()),
+             match, book_id, page_size, (page - 1) * page_size),
+        ).fetchall()
+        return {"total": total, "page": page, "page_size": page_size, "results": format_results(rows, with_offsets)}
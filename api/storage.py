@@ -0,0 +1,629 @@
+"""
+Armazenamento de capítulos, sugestões e críticas em disco.
+
+Layout por livro (atual):
+    /data/chapters/<book_id>/chapters/<chapter_id>.md
+    /data/chapters/<book_id>/suggestions/<titulo>__<id>.md
+    /data/chapters/<book_id>/critiques/<titulo>__<id>.md
+
+Layout plano (legado), ainda lido enquanto a migração não termina:
+    /data/chapters/<book_id>__<chapter_id>.md
+    /data/chapters/sugest_<titulo>__<id>.md
+    /data/chapters/critica_<titulo>__<id>.md
+
+Motores (STORAGE_ENGINE):
+    fs      — só os arquivos .md acima (padrão)
+    sqlite  — /data/storage.db (WAL, índices por livro/capítulo/tipo/data, FTS5);
+              os .md continuam sendo gravados como exportação
+
+Migração online (pode rodar com a API no ar):
+    python storage.py migrate [--dry-run]
+"""
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from search_index import fts_query, format_results, HL_OPEN, HL_CLOSE
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+CHAPTER_DIR = os.path.join(DATA_DIR, "chapters")
+STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "fs").lower()
+STORAGE_DB_PATH = os.getenv("STORAGE_DB_PATH", os.path.join(DATA_DIR, "storage.db"))
+
+KINDS = {
+    "chapter": "chapters",
+    "suggestion": "suggestions",
+    "critique": "critiques",
+}
+_LEGACY_PREFIX = {"suggestion": "sugest_", "critique": "critica_"}
+_LEGACY_CHAPTER = re.compile(r"^(.+?)__([^.]+)\.md$")
+_LEGACY_BOOK_LINE = re.compile(r"^\*\*Livro:\*\*\s*(.+?)\s*$")
+UNASSIGNED_BOOK = "_sem_livro"
+
+
+def safe_title(title: str) -> str:
+    return title.replace(' ', '_').replace(':', '_').replace('/', '_').replace('\\', '_')
+
+
+def split_title(content: str) -> Tuple[str, str]:
+    """'# Título' na primeira linha → (título, texto)."""
+    title = "Capítulo"
+    first = content.splitlines()[0] if content else ""
+    if first.startswith("# "):
+        return first[2:].strip(), content[len(first):].lstrip()
+    return title, content
+
+
+def _first_line_title(path: str) -> str:
+    """Título = primeira linha '# ' ou 1ª linha não vazia (sem ler o arquivo inteiro)."""
+    with open(path, "r", encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.strip()
+            if ln:
+                return ln[2:].strip() if ln.startswith("# ") else (ln[:120] or "Capítulo")
+    return "Capítulo"
+
+
+class FileStorage:
+    """Um diretório por livro; cada listagem só enxerga os arquivos daquele livro."""
+
+    def __init__(self, root: str = CHAPTER_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self.legacy_present = self._scan_legacy()
+
+    # ------------------------------------------------------------------
+    # caminhos
+    # ------------------------------------------------------------------
+    def _kind_dir(self, book_id: str, kind: str) -> str:
+        return os.path.join(self.root, book_id, KINDS[kind])
+
+    def chapter_path(self, book_id: str, chapter_id: str) -> str:
+        return os.path.join(self._kind_dir(book_id, "chapter"), f"{chapter_id}.md")
+
+    def _legacy_chapter_path(self, book_id: str, chapter_id: str) -> str:
+        return os.path.join(self.root, f"{book_id}__{chapter_id}.md")
+
+    def _scan_legacy(self) -> bool:
+        """Há arquivos .md soltos na raiz? (uma única leitura de diretório)"""
+        try:
+            with os.scandir(self.root) as it:
+                return any(e.is_file() and e.name.endswith(".md") for e in it)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _list_md(directory: str) -> List[os.DirEntry]:
+        try:
+            with os.scandir(directory) as it:
+                return [e for e in it if e.is_file() and e.name.endswith(".md")]
+        except FileNotFoundError:
+            return []
+
+    # ------------------------------------------------------------------
+    # livros / capítulos
+    # ------------------------------------------------------------------
+    def list_books(self) -> List[str]:
+        books = set()
+        with os.scandir(self.root) as it:
+            for e in it:
+                if e.is_dir() and not e.name.startswith((".", "_")):
+                    books.add(e.name)
+                elif self.legacy_present and e.is_file() and "__" in e.name \
+                        and not e.name.startswith(tuple(_LEGACY_PREFIX.values())):
+                    books.add(e.name.split("__", 1)[0])
+        return sorted(books)
+
+    def _chapter_files(self, book_id: str) -> List[Dict]:
+        """[{id, path, mtime, size}] ordenado por id; não lê o conteúdo."""
+        found: Dict[str, Dict] = {}
+        if self.legacy_present:
+            for e in self._list_md(self.root):
+                m = _LEGACY_CHAPTER.match(e.name)
+                if m and m.group(1) == book_id and not e.name.startswith(tuple(_LEGACY_PREFIX.values())):
+                    st = e.stat()
+                    found[m.group(2)] = {"id": m.group(2), "path": e.path, "mtime": st.st_mtime, "size": st.st_size}
+        for e in self._list_md(self._kind_dir(book_id, "chapter")):
+            st = e.stat()
+            cid = e.name[:-3]
+            found[cid] = {"id": cid, "path": e.path, "mtime": st.st_mtime, "size": st.st_size}
+        return [found[cid] for cid in sorted(found)]
+
+    def list_chapters(self, book_id: str, with_text: bool = False) -> List[Dict]:
+        """[{id, title, path, mtime, size, text?}] ordenado por id."""
+        out = []
+        for ch in self._chapter_files(book_id):
+            try:
+                if with_text:
+                    with open(ch["path"], "r", encoding="utf-8") as f:
+                        title, text = split_title(f.read())
+                    out.append({**ch, "title": title, "text": text})
+                else:
+                    out.append({**ch, "title": _first_line_title(ch["path"])})
+            except FileNotFoundError:
+                continue  # movido/removido no meio da listagem
+            except (OSError, UnicodeDecodeError) as e:
+                # um arquivo ilegível não derruba a listagem do livro inteiro
+                print(f"[WARN] Capítulo ignorado ({ch['path']}): {e}")
+        return out
+
+    def list_chapter_ids(self, book_id: str) -> List[str]:
+        return [c["id"] for c in self._chapter_files(book_id)]
+
+    def chapter_stamps(self, book_id: str) -> Dict[str, str]:
+        """{chapter_id: "mtime:tamanho"} — detecta capítulos alterados sem ler o conteúdo."""
+        return {c["id"]: f"{c['mtime']:.6f}:{c['size']}" for c in self._chapter_files(book_id)}
+
+    def locate_chapter(self, book_id: str, chapter_id: str) -> Optional[str]:
+        # sharded → legado → sharded de novo (o migrador pode ter movido o arquivo no meio)
+        for path in (self.chapter_path(book_id, chapter_id),
+                     self._legacy_chapter_path(book_id, chapter_id),
+                     self.chapter_path(book_id, chapter_id)):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def read_chapter_raw(self, book_id: str, chapter_id: str) -> Optional[str]:
+        path = self.locate_chapter(book_id, chapter_id)
+        if not path:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            path = self.locate_chapter(book_id, chapter_id)
+            if not path:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+
+    def read_chapter(self, book_id: str, chapter_id: str) -> Optional[Dict]:
+        content = self.read_chapter_raw(book_id, chapter_id)
+        if content is None:
+            return None
+        title, text = split_title(content)
+        return {"title": title, "text": text, "path": self.locate_chapter(book_id, chapter_id) or self.chapter_path(book_id, chapter_id)}
+
+    def write_chapter(self, book_id: str, chapter_id: str, title: str, text: str) -> str:
+        path = self.chapter_path(book_id, chapter_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(f"# {title}\n\n{text}\n")
+        os.replace(tmp, path)
+        # capítulo legado regravado → passa a existir só no layout novo
+        legacy = self._legacy_chapter_path(book_id, chapter_id)
+        if self.legacy_present and os.path.exists(legacy):
+            os.remove(legacy)
+        return path
+
+    def delete_chapter(self, book_id: str, chapter_id: str) -> bool:
+        removed = False
+        for path in (self.chapter_path(book_id, chapter_id), self._legacy_chapter_path(book_id, chapter_id)):
+            if os.path.exists(path):
+                os.remove(path)
+                removed = True
+        return removed
+
+    # ------------------------------------------------------------------
+    # sugestões / críticas
+    # ------------------------------------------------------------------
+    def save_artifact(self, book_id: str, kind: str, artifact_id: str, title: str, content: str,
+                      chapter_id: Optional[str] = None) -> str:
+        directory = self._kind_dir(book_id, kind)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{safe_title(title)}__{artifact_id}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    def delete_artifact(self, book_id: str, kind: str, artifact_id: str) -> bool:
+        removed = False
+        for e in self._list_md(self._kind_dir(book_id, kind)):
+            if e.name.endswith(f"__{artifact_id}.md"):
+                os.remove(e.path)
+                removed = True
+        return removed
+
+    def list_artifacts(self, book_id: str, kind: str, chapter_id: Optional[str] = None,
+                       limit: Optional[int] = None) -> List[Dict]:
+        """Mais recentes primeiro. No layout de arquivos o capítulo de origem não é conhecido (chapter_id ignorado)."""
+        out = []
+        for e in self._list_md(self._kind_dir(book_id, kind)):
+            st = e.stat()
+            out.append({"id": e.name[:-3].rsplit("__", 1)[-1], "file": e.name, "path": e.path, "mtime": st.st_mtime})
+        if self.legacy_present:
+            prefix = _LEGACY_PREFIX[kind]
+            for e in self._list_md(self.root):
+                if e.name.startswith(prefix) and _legacy_artifact_book(e.path) == book_id:
+                    st = e.stat()
+                    out.append({"id": e.name[:-3].rsplit("__", 1)[-1], "file": e.name, "path": e.path, "mtime": st.st_mtime})
+        out = sorted(out, key=lambda a: a["mtime"], reverse=True)
+        return out[:limit] if limit else out
+
+    def read_artifact(self, path: str) -> str:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def search(self, book_id: str, query: str, kinds: Optional[List[str]] = None, limit: int = 20) -> List[Dict]:
+        """Busca por substring (varredura); o motor sqlite usa FTS5."""
+        q = query.lower()
+        hits = []
+        for kind in kinds or list(KINDS):
+            items = self.list_chapters(book_id, with_text=True) if kind == "chapter" else self.list_artifacts(book_id, kind)
+            for it in items:
+                body = it["text"] if kind == "chapter" else self.read_artifact(it["path"])
+                pos = body.lower().find(q)
+                if pos >= 0:
+                    hits.append({"kind": kind, "id": it["id"], "title": it.get("title", it.get("file")),
+                                 "snippet": body[max(0, pos - 60): pos + len(q) + 60]})
+                    if len(hits) >= limit:
+                        return hits
+        return hits
+
+    def counts(self, book_id: str) -> Dict[str, int]:
+        return {
+            "chapters": len(self._chapter_files(book_id)),
+            "suggestions": len(self.list_artifacts(book_id, "suggestion")),
+            "critiques": len(self.list_artifacts(book_id, "critique")),
+        }
+
+    # ------------------------------------------------------------------
+    # migração plano → por livro
+    # ------------------------------------------------------------------
+    def migrate(self, dry_run: bool = False) -> Dict:
+        """Move os arquivos soltos da raiz para o layout por livro (os.replace, atômico)."""
+        report = {"moved": 0, "skipped": 0, "conflicts": 0, "dry_run": dry_run, "books": {}}
+        for e in self._list_md(self.root):
+            kind, book_id, target_name = None, None, None
+            for k, prefix in _LEGACY_PREFIX.items():
+                if e.name.startswith(prefix):
+                    kind = k
+                    book_id = _legacy_artifact_book(e.path) or UNASSIGNED_BOOK
+                    target_name = e.name[len(prefix):]
+                    break
+            if kind is None:
+                m = _LEGACY_CHAPTER.match(e.name)
+                if not m:
+                    report["skipped"] += 1
+                    continue
+                kind, book_id, target_name = "chapter", m.group(1), f"{m.group(2)}.md"
+
+            target = os.path.join(self._kind_dir(book_id, kind), target_name)
+            report["books"][book_id] = report["books"].get(book_id, 0) + 1
+            if dry_run:
+                report["moved"] += 1
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.exists(target):
+                # já regravado no layout novo: fica o mais recente
+                report["conflicts"] += 1
+                if os.path.getmtime(target) >= e.stat().st_mtime:
+                    os.remove(e.path)
+                    continue
+            os.replace(e.path, target)
+            report["moved"] += 1
+        if not dry_run:
+            self.legacy_present = self._scan_legacy()
+        report["legacy_remaining"] = self.legacy_present if not dry_run else True
+        return report
+
+
+def _legacy_artifact_book(path: str) -> Optional[str]:
+    """Sugestões/críticas antigas não têm o livro no nome; ele está na linha '**Livro:** <id>'."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for _ in range(8):
+                line = f.readline()
+                if not line:
+                    break
+                m = _LEGACY_BOOK_LINE.match(line.strip())
+                if m:
+                    return m.group(1)
+    except OSError:
+        pass
+    return None
+
+
+# ========================
+# Motor SQLite
+# ========================
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id          INTEGER PRIMARY KEY,
+    book_id     TEXT NOT NULL,
+    kind        TEXT NOT NULL,            -- chapter | suggestion | critique
+    doc_id      TEXT NOT NULL,            -- chapter_id do capítulo ou id da sugestão/crítica
+    chapter_id  TEXT,                     -- capítulo a que o documento se refere
+    title       TEXT NOT NULL DEFAULT '',
+    body        TEXT NOT NULL DEFAULT '',
+    md_path     TEXT,                     -- exportação .md correspondente
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL,
+    UNIQUE (book_id, kind, doc_id)
+);
+CREATE INDEX IF NOT EXISTS idx_documents_book_kind_created ON documents (book_id, kind, created_at);
+CREATE INDEX IF NOT EXISTS idx_documents_book_chapter ON documents (book_id, chapter_id);
+CREATE INDEX IF NOT EXISTS idx_documents_kind_created ON documents (kind, created_at);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    title, body, content='documents', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts(documents_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_au AFTER UPDATE ON documents BEGIN
+    INSERT INTO documents_fts(documents_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+    INSERT INTO documents_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+END;
+"""
+
+
+class SQLiteStorage:
+    """
+    Um banco SQLite (WAL) para capítulos, sugestões e críticas.
+    Listagem/busca viram consultas indexadas; os .md continuam sendo exportados via FileStorage.
+    """
+
+    def __init__(self, db_path: str = STORAGE_DB_PATH, export: Optional[FileStorage] = None):
+        self.db_path = db_path
+        self.export = export or FileStorage(CHAPTER_DIR)
+        self.root = self.export.root
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        try:
+            conn.executescript(_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"[WARN] SQLite sem FTS5 ({e}); busca cai em LIKE")
+            self.fts = False
+        conn.commit()
+        if conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 0:
+            n = self.import_files()
+            if n:
+                print(f"[OK] {n} documento(s) importado(s) dos .md para {db_path}")
+
+    @property
+    def legacy_present(self) -> bool:
+        return self.export.legacy_present
+
+    def _conn(self) -> sqlite3.Connection:
+        # Uma conexão por thread (FastAPI roda endpoints síncronos num pool de threads)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def _upsert(self, book_id: str, kind: str, doc_id: str, chapter_id: Optional[str],
+                title: str, body: str, md_path: Optional[str], created_at: Optional[float] = None):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                """INSERT INTO documents (book_id, kind, doc_id, chapter_id, title, body, md_path, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (book_id, kind, doc_id) DO UPDATE SET
+                       chapter_id = excluded.chapter_id, title = excluded.title, body = excluded.body,
+                       md_path = excluded.md_path, updated_at = excluded.updated_at""",
+                (book_id, kind, doc_id, chapter_id, title, body, md_path, created_at or now, now),
+            )
+
+    def import_files(self) -> int:
+        """Carrega no banco tudo o que já existe em disco (ambos os layouts)."""
+        n = 0
+        for book_id in self.export.list_books():
+            for ch in self.export.list_chapters(book_id, with_text=True):
+                self._upsert(book_id, "chapter", ch["id"], ch["id"], ch["title"], ch["text"], ch["path"], ch["mtime"])
+                n += 1
+            for kind in ("suggestion", "critique"):
+                for a in self.export.list_artifacts(book_id, kind):
+                    body = self.export.read_artifact(a["path"])
+                    self._upsert(book_id, kind, a["id"], None, split_title(body)[0], body, a["path"], a["mtime"])
+                    n += 1
+        return n
+
+    # ------------------------------------------------------------------
+    # livros / capítulos
+    # ------------------------------------------------------------------
+    def list_books(self) -> List[str]:
+        rows = self._conn().execute("SELECT DISTINCT book_id FROM documents WHERE kind = 'chapter' ORDER BY book_id")
+        return [r[0] for r in rows]
+
+    def list_chapters(self, book_id: str, with_text: bool = False) -> List[Dict]:
+        cols = "doc_id, title, md_path, updated_at, length(body) AS size" + (", body" if with_text else "")
+        rows = self._conn().execute(
+            f"SELECT {cols} FROM documents WHERE book_id = ? AND kind = 'chapter' ORDER BY doc_id", (book_id,)
+        ).fetchall()
+        out = []
+        for r in rows:
+            item = {"id": r["doc_id"], "title": r["title"], "path": r["md_path"], "mtime": r["updated_at"], "size": r["size"]}
+            if with_text:
+                item["text"] = r["body"]
+            out.append(item)
+        return out
+
+    def list_chapter_ids(self, book_id: str) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT doc_id FROM documents WHERE book_id = ? AND kind = 'chapter' ORDER BY doc_id", (book_id,))
+        return [r[0] for r in rows]
+
+    def chapter_stamps(self, book_id: str) -> Dict[str, str]:
+        rows = self._conn().execute(
+            "SELECT doc_id, updated_at, length(body) FROM documents WHERE book_id = ? AND kind = 'chapter'", (book_id,))
+        return {r[0]: f"{r[1]:.6f}:{r[2]}" for r in rows}
+
+    def chapter_path(self, book_id: str, chapter_id: str) -> str:
+        return self.export.chapter_path(book_id, chapter_id)
+
+    def locate_chapter(self, book_id: str, chapter_id: str) -> Optional[str]:
+        row = self._conn().execute(
+            "SELECT md_path FROM documents WHERE book_id = ? AND kind = 'chapter' AND doc_id = ?",
+            (book_id, chapter_id)).fetchone()
+        return row[0] if row else None
+
+    def read_chapter(self, book_id: str, chapter_id: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            "SELECT title, body, md_path FROM documents WHERE book_id = ? AND kind = 'chapter' AND doc_id = ?",
+            (book_id, chapter_id)).fetchone()
+        if not row:
+            return None
+        return {"title": row["title"], "text": row["body"], "path": row["md_path"]}
+
+    def read_chapter_raw(self, book_id: str, chapter_id: str) -> Optional[str]:
+        ch = self.read_chapter(book_id, chapter_id)
+        return f"# {ch['title']}\n\n{ch['text']}\n" if ch else None
+
+    def write_chapter(self, book_id: str, chapter_id: str, title: str, text: str) -> str:
+        path = self.export.write_chapter(book_id, chapter_id, title, text)
+        self._upsert(book_id, "chapter", chapter_id, chapter_id, title, text, path)
+        return path
+
+    def delete_chapter(self, book_id: str, chapter_id: str) -> bool:
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM documents WHERE book_id = ? AND kind = 'chapter' AND doc_id = ?",
+                               (book_id, chapter_id))
+        return self.export.delete_chapter(book_id, chapter_id) or cur.rowcount > 0
+
+    # ------------------------------------------------------------------
+    # sugestões / críticas
+    # ------------------------------------------------------------------
+    def save_artifact(self, book_id: str, kind: str, artifact_id: str, title: str, content: str,
+                      chapter_id: Optional[str] = None) -> str:
+        path = self.export.save_artifact(book_id, kind, artifact_id, title, content)
+        self._upsert(book_id, kind, artifact_id, chapter_id, title, content, path)
+        return path
+
+    def delete_artifact(self, book_id: str, kind: str, artifact_id: str) -> bool:
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM documents WHERE book_id = ? AND kind = ? AND doc_id = ?",
+                               (book_id, kind, artifact_id))
+        return self.export.delete_artifact(book_id, kind, artifact_id) or cur.rowcount > 0
+
+    def list_artifacts(self, book_id: str, kind: str, chapter_id: Optional[str] = None,
+                       limit: Optional[int] = None) -> List[Dict]:
+        sql = "SELECT doc_id, chapter_id, title, md_path, created_at FROM documents WHERE book_id = ? AND kind = ?"
+        args: list = [book_id, kind]
+        if chapter_id:
+            sql += " AND chapter_id = ?"
+            args.append(chapter_id)
+        sql += " ORDER BY created_at DESC"
+        if limit:
+            sql += " LIMIT ?"
+            args.append(int(limit))
+        return [
+            {"id": r["doc_id"], "chapter_id": r["chapter_id"], "title": r["title"],
+             "file": os.path.basename(r["md_path"] or ""), "path": r["md_path"], "mtime": r["created_at"]}
+            for r in self._conn().execute(sql, args)
+        ]
+
+    def read_artifact(self, path: str) -> str:
+        row = self._conn().execute("SELECT body FROM documents WHERE md_path = ?", (path,)).fetchone()
+        return row[0] if row else self.export.read_artifact(path)
+
+    def search(self, book_id: str, query: str, kinds: Optional[List[str]] = None, limit: int = 20) -> List[Dict]:
+        kinds = kinds or list(KINDS)
+        marks = ",".join("?" * len(kinds))
+        conn = self._conn()
+        if self.fts:
+            rows = conn.execute(
+                f"""SELECT d.kind, d.doc_id, d.title, snippet(documents_fts, 1, '[', ']', '…', 16) AS snippet
+                    FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid
+                    WHERE documents_fts MATCH ? AND d.book_id = ? AND d.kind IN ({marks})
+                    ORDER BY rank LIMIT ?""",
+                (fts_query(query), book_id, *kinds, limit)).fetchall()
+        else:
+            rows = conn.execute(
+                f"""SELECT kind, doc_id, title, substr(body, 1, 160) AS snippet FROM documents
+                    WHERE book_id = ? AND kind IN ({marks}) AND body LIKE ? LIMIT ?""",
+                (book_id, *kinds, f"%{query}%", limit)).fetchall()
+        return [{"kind": r["kind"], "id": r["doc_id"], "title": r["title"], "snippet": r["snippet"]} for r in rows]
+
+    def search_chapters(self, book_id: str, query: str, page: int = 1, page_size: int = 20,
+                        snippet_tokens: int = 24, with_offsets: bool = False) -> Dict:
+        """
+        Busca de /search/{book_id} direto no documents_fts (mesmo formato do SearchIndex.search):
+        com este motor não há um segundo índice para manter em dia.
+        """
+        match = fts_query(query)
+        if not match:
+            return {"total": 0, "page": page, "page_size": page_size, "results": []}
+        conn = self._conn()
+        where = "documents_fts MATCH ? AND d.book_id = ? AND d.kind = 'chapter'"
+        total = conn.execute(
+            f"SELECT COUNT(*) FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid WHERE {where}",
+            (match, book_id)).fetchone()[0]
+        rows = conn.execute(
+            f"""SELECT d.doc_id AS chapter_id, d.title, bm25(documents_fts, 2.0, 1.0) AS score,
+                       snippet(documents_fts, 1, ?, ?, '…', ?) AS snip,
+                       {"highlight(documents_fts, 1, ?, ?)" if with_offsets else "NULL"} AS marked
+                FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid WHERE {where}
+                ORDER BY score LIMIT ? OFFSET ?""",
+            (HL_OPEN, HL_CLOSE, snippet_tokens,
+             *((HL_OPEN, HL_CLOSE) if with_offsets else ()),
+             match, book_id, page_size, (page - 1) * page_size),
+        ).fetchall()
+        return {"total": total, "page": page, "page_size": page_size, "results": format_results(rows, with_offsets)}
+
+    def counts(self, book_id: str) -> Dict[str, int]:
+        rows = self._conn().execute(
+            "SELECT kind, COUNT(*) FROM documents WHERE book_id = ? GROUP BY kind", (book_id,)).fetchall()
+        by_kind = {r[0]: r[1] for r in rows}
+        return {"chapters": by_kind.get("chapter", 0),
+                "suggestions": by_kind.get("suggestion", 0),
+                "critiques": by_kind.get("critique", 0)}
+
+    def migrate(self, dry_run: bool = False) -> Dict:
+        """Reorganiza a exportação .md e atualiza os caminhos gravados no banco."""
+        report = self.export.migrate(dry_run=dry_run)
+        if not dry_run and report["moved"]:
+            conn = self._conn()
+            with conn:
+                for r in conn.execute("SELECT id, book_id, kind, doc_id, md_path FROM documents").fetchall():
+                    if r["md_path"] and os.path.exists(r["md_path"]):
+                        continue
+                    if r["kind"] == "chapter":
+                        path = self.export.chapter_path(r["book_id"], r["doc_id"])
+                    else:
+                        name = os.path.basename(r["md_path"] or "").removeprefix(_LEGACY_PREFIX[r["kind"]])
+                        path = os.path.join(self.export._kind_dir(r["book_id"], r["kind"]), name)
+                    if os.path.exists(path):
+                        conn.execute("UPDATE documents SET md_path = ? WHERE id = ?", (path, r["id"]))
+        return report
+
+
+def get_storage(engine: str = STORAGE_ENGINE, root: str = CHAPTER_DIR):
+    """Motor de armazenamento configurado em STORAGE_ENGINE (fs | sqlite)."""
+    export = FileStorage(root)
+    if engine == "sqlite":
+        return SQLiteStorage(STORAGE_DB_PATH, export=export)
+    if engine != "fs":
+        print(f"[WARN] STORAGE_ENGINE desconhecido: {engine!r}; usando 'fs'")
+    return export
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("uso: python storage.py migrate [--dry-run]")
+        sys.exit(2)
+    storage = get_storage()
+    print(json.dumps(storage.migrate(dry_run="--dry-run" in sys.argv), ensure_ascii=False, indent=2))
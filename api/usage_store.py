@@ -0,0 +1,162 @@
+"""
+Contabilidade de tokens do vLLM (SQLite) e cotas por livro/usuário.
+
+- uma linha por chamada ao vLLM: livro, usuário (header X-User), rota, operação, backend,
+  tokens de prompt e de resposta (o `usage` que o vLLM devolve; estimado se a geração foi abortada)
+- agregações por livro/rota/usuário/operação/hora/dia em qualquer janela de tempo
+- cotas: tokens por janela deslizante (QUOTA_WINDOW_S), padrão por env e exceções por livro/usuário
+  gravadas aqui mesmo; verificadas antes de cada chamada ao vLLM
+"""
+import os
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", os.path.join(DATA_DIR, "usage.db"))
+
+GROUP_COLUMNS = {
+    "book": "book_id",
+    "user": "user_id",
+    "endpoint": "endpoint",
+    "op": "op",
+    "backend": "backend",
+    "hour": "strftime('%Y-%m-%dT%H:00', ts, 'unixepoch', 'localtime')",
+    "day": "strftime('%Y-%m-%d', ts, 'unixepoch', 'localtime')",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id                 INTEGER PRIMARY KEY,
+    ts                 REAL NOT NULL,
+    book_id            TEXT NOT NULL DEFAULT '',
+    user_id            TEXT NOT NULL DEFAULT '',
+    endpoint           TEXT NOT NULL DEFAULT '',
+    op                 TEXT NOT NULL DEFAULT '',
+    backend            TEXT NOT NULL DEFAULT '',
+    prompt_tokens      INTEGER NOT NULL DEFAULT 0,
+    completion_tokens  INTEGER NOT NULL DEFAULT 0,
+    estimated          INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts);
+CREATE INDEX IF NOT EXISTS usage_book_ts ON usage (book_id, ts);
+CREATE INDEX IF NOT EXISTS usage_user_ts ON usage (user_id, ts);
+CREATE TABLE IF NOT EXISTS quotas (
+    scope   TEXT NOT NULL,      -- book | user
+    key     TEXT NOT NULL,
+    tokens  INTEGER NOT NULL,   -- 0 = sem limite
+    PRIMARY KEY (scope, key)
+);
+"""
+
+
+class UsageStore:
+    def __init__(self, db_path: str = USAGE_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # escrita
+    # ------------------------------------------------------------------
+    def record(self, book_id: str, user_id: str, endpoint: str, op: str, backend: str,
+               prompt_tokens: int, completion_tokens: int, estimated: bool = False):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO usage (ts, book_id, user_id, endpoint, op, backend, prompt_tokens, "
+                "completion_tokens, estimated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), book_id or "", user_id or "", endpoint or "", op, backend,
+                 int(prompt_tokens), int(completion_tokens), int(estimated)),
+            )
+
+    def set_quota(self, scope: str, key: str, tokens: Optional[int]):
+        """tokens=None remove a exceção (volta ao padrão); 0 = sem limite."""
+        conn = self._conn()
+        with conn:
+            if tokens is None:
+                conn.execute("DELETE FROM quotas WHERE scope = ? AND key = ?", (scope, key))
+            else:
+                conn.execute("INSERT OR REPLACE INTO quotas (scope, key, tokens) VALUES (?, ?, ?)",
+                             (scope, key, int(tokens)))
+
+    def purge(self, before: float) -> int:
+        conn = self._conn()
+        with conn:
+            return conn.execute("DELETE FROM usage WHERE ts < ?", (before,)).rowcount
+
+    # ------------------------------------------------------------------
+    # leitura
+    # ------------------------------------------------------------------
+    def quota_overrides(self) -> Dict[str, Dict[str, int]]:
+        out: Dict[str, Dict[str, int]] = {"book": {}, "user": {}}
+        for r in self._conn().execute("SELECT scope, key, tokens FROM quotas"):
+            out.setdefault(r["scope"], {})[r["key"]] = r["tokens"]
+        return out
+
+    def quota_override(self, scope: str, key: str) -> Optional[int]:
+        r = self._conn().execute("SELECT tokens FROM quotas WHERE scope = ? AND key = ?", (scope, key)).fetchone()
+        return r["tokens"] if r else None
+
+    def used(self, scope: str, key: str, since: float) -> int:
+        column = "book_id" if scope == "book" else "user_id"
+        r = self._conn().execute(
+            f"SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM usage WHERE {column} = ? AND ts >= ?",
+            (key, since),
+        ).fetchone()
+        return int(r[0])
+
+    def freed_at(self, scope: str, key: str, since: float, excess: int) -> Optional[float]:
+        """Momento (ts do registro) em que, saindo da janela, os tokens mais antigos liberam `excess`."""
+        column = "book_id" if scope == "book" else "user_id"
+        freed = 0
+        for r in self._conn().execute(
+                f"SELECT ts, prompt_tokens + completion_tokens AS t FROM usage WHERE {column} = ? AND ts >= ? ORDER BY ts",
+                (key, since)):
+            freed += r["t"]
+            if freed >= excess:
+                return r["ts"]
+        return None
+
+    def summary(self, group_by: List[str], since: Optional[float] = None, until: Optional[float] = None,
+                book_id: Optional[str] = None, user_id: Optional[str] = None,
+                endpoint: Optional[str] = None) -> List[Dict]:
+        where, params = [], []
+        for column, value in (("ts >=", since), ("ts <", until), ("book_id =", book_id),
+                              ("user_id =", user_id), ("endpoint =", endpoint)):
+            if value is not None:
+                where.append(f"{column} ?")
+                params.append(value)
+        cols = [f"{GROUP_COLUMNS[g]} AS {g}" for g in group_by] + [
+            "COUNT(*) AS calls", "SUM(prompt_tokens) AS prompt_tokens",
+            "SUM(completion_tokens) AS completion_tokens", "SUM(estimated) AS estimated_calls",
+        ]
+        sql = (
+            f"SELECT {', '.join(cols)} FROM usage"
+            + (f" WHERE {' AND '.join(where)}" if where else "")
+            + (f" GROUP BY {', '.join(GROUP_COLUMNS[g] for g in group_by)}" if group_by else "")
+            + " ORDER BY SUM(prompt_tokens + completion_tokens) DESC"
+        )
+        out = []
+        for r in self._conn().execute(sql, params):
+            row = dict(r)
+            row["prompt_tokens"] = row["prompt_tokens"] or 0
+            row["completion_tokens"] = row["completion_tokens"] or 0
+            row["estimated_calls"] = row["estimated_calls"] or 0
+            row["total_tokens"] = row["prompt_tokens"] + row["completion_tokens"]
+            out.append(row)
+        return [r for r in out if r["calls"]]
@@ -0,0 +1,451 @@
+"""
+Índice vetorial local por livro (caminho sem Chroma): vetores por trecho de capítulo + IVF.
+
+/data/vectors/<book_id>/
+    vectors.npy    — matriz [linhas, dim] float16 contígua; cabeçalho .npy fixo de 128 bytes para
+                     crescer no próprio arquivo (append). Aberta só para leitura com mmap: todos os
+                     workers do uvicorn compartilham a mesma cópia pelo page cache.
+    assign.npy     — lista IVF de cada linha (int32; -1 = linha apagada)
+    centroids.npy  — centróides IVF (só existe quando o livro tem linhas suficientes)
+    meta.json      — dim, nº de linhas, capítulos → linhas/trechos/assinatura
+
+Busca: produto interno (vetores normalizados) só nas listas IVF mais próximas da consulta
+(ou em tudo, se o livro é pequeno) e seleção top-k com np.argpartition.
+Capítulos apagados/regravados deixam lápides; a compactação reescreve o arquivo sem elas.
+"""
+import os
+import json
+import struct
+import threading
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+VECTOR_DIR = os.path.join(DATA_DIR, "vectors")
+
+CHUNK_CHARS = int(os.getenv("VECTOR_CHUNK_CHARS", "1200"))
+CHUNK_OVERLAP = int(os.getenv("VECTOR_CHUNK_OVERLAP", "200"))
+IVF_MIN_ROWS = int(os.getenv("VECTOR_IVF_MIN_ROWS", "512"))     # abaixo disso: busca exata
+IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "8"))
+COMPACT_RATIO = float(os.getenv("VECTOR_COMPACT_RATIO", "0.3"))  # fração de lápides que dispara compactação
+
+VECTOR_DTYPE = np.float16
+_NPY_HEADER_LEN = 128
+_SCORE_BLOCK_ROWS = 4096   # linhas convertidas para float32 por vez na busca (memória temporária limitada)
+
+Encoder = Callable[[List[str]], np.ndarray]   # textos → [n, dim] normalizado
+
+
+def chunk_spans(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+    """Trechos [início, fim) com sobreposição, cortando preferencialmente em fim de parágrafo/frase."""
+    if not text:
+        return [(0, 0)]
+    spans, start, n = [], 0, len(text)
+    while start < n:
+        end = min(n, start + size)
+        if end < n:
+            cut = max(text.rfind("\n", start + size // 2, end), text.rfind(". ", start + size // 2, end))
+            if cut > start:
+                end = cut + 1
+        spans.append((start, end))
+        if end >= n:
+            break
+        start = max(end - overlap, start + 1)
+    return spans
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Índices dos k maiores valores, ordenados (argpartition: O(n) em vez de ordenar tudo)."""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+def _npy_header(rows: int, dim: int) -> bytes:
+    """Cabeçalho .npy v1.0 com tamanho fixo: dá para reescrever o shape sem mover os dados."""
+    desc = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (np.dtype(VECTOR_DTYPE).str, rows, dim)
+    hlen = _NPY_HEADER_LEN - 10
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", hlen) + (desc.ljust(hlen - 1) + "\n").encode("latin1")
+
+
+def _kmeans(x: np.ndarray, nlist: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """k-means esférico (vetores normalizados) → centróides [nlist, dim]."""
+    rng = np.random.default_rng(seed)
+    c = x[rng.choice(len(x), size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        a = np.argmax(x @ c.T, axis=1)
+        for j in range(nlist):
+            members = x[a == j]
+            if len(members):
+                c[j] = members.sum(axis=0)
+            else:
+                c[j] = x[rng.integers(len(x))]
+        c /= np.linalg.norm(c, axis=1, keepdims=True) + 1e-12
+    return c.astype(np.float32)
+
+
+class VectorIndex:
+    def __init__(self, book_id: str, root: str = VECTOR_DIR):
+        self.book_id = book_id
+        self.dir = os.path.join(root, book_id)
+        self.lock = threading.Lock()
+        self._mtime = None
+        self._load()
+
+    # ------------------------------------------------------------------
+    # persistência
+    # ------------------------------------------------------------------
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.dir, "meta.json")
+
+    def _load(self):
+        try:
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+            self._mtime = os.path.getmtime(self._meta_path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.meta = {"dim": None, "rows": 0, "chapters": {}, "trained_rows": 0}
+            self._mtime = None
+        self.assign = self._load_npy("assign.npy", np.int32)
+        self.centroids = self._load_npy("centroids.npy", np.float32) if self.meta.get("trained_rows") else None
+        self._vectors = None
+        self._row_chapter = None
+        self._garbage: List[str] = []
+
+    def _load_npy(self, name: str, dtype) -> np.ndarray:
+        try:
+            return np.load(os.path.join(self.dir, name)).astype(dtype, copy=False)
+        except FileNotFoundError:
+            return np.empty(0, dtype=dtype)
+
+    def refresh(self):
+        """Recarrega se outro worker gravou o índice."""
+        try:
+            mtime = os.path.getmtime(self._meta_path)
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            self._load()
+
+    def _save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        np.save(os.path.join(self.dir, "assign.npy.tmp.npy"), self.assign)
+        os.replace(os.path.join(self.dir, "assign.npy.tmp.npy"), os.path.join(self.dir, "assign.npy"))
+        if self.centroids is not None:
+            np.save(os.path.join(self.dir, "centroids.npy.tmp.npy"), self.centroids)
+            os.replace(os.path.join(self.dir, "centroids.npy.tmp.npy"), os.path.join(self.dir, "centroids.npy"))
+        tmp = f"{self._meta_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self._meta_path)
+        self._mtime = os.path.getmtime(self._meta_path)
+        self._row_chapter = None
+        for path in self._garbage:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._garbage = []
+
+    @property
+    def _vectors_path(self) -> str:
+        # cada compactação grava um arquivo novo; o meta.json aponta para a geração atual
+        gen = self.meta.get("gen", 0) if hasattr(self, "meta") else 0
+        return os.path.join(self.dir, "vectors.npy" if not gen else f"vectors.{gen}.npy")
+
+    def vectors(self) -> np.ndarray:
+        """Matriz [linhas, dim] float16 mapeada em memória (somente leitura)."""
+        rows, dim = self.meta["rows"], self.meta["dim"]
+        if not rows:
+            return np.empty((0, dim or 0), dtype=VECTOR_DTYPE)
+        if self._vectors is None or self._vectors.shape[0] < rows:
+            self._vectors = np.load(self._vectors_path, mmap_mode="r")
+        # o cabeçalho pode estar à frente do meta.json (append interrompido): vale o meta
+        return self._vectors[:rows]
+
+    def _append_vectors(self, vecs: np.ndarray):
+        """Acrescenta linhas no fim do .npy e atualiza o shape no cabeçalho (mesmo tamanho)."""
+        os.makedirs(self.dir, exist_ok=True)
+        rows, dim = self.meta["rows"], self.meta["dim"]
+        expected = _NPY_HEADER_LEN + rows * dim * np.dtype(VECTOR_DTYPE).itemsize
+        mode = "r+b" if os.path.exists(self._vectors_path) else "w+b"
+        with open(self._vectors_path, mode) as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != expected:
+                f.truncate(expected)   # sobra de uma gravação interrompida antes do meta.json
+            f.seek(expected)
+            f.write(np.ascontiguousarray(vecs, dtype=VECTOR_DTYPE).tobytes())
+            f.seek(0)
+            f.write(_npy_header(rows + len(vecs), dim))
+        self.meta["rows"] += len(vecs)
+        self._vectors = None
+
+    def compact(self) -> int:
+        """Reescreve o .npy só com as linhas vivas e renumera capítulos/listas. Retorna linhas removidas."""
+        with self.lock:
+            self.refresh()
+            live = np.nonzero(self.assign >= 0)[0]
+            removed = self.meta["rows"] - len(live)
+            if removed <= 0:
+                return 0
+            self._rewrite(live)
+            self._save()
+            print(f"[OK] Índice vetorial compactado: {self.book_id} (-{removed} linhas)")
+            return removed
+
+    def _rewrite(self, keep: np.ndarray):
+        dim = self.meta["dim"]
+        new_row = np.full(self.meta["rows"], -1, dtype=np.int64)
+        new_row[keep] = np.arange(len(keep))
+        src = self.vectors()
+        old_path = self._vectors_path
+        self.meta["gen"] = self.meta.get("gen", 0) + 1
+        with open(self._vectors_path, "wb") as f:
+            f.write(_npy_header(len(keep), dim))
+            for i in range(0, len(keep), 65536):
+                f.write(np.ascontiguousarray(src[keep[i:i + 65536]], dtype=VECTOR_DTYPE).tobytes())
+        # o arquivo antigo só é apagado depois que o meta.json aponta para o novo; quem ainda o tem
+        # mapeado continua lendo o inode antigo até recarregar
+        self._garbage.append(old_path)
+        self.assign = self.assign[keep]
+        for ch in self.meta["chapters"].values():
+            ch["rows"] = [int(new_row[r]) for r in ch["rows"]]
+        self.meta["rows"] = len(keep)
+        self._vectors = None
+
+    def _maybe_compact(self):
+        rows = self.meta["rows"]
+        if rows and (rows - self.live_rows()) / rows > COMPACT_RATIO:
+            self._rewrite(np.nonzero(self.assign >= 0)[0])
+
+    # ------------------------------------------------------------------
+    # escrita
+    # ------------------------------------------------------------------
+    def signature(self, chapter_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """(hash do conteúdo, carimbo mtime/tamanho) gravados para o capítulo."""
+        ch = self.meta["chapters"].get(chapter_id)
+        return (ch["sig"], ch.get("stamp")) if ch else (None, None)
+
+    def touch(self, chapter_id: str, stamp: str):
+        """Conteúdo igual, arquivo regravado: só atualiza o carimbo (sem recalcular vetores)."""
+        with self.lock:
+            self.refresh()
+            if chapter_id in self.meta["chapters"]:
+                self.meta["chapters"][chapter_id]["stamp"] = stamp
+                self._save()
+
+    def upsert(self, chapter_id: str, title: str, text: str, sig: str, encode: Encoder,
+               stamp: Optional[str] = None):
+        """Troca os vetores do capítulo (linhas antigas viram lápides; as novas vão para o fim)."""
+        spans = chunk_spans(text)
+        vecs = np.asarray(encode([f"{title}\n{text[a:b]}" for a, b in spans]), dtype=np.float32)
+        with self.lock:
+            self.refresh()
+            if self.meta["dim"] not in (None, vecs.shape[1]):
+                raise ValueError(f"dimensão do índice {self.meta['dim']} ≠ modelo {vecs.shape[1]}; use rebuild")
+            self.meta["dim"] = vecs.shape[1]
+            self._tombstone(chapter_id)
+            first = self.meta["rows"]
+            self._append_vectors(vecs)
+            new_assign = (np.argmax(vecs @ self.centroids.T, axis=1).astype(np.int32)
+                          if self.centroids is not None else np.zeros(len(vecs), dtype=np.int32))
+            self.assign = np.concatenate([self.assign, new_assign])
+            self.meta["chapters"][chapter_id] = {
+                "title": title, "sig": sig, "stamp": stamp, "rows": list(range(first, first + len(vecs))),
+                "spans": [list(s) for s in spans],
+            }
+            self._maybe_compact()
+            self._maybe_train()
+            self._save()
+
+    def delete(self, chapter_id: str):
+        with self.lock:
+            self.refresh()
+            if self._tombstone(chapter_id):
+                self._maybe_compact()
+                self._save()
+
+    def _tombstone(self, chapter_id: str) -> bool:
+        old = self.meta["chapters"].pop(chapter_id, None)
+        if not old:
+            return False
+        self.assign[np.asarray(old["rows"], dtype=np.int64)] = -1
+        return True
+
+    def live_rows(self) -> int:
+        return int((self.assign >= 0).sum())
+
+    def _maybe_train(self):
+        """(Re)treina o IVF quando o livro passa do mínimo ou quadruplica desde o último treino."""
+        live = self.live_rows()
+        trained = self.meta.get("trained_rows", 0)
+        if live < IVF_MIN_ROWS or (trained and live < 4 * trained):
+            return
+        idx = np.nonzero(self.assign >= 0)[0]
+        vecs = np.asarray(self.vectors()[idx], dtype=np.float32)
+        sample = vecs if len(vecs) <= 20000 else vecs[np.random.default_rng(0).choice(len(vecs), 20000, replace=False)]
+        nlist = int(min(1024, max(8, np.sqrt(live))))
+        self.centroids = _kmeans(sample, nlist)
+        self.assign[idx] = np.argmax(vecs @ self.centroids.T, axis=1).astype(np.int32)
+        self.meta["trained_rows"] = live
+        print(f"[OK] IVF treinado para {self.book_id}: {nlist} listas, {live} vetores")
+
+    # ------------------------------------------------------------------
+    # leitura
+    # ------------------------------------------------------------------
+    def _row_to_chapter(self) -> Dict[int, Tuple[str, int]]:
+        if self._row_chapter is None:
+            self._row_chapter = {
+                row: (cid, i) for cid, ch in self.meta["chapters"].items() for i, row in enumerate(ch["rows"])
+            }
+        return self._row_chapter
+
+    def search(self, qv: np.ndarray, k: int = 8, nprobe: int = IVF_NPROBE, per_chapter: bool = True) -> List[Dict]:
+        """
+        Top-k por produto interno. per_chapter=True agrega por capítulo (melhor trecho de cada um).
+        Retorna [{chapter_id, title, score, span: [início, fim]}].
+        """
+        return self.search_batch(np.asarray(qv).reshape(1, -1), k=k, nprobe=nprobe, per_chapter=per_chapter)[0]
+
+    def search_batch(self, qvs: np.ndarray, k: int = 8, nprobe: int = IVF_NPROBE,
+                     per_chapter: bool = True) -> List[List[Dict]]:
+        """
+        Várias consultas de uma vez: um único produto de matrizes (candidatos × consultas).
+        Com IVF, os candidatos são a união das listas visitadas; o que fica fora das listas
+        de cada consulta é descartado só na hora de escolher o top-k dela.
+        """
+        self.refresh()
+        qvs = np.asarray(qvs, dtype=np.float32).reshape(len(qvs), -1)
+        if not self.meta["rows"] or not len(qvs):
+            return [[] for _ in range(len(qvs))]
+        if self.centroids is not None and len(self.centroids) > nprobe:
+            cs = qvs @ self.centroids.T                               # (consultas, listas)
+            probes = np.argpartition(-cs, nprobe - 1, axis=1)[:, :nprobe]
+            cand = np.nonzero(np.isin(self.assign, np.unique(probes)))[0]
+            masks = [np.isin(self.assign[cand], p) for p in probes]
+        else:
+            cand = np.nonzero(self.assign >= 0)[0]
+            masks = None
+        if cand.size == 0:
+            return [[] for _ in range(len(qvs))]
+        vecs = self.vectors()
+        scores = np.empty((cand.size, len(qvs)), dtype=np.float32)   # (candidatos, consultas)
+        for start in range(0, cand.size, _SCORE_BLOCK_ROWS):
+            block = cand[start:start + _SCORE_BLOCK_ROWS]
+            scores[start:start + block.size] = np.asarray(vecs[block], dtype=np.float32) @ qvs.T
+        out = []
+        for q in range(len(qvs)):
+            col = scores[:, q]
+            if masks is not None:
+                col = np.where(masks[q], col, -np.inf)
+            out.append(self._collect(col, cand, k, per_chapter))
+        return out
+
+    def _collect(self, scores: np.ndarray, cand: np.ndarray, k: int, per_chapter: bool) -> List[Dict]:
+        rows = self._row_to_chapter()
+        valid = int(np.isfinite(scores).sum())
+        # busca mais trechos do que k para sobrar k capítulos distintos depois de agregar
+        fetch = k * 4 if per_chapter else k
+        while True:
+            out, seen = [], set()
+            for j in top_k_indices(scores, min(fetch, valid)):
+                cid, chunk = rows.get(int(cand[j]), (None, None))
+                if cid is None or (per_chapter and cid in seen):
+                    continue
+                seen.add(cid)
+                ch = self.meta["chapters"][cid]
+                out.append({"chapter_id": cid, "title": ch["title"], "score": float(scores[j]),
+                            "span": ch["spans"][chunk]})
+                if len(out) >= k:
+                    return out
+            if fetch >= valid:
+                return out
+            fetch *= 4
+
+    def snapshot(self) -> Optional[Dict]:
+        """
+        Cópia consistente para exportação: {meta (JSON em bytes), assign, centroids, file, nbytes}, ou None se vazio.
+        `file` fica aberto no início das linhas: appends só escrevem depois delas e a compactação
+        grava outro arquivo, então dá para ler as `nbytes` sem segurar o lock.
+        """
+        with self.lock:
+            self.refresh()
+            rows, dim = self.meta["rows"], self.meta["dim"]
+            if not rows:
+                return None
+            f = open(self._vectors_path, "rb")
+            f.seek(_NPY_HEADER_LEN)
+            return {
+                "meta": json.dumps(self.meta).encode("utf-8"),
+                "assign": self.assign.copy(),
+                "centroids": None if self.centroids is None else self.centroids.copy(),
+                "file": f,
+                "nbytes": rows * dim * np.dtype(VECTOR_DTYPE).itemsize,
+            }
+
+    def stats(self) -> Dict:
+        self.refresh()
+        return {
+            "book_id": self.book_id,
+            "dim": self.meta["dim"],
+            "rows": self.meta["rows"],
+            "live_rows": self.live_rows(),
+            "chapters": len(self.meta["chapters"]),
+            "ivf_lists": 0 if self.centroids is None else len(self.centroids),
+            "dtype": np.dtype(VECTOR_DTYPE).name,
+            "bytes": self.meta["rows"] * (self.meta["dim"] or 0) * np.dtype(VECTOR_DTYPE).itemsize,
+        }
+
+
+_indexes: Dict[str, VectorIndex] = {}
+_indexes_guard = threading.Lock()
+
+
+def get_index(book_id: str) -> VectorIndex:
+    with _indexes_guard:
+        if book_id not in _indexes:
+            _indexes[book_id] = VectorIndex(book_id)
+        return _indexes[book_id]
+
+
+def restore(book_id: str, meta: Dict, assign: np.ndarray, centroids: Optional[np.ndarray],
+            rows: BinaryIO, nbytes: int) -> VectorIndex:
+    """
+    Grava um índice exportado por snapshot() no lugar do índice do livro. As linhas são copiadas
+    em blocos de `rows` direto para o .npy (nenhum embedding é recalculado).
+    """
+    n, dim = meta["rows"], meta["dim"]
+    if nbytes != n * dim * np.dtype(VECTOR_DTYPE).itemsize or len(assign) != n:
+        raise ValueError("vetores do snapshot não batem com o meta.json")
+    drop_index(book_id)
+    path = os.path.join(VECTOR_DIR, book_id)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "vectors.npy"), "wb") as f:
+        f.write(_npy_header(n, dim))
+        left = nbytes
+        while left:
+            block = rows.read(min(left, 1 << 20))
+            if not block:
+                raise ValueError("vetores do snapshot truncados")
+            f.write(block)
+            left -= len(block)
+    np.save(os.path.join(path, "assign.npy"), np.asarray(assign, dtype=np.int32))
+    if centroids is not None:
+        np.save(os.path.join(path, "centroids.npy"), np.asarray(centroids, dtype=np.float32))
+    meta = {k: v for k, v in meta.items() if k != "gen"}
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return get_index(book_id)
+
+
+def drop_index(book_id: str):
+    """Remove o índice do livro do disco (o próximo acesso recomeça do zero)."""
+    import shutil
+    with _indexes_guard:
+        idx = _indexes.pop(book_id, None)
+    path = idx.dir if idx else os.path.join(VECTOR_DIR, book_id)
+    shutil.rmtree(path, ignore_errors=True)
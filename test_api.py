@@ -72,6 +72,9 @@ class BookAssistantTester:
         
         self.test_endpoint("GET", "/health", description="Verificar se API está rodando")
         self.test_endpoint("GET", "/ready", description="Verificar readiness completo")
+        self.test_endpoint("GET", "/metrics", description="Métricas internas")
+        self.test_endpoint("GET", "/usage?group_by=book,endpoint", description="Uso de tokens por livro e rota")
+        self.test_endpoint("GET", "/usage/quotas?book_id=test-book", description="Cotas de tokens")
         self.test_endpoint("GET", "/chroma/status", description="Status do ChromaDB")
         self.test_endpoint("GET", "/chroma/collections", description="Listar coleções")
         
@@ -96,11 +99,56 @@ class BookAssistantTester:
         # Teste de listagem
         self.test_endpoint("GET", "/chapters/test-book", 
                           description="Listar capítulos do livro")
+        self.test_endpoint("GET", "/books", description="Listar livros")
+        self.test_endpoint("GET", "/books/test-book/version", description="Versão do livro")
+        self.test_endpoint("GET", "/books/test-book/order", description="Ordem dos capítulos")
+        
+        # Teste do histórico de revisões (capítulo inexistente → 404)
+        self.test_endpoint("GET", "/chapter/inexistente/history?book_id=test-book", expected_status=404,
+                          description="Histórico de revisões do capítulo")
+        
+        # Teste de busca textual (sem acento: "capitulo" acha "capítulo")
+        self.test_endpoint("GET", "/search/test-book?q=capitulo",
+                          description="Busca textual nos capítulos")
+        
+        # Teste do índice vetorial local
+        self.test_endpoint("GET", "/vectors/test-book",
+                          description="Estado do índice vetorial do livro")
+        
+        # Teste dos pacotes de contexto
+        self.test_endpoint("GET", "/packs/test-book",
+                          description="Pacotes de contexto do livro")
+        
+        # Teste de busca em lote
+        self.test_endpoint("POST", "/retrieve/batch",
+                          data={"book_id": "test-book", "queries": ["capítulo", "teste"], "k": 3},
+                          description="Várias consultas num único encode")
+        
+        # Teste do índice de entidades
+        self.test_endpoint("GET", "/entities/test-book",
+                          description="Personagens/locais do livro")
         
         # Teste de metadados
         self.test_endpoint("GET", "/metadata/book/test-book", 
                           description="Obter metadados do livro")
         
+        # Teste de resumo em lote
+        self.test_endpoint("POST", "/chapters/summarize-batch", data={"book_id": "test-book"},
+                          description="Resumir capítulos em paralelo")
+        
+        # Teste da árvore de resumos
+        self.test_endpoint("GET", "/summary-tree/test-book",
+                          description="Obter sinopse/arcos do livro")
+        
+        # Teste de importação (um capítulo em JSONL)
+        self.test_endpoint("POST", "/books/test-book/import?format=jsonl",
+                          data={"title": "Capítulo Importado", "text": "Texto importado para o teste."},
+                          description="Importar capítulos")
+        
+        # Teste de backup do livro
+        self.test_endpoint("GET", "/books/test-book/export?embeddings=false",
+                          description="Exportar snapshot do livro")
+        
     def run_ai_tests(self):
         """Testa funcionalidades de IA"""
         print("\n🤖 TESTANDO FUNCIONALIDADES DE IA")
@@ -128,6 +176,14 @@ class BookAssistantTester:
         self.test_endpoint("POST", "/critique", data=critique_data, 
                           description="Analisar coerência")
         
+        self.test_endpoint("POST", "/critique", data={**critique_data, "stream": True},
+                          description="Analisar coerência (streaming NDJSON)")
+        
+        # Teste de auditoria de continuidade (job em segundo plano) e lista de jobs
+        self.test_endpoint("POST", "/continuity/test-book/audit", data={"k": 3},
+                          description="Iniciar auditoria de continuidade")
+        self.test_endpoint("GET", "/jobs?book_id=test-book", description="Jobs do livro")
+        
         # Teste de pergunta livre
         ask_data = {
             "book_id": "test-book",
@@ -141,6 +197,9 @@ class BookAssistantTester:
         self.test_endpoint("POST", "/ask", data=ask_data, 
                           description="Fazer pergunta ao copiloto")
         
+        self.test_endpoint("POST", "/ask", data={**ask_data, "use_entities": True},
+                          description="Pergunta com capítulos dos personagens citados")
+        
         # Teste de geração de ideias
         ideate_data = {
             "book_id": "test-book",
@@ -170,6 +229,14 @@ class BookAssistantTester:
         self.test_endpoint("POST", "/expand", data=expand_data, 
                           description="Expandir ideia")
         
+        # Teste do contexto dos capítulos anteriores
+        self.test_endpoint("POST", "/expand", data={**expand_data, "use_memory": "previous", "previous_n": 2},
+                          description="Expandir ideia (capítulos anteriores)")
+        
+        # Teste de várias alternativas numa só geração
+        self.test_endpoint("POST", "/expand", data={**expand_data, "n": 2},
+                          description="Expandir ideia (2 alternativas)")
+        
     def run_maintenance_tests(self):
         """Testa endpoints de manutenção"""
         print("\n🛠️ TESTANDO MANUTENÇÃO & LIMPEZA")
@@ -177,6 +244,13 @@ class BookAssistantTester:
         
         self.test_endpoint("POST", "/chroma/vectorize-existing", 
                           description="Vetorizar capítulos existentes")
+        self.test_endpoint("GET", "/storage/status", description="Layout de armazenamento")
+        self.test_endpoint("GET", "/artifacts/test-book?kind=suggestion&limit=5",
+                          description="Sugestões salvas do livro")
+        self.test_endpoint("POST", "/storage/migrate?dry_run=true",
+                          description="Migração de armazenamento (simulação)")
+        self.test_endpoint("POST", "/vectors/test-book/compact",
+                          description="Compactar arquivo de vetores")
         
         # Teste de debug
         debug_data = {
@@ -0,0 +1,26 @@
+"""
+Testes unitários dos módulos da API que não dependem do vLLM/Chroma (rodam com `pytest tests`).
+Os módulos leem DATA_DIR na importação: aqui ele aponta para um diretório temporário e cada teste
+ainda recebe o seu (fixture data_dir).
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="book-assistant-tests-")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+
+import chapter_order   # noqa: E402
+import entity_index    # noqa: E402
+import vector_index    # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(chapter_order, "ORDER_DIR", str(tmp_path / "order"))
+    monkeypatch.setattr(entity_index, "ENTITY_DIR", str(tmp_path / "entities"))
+    monkeypatch.setattr(vector_index, "VECTOR_DIR", str(tmp_path / "vectors"))
+    monkeypatch.setattr(vector_index, "_indexes", {})
+    return tmp_path
@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from chapter_history import ChapterHistory, apply_delta, make_delta
+
+
+def _edit(text: str, rnd: random.Random) -> str:
+    lines = text.splitlines(keepends=True)
+    for _ in range(rnd.randint(1, 6)):
+        i = rnd.randrange(len(lines) + 1)
+        op = rnd.choice("idm")
+        if op == "i" or i == len(lines):
+            lines.insert(i, f"nova linha {rnd.random()}\n")
+        elif op == "d":
+            del lines[i]
+        else:
+            lines[i] = f"linha alterada {rnd.random()}\n"
+    return "".join(lines)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("", ""),
+    ("", "texto novo"),
+    ("texto antigo\n", ""),
+    ("a\nb\nc", "a\nb\nc\n"),          # só o fim de linha final muda
+    ("a\nb\nc\n", "a\nc\n"),
+    ("mesmo\n", "mesmo\n"),
+    ("a\r\nb\r\n", "a\r\nx\r\nb\r\n"),
+    ("Ação\nçã\n", "Ação\nção\nçã\n"),
+])
+def test_delta_roundtrip_edge_cases(a, b):
+    assert apply_delta(a, make_delta(a, b)) == b
+
+
+def test_delta_roundtrip_random_edits():
+    rnd = random.Random(7)
+    text = "".join(f"linha {i} " + "x" * rnd.randint(0, 60) + "\n" for i in range(300))
+    for _ in range(100):
+        new = _edit(text, rnd) + rnd.choice(["", "fim sem quebra"])
+        assert apply_delta(text, make_delta(text, new)) == new
+        text = new
+
+
+def test_record_keyframes_and_reads(tmp_path):
+    history = ChapterHistory(str(tmp_path / "history.db"), keyframe_every=4)
+    rnd = random.Random(3)
+    text = "".join(f"parágrafo {i}\n" for i in range(200))
+    versions = []
+    for i in range(10):
+        text = _edit(text, rnd)
+        versions.append(text)
+        assert history.record("livro", "cap", f"Título {i}", text, "update") == i + 1
+
+    revisions = history.list("livro", "cap")
+    assert [r["n"] for r in revisions] == list(range(10, 0, -1))
+    kinds = [r["kind"] for r in reversed(revisions)]
+    assert [n + 1 for n, k in enumerate(kinds) if k == "full"] == [1, 5, 9]
+    for n, expected in enumerate(versions, start=1):
+        rev = history.get("livro", "cap", n)
+        assert rev["text"] == expected
+        assert rev["title"] == f"Título {n - 1}"
+    assert sum(r["stored_bytes"] for r in revisions) < len(versions[0])
+    assert history.latest("livro", "cap") == 10
+
+
+def test_record_skips_unchanged_and_isolates_chapters(tmp_path):
+    history = ChapterHistory(str(tmp_path / "history.db"))
+    assert history.record("b", "c1", "T", "texto") == 1
+    assert history.record("b", "c1", "T", "texto") is None
+    assert history.record("b", "c1", "T2", "texto") == 2      # título mudou: nova revisão
+    assert history.record("b", "c2", "T", "texto") == 1
+    assert history.record("outro", "c1", "T", "texto") == 1
+    assert history.has_history("b", "c1") and not history.has_history("b", "c3")
+    assert history.get("b", "c1", 3) is None
+    assert history.latest("b", "c3") is None
+
+
+def test_forget_drops_only_that_chapter(tmp_path):
+    history = ChapterHistory(str(tmp_path / "history.db"))
+    history.record("b", "c1", "T", "um")
+    history.record("b", "c1", "T", "dois")
+    history.record("b", "c2", "T", "outro")
+    assert history.forget("b", "c1") == 2
+    assert not history.has_history("b", "c1") and history.has_history("b", "c2")
+    assert history.record("b", "c1", "T", "de novo") == 1
@@ -0,0 +1,47 @@
+import pytest
+
+import chapter_order
+
+
+def test_new_chapters_go_to_the_end_by_mtime(data_dir):
+    assert chapter_order.resolve("b", {"c2": 20.0, "c1": 10.0}) == ["c1", "c2"]
+    version = chapter_order.version("b")
+    # capítulo novo, mesmo que mais antigo no disco, entra no fim da ordem já gravada
+    assert chapter_order.resolve("b", {"c2": 20.0, "c1": 10.0, "c0": 5.0, "c3": 30.0}) == ["c1", "c2", "c0", "c3"]
+    assert chapter_order.version("b") == version + 1
+
+
+def test_resolve_without_changes_does_not_rewrite(data_dir):
+    mtimes = {"a": 1.0, "b": 2.0}
+    chapter_order.resolve("b", mtimes)
+    version = chapter_order.version("b")
+    assert chapter_order.resolve("b", mtimes) == ["a", "b"]
+    assert chapter_order.version("b") == version
+
+
+def test_deleted_chapters_leave_the_order(data_dir):
+    chapter_order.resolve("b", {"a": 1.0, "b": 2.0, "c": 3.0})
+    assert chapter_order.resolve("b", {"a": 1.0, "c": 3.0}) == ["a", "c"]
+    assert chapter_order.load("b")["order"] == ["a", "c"]
+    # o mesmo id reaparecendo volta no fim, não na posição antiga
+    assert chapter_order.resolve("b", {"a": 1.0, "b": 2.0, "c": 3.0}) == ["a", "c", "b"]
+
+
+def test_same_mtime_is_stable(data_dir):
+    assert chapter_order.resolve("b", {"z": 1.0, "y": 1.0, "x": 1.0}) == ["x", "y", "z"]
+
+
+def test_set_order_and_move(data_dir):
+    mtimes = {"a": 1.0, "b": 2.0, "c": 3.0}
+    chapter_order.resolve("b", mtimes)
+    assert chapter_order.set_order("b", ["c", "a"], mtimes) == ["c", "a", "b"]
+    assert chapter_order.move("b", "b", 0, mtimes) == ["b", "c", "a"]
+    assert chapter_order.move("b", "b", 99, mtimes) == ["c", "a", "b"]
+    assert chapter_order.move("b", "a", -5, mtimes) == ["a", "c", "b"]
+    with pytest.raises(KeyError):
+        chapter_order.set_order("b", ["a", "nao-existe"], mtimes)
+    with pytest.raises(ValueError):
+        chapter_order.set_order("b", ["a", "a"], mtimes)
+    with pytest.raises(KeyError):
+        chapter_order.move("b", "nao-existe", 0, mtimes)
+    assert chapter_order.resolve("b", mtimes) == ["a", "c", "b"]
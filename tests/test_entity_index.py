@@ -0,0 +1,97 @@
+import pytest
+
+import entity_index
+
+
+def _chars(*names):
+    return {"personagens": list(names)}
+
+
+def _entity(book_id: str, name: str):
+    return entity_index.chapters_for(book_id, name)
+
+
+def test_punctuation_only_names_are_ignored(data_dir):
+    index = entity_index.set_chapter("b", "c1", "Um", _chars("Ana", "...", "?", "—", " "))
+    assert list(index["entities"]) == ["ana"]
+    assert entity_index.set_chapter("b", "c2", "Dois", _chars("...", "!!")) is None
+
+
+def test_accents_and_case_are_the_same_entity(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", _chars("João"))
+    index = entity_index.set_chapter("b", "c2", "Dois", _chars("joao", "JOÃO"))
+    assert len(index["entities"]) == 1
+    assert _entity("b", "Joao")["chapters"] == {"c1": "Um", "c2": "Dois"}
+
+
+def test_short_name_joins_unique_full_name_in_both_orders(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", _chars("Ana"))
+    entity_index.set_chapter("b", "c2", "Dois", _chars("Ana Souza"))
+    ent = _entity("b", "Ana")
+    assert ent["name"] == "Ana Souza" and "Ana" in ent["aliases"]
+    assert set(ent["chapters"]) == {"c1", "c2"}
+
+    entity_index.set_chapter("x", "c1", "Um", _chars("Rui Prado"))
+    entity_index.set_chapter("x", "c2", "Dois", _chars("Rui"))
+    assert _entity("x", "Rui")["key"] == _entity("x", "Rui Prado")["key"]
+
+
+def test_ambiguous_short_name_stays_separate(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", _chars("Ana Souza", "Ana Lima"))
+    index = entity_index.set_chapter("b", "c2", "Dois", _chars("Ana"))
+    assert len(index["entities"]) == 3
+    assert _entity("b", "Ana")["chapters"] == {"c2": "Dois"}
+
+
+def test_short_name_only_joins_same_type(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", {"personagens": ["Santos"], "locais": ["Santos Dumont"]})
+    index = entity_index.load("b")
+    assert {e["type"] for e in index["entities"].values()} == {"character", "location"}
+    assert len(index["entities"]) == 2
+
+
+def test_resaving_chapter_drops_entities_that_left(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", _chars("Ana", "Bruno"))
+    entity_index.set_chapter("b", "c1", "Um", _chars("Ana"))
+    assert _entity("b", "Bruno") is None
+    assert _entity("b", "Ana")["chapters"] == {"c1": "Um"}
+
+
+def test_merge_survives_rewrites_and_drops_self_relationships(data_dir):
+    summary = {
+        "plot_summary": "…",
+        "main_characters": [{"name": "Rui Prado"}],
+        "supporting_characters": [{"name": "O Capitão"}],
+        "relationships": [{"character1": "Rui Prado", "character2": "O Capitão", "type": "rival"}],
+    }
+    entity_index.set_chapter("b", "c1", "Um", summary)
+    assert len(entity_index.load("b")["relationships"]) == 1
+
+    merged = entity_index.merge("b", ["O Capitão", "Rui Prado"], into="Rui Prado")
+    assert merged["name"] == "Rui Prado" and "O Capitão" in merged["aliases"]
+    assert entity_index.load("b")["relationships"] == []
+
+    # o capítulo é regravado (o LLM volta a citar os dois nomes): a fusão continua valendo
+    index = entity_index.set_chapter("b", "c1", "Um", summary)
+    assert len(index["entities"]) == 1
+    # capítulo novo só com o apelido cai na mesma entidade
+    entity_index.set_chapter("b", "c2", "Dois", _chars("o capitao"))
+    assert set(_entity("b", "Rui Prado")["chapters"]) == {"c1", "c2"}
+
+
+def test_merge_unknown_names(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", _chars("Ana", "Bruno"))
+    with pytest.raises(KeyError):
+        entity_index.merge("b", ["Ana", "Carla"])
+    with pytest.raises(KeyError):
+        entity_index.merge("b", ["Ana", "Bruno"], into="Carla")
+    with pytest.raises(KeyError):
+        entity_index.merge("b", ["Ana", "..."])
+
+
+def test_mentioned_in(data_dir):
+    entity_index.set_chapter("b", "c1", "Um", _chars("Ana Souza", "Bruno"))
+    entity_index.set_chapter("b", "c2", "Dois", _chars("Ana"))
+    hits = entity_index.mentioned_in("b", "O que a Ana fez depois do farol?")
+    assert [h["name"] for h in hits] == ["Ana Souza"]
+    assert entity_index.mentioned_in("b", "...") == []
@@ -0,0 +1,111 @@
+import os
+import zlib
+
+import numpy as np
+import pytest
+
+import vector_index
+from vector_index import VectorIndex
+
+DIM = 16
+
+
+def _vec(text: str) -> np.ndarray:
+    v = np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def encode(texts):
+    return np.stack([_vec(t) for t in texts])
+
+
+def _add(idx: VectorIndex, cid: str, text: str = None):
+    text = text or f"texto do capítulo {cid}"
+    idx.upsert(cid, cid.upper(), text, sig=cid, encode=encode)
+    return _vec(f"{cid.upper()}\n{text}")
+
+
+def test_upsert_and_search(data_dir):
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    queries = {cid: _add(idx, cid) for cid in ("a", "b", "c")}
+    for cid, q in queries.items():
+        hits = idx.search(q, k=2)
+        assert hits[0]["chapter_id"] == cid
+        assert hits[0]["score"] == pytest.approx(1.0, abs=1e-2)     # float16 no disco
+        assert hits[0]["span"] == [0, len(f"texto do capítulo {cid}")]
+    assert idx.stats()["rows"] == 3
+
+
+def test_upsert_replaces_and_delete_tombstones(data_dir, monkeypatch):
+    monkeypatch.setattr(vector_index, "COMPACT_RATIO", 1.0)       # sem compactação automática
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    old_q = _add(idx, "a", "versão antiga")
+    _add(idx, "b")
+    new_q = _add(idx, "a", "versão nova")
+    assert idx.stats()["rows"] == 3 and idx.live_rows() == 2
+    assert idx.search(new_q, k=1)[0]["chapter_id"] == "a"
+    assert all(h["score"] < 0.99 for h in idx.search(old_q, k=3))  # a linha antiga não volta
+    idx.delete("b")
+    assert [h["chapter_id"] for h in idx.search(new_q, k=5)] == ["a"]
+    idx.delete("nao-existe")
+    assert idx.live_rows() == 1
+
+
+def test_compact_keeps_results_and_files(data_dir, monkeypatch):
+    monkeypatch.setattr(vector_index, "COMPACT_RATIO", 1.0)
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    queries = {cid: _add(idx, cid) for cid in "abcdef"}
+    for cid in "bdf":
+        idx.delete(cid)
+    before = {cid: idx.search(queries[cid], k=1) for cid in "ace"}
+    old_file = idx._vectors_path
+
+    assert idx.compact() == 3
+    assert idx.stats()["rows"] == idx.live_rows() == 3
+    assert not os.path.exists(old_file) and os.path.exists(idx._vectors_path)
+    assert idx.compact() == 0
+    reopened = VectorIndex("livro", root=str(data_dir / "vectors"))
+    for cid in "ace":
+        assert idx.search(queries[cid], k=1) == before[cid]
+        assert reopened.search(queries[cid], k=1) == before[cid]
+    assert sorted(reopened.meta["chapters"]) == ["a", "c", "e"]
+
+
+def test_automatic_compaction(data_dir, monkeypatch):
+    monkeypatch.setattr(vector_index, "COMPACT_RATIO", 0.3)
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    for i in range(5):
+        q = _add(idx, "a", f"revisão {i}")
+    assert idx.stats()["rows"] <= 2
+    assert idx.search(q, k=1)[0]["chapter_id"] == "a"
+
+
+def test_ivf_search_finds_every_chapter(data_dir, monkeypatch):
+    monkeypatch.setattr(vector_index, "IVF_MIN_ROWS", 64)
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    queries = {f"c{i}": _add(idx, f"c{i}") for i in range(80)}
+    assert idx.stats()["ivf_lists"] >= 8
+    results = idx.search_batch(np.stack(list(queries.values())), k=1, nprobe=2)
+    assert [r[0]["chapter_id"] for r in results] == list(queries)
+    # capítulo novo depois do treino vai para a lista do centróide mais próximo
+    q = _add(idx, "novo")
+    assert idx.search(q, k=1, nprobe=1)[0]["chapter_id"] == "novo"
+
+
+def test_search_scores_in_blocks(data_dir, monkeypatch):
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    queries = {f"c{i}": _add(idx, f"c{i}") for i in range(10)}
+    qvs = np.stack(list(queries.values()))
+    whole = idx.search_batch(qvs, k=3)
+    monkeypatch.setattr(vector_index, "_SCORE_BLOCK_ROWS", 3)
+    blocked = idx.search_batch(qvs, k=3)
+    assert [[h["chapter_id"] for h in r] for r in blocked] == [[h["chapter_id"] for h in r] for r in whole]
+    assert [h["score"] for r in blocked for h in r] == pytest.approx([h["score"] for r in whole for h in r], abs=1e-5)
+    assert [r[0]["chapter_id"] for r in whole] == list(queries)
+
+
+def test_dimension_mismatch(data_dir):
+    idx = VectorIndex("livro", root=str(data_dir / "vectors"))
+    _add(idx, "a")
+    with pytest.raises(ValueError):
+        idx.upsert("b", "B", "texto", sig="b", encode=lambda texts: np.ones((len(texts), DIM + 1)))
@@ -4,7 +4,7 @@ import requests
 import streamlit as st
 import re
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 st.set_page_config(page_title="Copiloto de Livro", layout="wide", page_icon="✍️")
 
@@ -128,158 +128,167 @@ def probe_direct():
         "source": "direct",
     }
 
-def readiness_loop(max_wait=900):
-    status_line = st.empty()   # um único bloco que será reescrito
-    detail_line = st.empty()
-    t0 = time.time()
-    attempt = 0
-    last_key = ""
-    same_count = 0
-
-    while time.time() - t0 < max_wait:
-        api_info = check_api_ready()
-        if api_info.get("ready"):
-            status_line.success("✅ Tudo pronto!")
-            detail_line.write(f"API ok • vLLM ok • Chroma {api_info['chroma']['status'] if 'chroma' in api_info else 'ok'}")
-            return api_info
-
-        # API ainda não pronta → sondar direto
-        direct = probe_direct()
-
-        # compõe uma "chave de estado" para detectar repetição
-        key = f"api:{api_info.get('ready', False)}|llm:{direct['llm']['ok']}|chroma:{direct['chroma']['ok']}"
-        if key == last_key:
-            same_count += 1
-        else:
-            same_count = 1
-            last_key = key
-
-        # backoff exponencial com teto de 10s
-        delay = min(2 ** min(attempt, 4), 10)  # 1,2,4,8,10,10…
-        attempt += 1
-
-        # linha principal sempre atualizada
-        status_line.info(f"⏳ Inicializando serviços… (tentativa {attempt}, próxima verificação em {delay}s)")
-
-        # detalhes só quando o estado mudou OU a cada 3 repetições
-        if same_count == 1 or same_count % 3 == 0:
-            api_txt = "ok" if api_info.get("api") else (api_info.get("detail") or "offline")
-            llm_txt = "ok" if direct["llm"]["ok"] else (direct["llm"]["detail"] or "carregando…")
-            chm_txt = "ok" if direct["chroma"]["ok"] else (direct["chroma"]["detail"] or "carregando…")
-            detail_line.write(f"API: {api_txt} • vLLM: {llm_txt} • Chroma: {chm_txt}")
+# Readiness: verificado uma vez por sessão; depois um fragmento revalida em segundo plano
+# (a página renderiza na hora, em modo degradado, enquanto os serviços sobem)
+UI_READY_POLL_S = int(os.getenv("UI_READY_POLL_S", "5"))          # enquanto não está pronto
+UI_READY_REFRESH_S = int(os.getenv("UI_READY_REFRESH_S", "60"))   # depois de pronto
 
-        time.sleep(delay)
-
-    status_line.error("❌ Tempo esgotado para inicialização.")
-    detail_line.write("Verifique logs dos containers (vllm, api, chroma).")
-    st.stop()
+def session_readiness() -> Dict:
+    if "ready_info" not in st.session_state:
+        info = check_api_ready()
+        st.session_state["ready_info"] = info
+        st.session_state["ready"] = bool(info.get("ready"))
+        st.session_state["ready_checked_at"] = time.time()
+    return st.session_state["ready_info"]
 
 # ========================
 # Sistema de gerenciamento de livros
 # ========================
-def get_existing_books() -> List[Dict]:
-    """Obtém lista de livros existentes baseado nos metadados e arquivos"""
-    books = []
+# Cache da camada de dados: o Streamlit reexecuta o script a cada interação, então as listagens
+# vêm da API (leves, sem texto) e ficam em cache até a versão do livro mudar ou o TTL expirar.
+UI_CACHE_TTL_S = int(os.getenv("UI_CACHE_TTL_S", "300"))
+UI_VERSION_TTL_S = int(os.getenv("UI_VERSION_TTL_S", "5"))
 
-    # 2.1 — ler metadados oficiais
+@st.cache_data(ttl=UI_VERSION_TTL_S, show_spinner=False)
+def _book_version(book_id: str) -> str:
     try:
-        for fn in os.listdir(BOOKS_DIR):
-            if fn.endswith(".json"):
-                with open(os.path.join(BOOKS_DIR, fn), "r", encoding="utf-8") as f:
-                    meta = json.load(f)
-                books.append({
-                    "id": meta["id"],
-                    "name": meta.get("name", meta["id"]),
-                    "chapters": 0,
-                    "suggestions": 0,
-                    "critiques": 0,
-                })
-    except FileNotFoundError:
-        pass
-
-    # 2.2 — se não houver meta, inferir pelos arquivos de capítulo (fallback)
-    if not books and os.path.exists(CHAPTERS_DIR):
-        import glob
-        all_files = glob.glob(f"{CHAPTERS_DIR}/*.md")
-        book_ids = set()
-        for p in all_files:
-            fn = os.path.basename(p)
-            if "__" in fn:
-                book_ids.add(fn.split("__", 1)[0])
-
-        for bid in sorted(book_ids):
-            books.append({
-                "id": bid,
-                "name": bid.replace("_", " ").replace("-", " ").title(),
-                "chapters": 0,
-                "suggestions": 0,
-                "critiques": 0,
-            })
-
-    # 2.3 — contar arquivos por livro
-    import glob
-    for b in books:
-        bid = b["id"]
-        chs = glob.glob(f"{CHAPTERS_DIR}/{bid}__*.md")
-        b["chapters"] = len([x for x in chs if not os.path.basename(x).startswith(("sugest_", "critica_"))])
-        b["suggestions"] = len(glob.glob(f"{CHAPTERS_DIR}/sugest_{bid}__*.md"))
-        b["critiques"]   = len(glob.glob(f"{CHAPTERS_DIR}/critica_{bid}__*.md"))
-
-    return books
+        r = requests.get(f"{API_BASE}/books/{book_id}/version", timeout=5)
+        return r.json().get("version", "") if r.ok else ""
+    except Exception:
+        return ""
+
+@st.cache_data(ttl=UI_VERSION_TTL_S, show_spinner=False)
+def _library_version() -> str:
+    try:
+        r = requests.get(f"{API_BASE}/books/version", timeout=5)
+        return r.json().get("version", "") if r.ok else ""
+    except Exception:
+        return ""
+
+@st.cache_data(ttl=UI_CACHE_TTL_S, show_spinner=False)
+def _fetch_books(version: str) -> List[Dict]:
+    r = requests.get(f"{API_BASE}/books", timeout=15)
+    r.raise_for_status()
+    return r.json().get("books", [])
+
+@st.cache_data(ttl=UI_CACHE_TTL_S, show_spinner=False)
+def _fetch_chapters(book_id: str, version: str) -> List[Dict]:
+    r = requests.get(f"{API_BASE}/chapters/{book_id}", timeout=15)
+    r.raise_for_status()
+    return r.json().get("chapters", [])
+
+@st.cache_data(ttl=UI_CACHE_TTL_S, max_entries=32, show_spinner=False)
+def _fetch_chapter(book_id: str, chapter_id: str, version: str) -> Dict:
+    r = requests.get(f"{API_BASE}/chapter/{book_id}/{chapter_id}", timeout=15)
+    r.raise_for_status()
+    return r.json()
+
+def invalidate_book_cache():
+    """Chamado depois de criar livro/salvar capítulo: a próxima leitura vai à API."""
+    _library_version.clear()
+    _book_version.clear()
+
+def get_existing_books() -> List[Dict]:
+    """Livros com contagens de capítulos/sugestões/críticas (GET /books, em cache)"""
+    try:
+        return _fetch_books(_library_version())
+    except Exception as e:
+        st.error(f"Erro ao listar livros: {_short_err(e)}")
+        return []
 
 def get_book_chapters(book_id: str) -> List[Dict]:
-    """Obtém lista de capítulos de um livro específico"""
+    """Lista leve de capítulos (sem o texto), na ordem do livro; em cache enquanto a versão não muda"""
     try:
-        import glob
-        import os
-        
-        # Usa caminho absoluto correto
-        chapters_dir = "/data/chapters"
-        
-        if not os.path.exists(chapters_dir):
-            return []
-        
-        # Busca por capítulos do livro
-        pattern = f"{chapters_dir}/{book_id}__*.md"
-        files = glob.glob(pattern)
-        
-        chapters = []
-        for file in files:
-            filename = os.path.basename(file)
-            if "__" in filename:
-                chapter_id = filename.split("__")[1].replace(".md", "")
-                
-                # Lê o conteúdo para extrair título
-                try:
-                    with open(file, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        # Extrai título da primeira linha (formato Markdown)
-                        lines = content.split('\n')
-                        title = "Capítulo sem título"
-                        if lines and lines[0].startswith('# '):
-                            title = lines[0][2:].strip()
-                        elif lines and lines[0].strip():
-                            title = lines[0].strip()
-                        
-                        chapters.append({
-                            "id": chapter_id,
-                            "title": title,
-                            "file_path": file,
-                            "content": content,
-                            "size": len(content),
-                            "modified": os.path.getmtime(file)
-                        })
-                except Exception as e:
-                    st.warning(f"Erro ao ler capítulo {filename}: {str(e)}")
-        
-        # Ordena por data de modificação (mais recente primeiro)
-        chapters.sort(key=lambda x: x["modified"], reverse=True)
-        return chapters
-        
+        return list(_fetch_chapters(book_id, _book_version(book_id)))
     except Exception as e:
-        st.error(f"Erro ao listar capítulos: {str(e)}")
+        st.error(f"Erro ao listar capítulos: {_short_err(e)}")
         return []
 
+def move_chapter(book_id: str, chapter_id: str, position: int) -> bool:
+    try:
+        r = requests.post(f"{API_BASE}/books/{book_id}/order/move",
+                          json={"chapter_id": chapter_id, "position": position}, timeout=10)
+        if r.ok:
+            invalidate_book_cache()
+            return True
+        st.error(f"Erro ao mover capítulo: {r.text}")
+    except Exception as e:
+        st.error(f"Erro de conexão: {_short_err(e)}")
+    return False
+
+def get_chapter_history(book_id: str, chapter_id: str) -> List[Dict]:
+    """Revisões do capítulo (mais recente primeiro, sem o texto)"""
+    try:
+        r = requests.get(f"{API_BASE}/chapter/{chapter_id}/history", params={"book_id": book_id}, timeout=10)
+        if r.ok:
+            return r.json()["revisions"]
+        st.error(f"Erro ao listar revisões: {r.text}")
+    except Exception as e:
+        st.error(f"Erro de conexão: {_short_err(e)}")
+    return []
+
+def get_chapter_revision(book_id: str, chapter_id: str, n: int) -> Optional[Dict]:
+    """Texto da revisão n, com o diff contra a anterior"""
+    try:
+        r = requests.get(f"{API_BASE}/chapter/{chapter_id}/revision/{n}",
+                         params={"book_id": book_id, "diff": "true"}, timeout=15)
+        if r.ok:
+            return r.json()
+        st.error(f"Erro ao carregar revisão: {r.text}")
+    except Exception as e:
+        st.error(f"Erro de conexão: {_short_err(e)}")
+    return None
+
+def restore_chapter_revision(book_id: str, chapter_id: str, n: int) -> Optional[Dict]:
+    """Volta o capítulo para a revisão n (vira uma revisão nova; resumo e Chroma são refeitos)"""
+    try:
+        r = requests.post(f"{API_BASE}/chapter/{chapter_id}/revision/{n}/restore",
+                          params={"book_id": book_id}, timeout=120)
+        if r.ok:
+            invalidate_book_cache()
+            return r.json()
+        st.error(f"Erro ao restaurar revisão: {r.text}")
+    except Exception as e:
+        st.error(f"Erro de conexão: {_short_err(e)}")
+    return None
+
+_IMPORT_CONTENT_TYPES = {"zip": "application/zip", "jsonl": "application/x-ndjson", "gz": "application/gzip"}
+
+def import_manuscript(book_id: str, uploaded) -> Optional[Dict]:
+    """Envia o arquivo para /books/{id}/import (capítulos gravados na hora; indexação vira um job)"""
+    ext = uploaded.name.rsplit(".", 1)[-1].lower()
+    headers = {"Content-Type": _IMPORT_CONTENT_TYPES.get(ext, "text/markdown")}
+    try:
+        uploaded.seek(0)
+        r = requests.post(f"{API_BASE}/books/{book_id}/import", data=uploaded, headers=headers, timeout=600)
+        if r.ok:
+            invalidate_book_cache()
+            return r.json()
+        st.error(f"Erro ao importar ({r.status_code}): {r.text}")
+    except Exception as e:
+        st.error(f"Erro de conexão: {_short_err(e)}")
+    return None
+
+def export_book(book_id: str, embeddings: bool) -> Optional[bytes]:
+    """Baixa o snapshot (.tar.gz) do livro pela API"""
+    try:
+        r = requests.get(f"{API_BASE}/books/{book_id}/export", params={"embeddings": str(embeddings).lower()},
+                         stream=True, timeout=600)
+        if r.ok:
+            return b"".join(r.iter_content(1 << 20))
+        st.error(f"Erro ao exportar ({r.status_code}): {r.text}")
+    except Exception as e:
+        st.error(f"Erro de conexão: {_short_err(e)}")
+    return None
+
+def load_chapter(book_id: str, chapter_id: str) -> Optional[Dict]:
+    """Conteúdo completo de um capítulo — só quando o usuário pede para carregar"""
+    try:
+        return _fetch_chapter(book_id, chapter_id, _book_version(book_id))
+    except Exception as e:
+        st.error(f"Erro ao carregar capítulo: {_short_err(e)}")
+        return None
+
 def create_new_book(book_id: str, book_name: str) -> bool:
     """Cria um novo livro com slug automático e metadados"""
     if not (book_name or "").strip():
@@ -306,35 +315,106 @@ def create_new_book(book_id: str, book_name: str) -> bool:
 
     # selecionar automaticamente
     st.session_state["selected_book"] = meta
+    invalidate_book_cache()
     st.success(f"✅ Livro '{book_name}' (ID: {book_id}) criado!")
     return True
 
+# ========================
+# Geração em streaming
+# ========================
+def _ndjson_deltas(path: str, payload: Dict, result: Dict):
+    """
+    POST com "stream": true. Gera os trechos de texto (para st.write_stream) e guarda a linha
+    final ({"done": true, ...}) em result. O finally fecha a conexão, inclusive quando o
+    Streamlit interrompe o script — a API percebe e aborta a geração no vLLM.
+    """
+    r = requests.post(f"{API_BASE}{path}", json={**payload, "stream": True}, stream=True, timeout=600)
+    try:
+        if not r.ok:
+            raise RuntimeError(r.text)
+        for line in r.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            msg = json.loads(line)
+            if "delta" in msg:
+                yield msg["delta"]
+            elif msg.get("error"):
+                raise RuntimeError(msg["error"])
+            elif msg.get("done"):
+                result.update(msg)
+    finally:
+        r.close()
+
+def stream_generation(path: str, payload: Dict, key: str) -> Dict:
+    """
+    Mostra o texto conforme os tokens chegam, com um botão para cancelar. Qualquer clique
+    (inclusive "Cancelar") reinicia o script e interrompe a geração; nada é salvo.
+    """
+    result: Dict = {}
+    st.button("⏹️ Cancelar", key=f"cancel_{key}", help="Interrompe a geração (nada é salvo)")
+    st.session_state["streaming"] = key
+    try:
+        st.write_stream(_ndjson_deltas(path, payload, result))
+    except Exception:
+        st.session_state.pop("streaming", None)
+        raise
+    st.session_state.pop("streaming", None)
+    return result
+
+# geração interrompida na execução anterior do script
+if st.session_state.pop("streaming", None):
+    st.toast("⏹️ Geração cancelada — nada foi salvo.")
+
 # ========================
 # Inicialização dos serviços
 # ========================
-with st.spinner("Checando serviços…"):
-    info = readiness_loop()
-st.session_state["ready"] = True
+info = session_readiness()
 
 def badge(text: str, kind: str="ok"):
     return f'<span class="badge {kind}">● {text}</span>'
 
-# Cabeçalho "hero"
-col_logo, col_status = st.columns([0.6, 0.4])
-with col_logo:
-    st.markdown("### ✍️ **Copiloto de Escrita**")
-    st.caption("vLLM + RAG • editor com memória • ideias e análise em um só lugar")
-
-with col_status:
+def render_status_badges(info: Dict):
+    api_ok = info.get("source") == "api" and "detail" not in info
     llm_ok = info.get("llm",{}).get("ok", False)
     chroma_ok = info.get("chroma",{}).get("ok", False) or info.get("chroma",{}).get("status") == "ready"
-    api_ok = True
 
-    b_api   = badge("API pronta", "ok" if api_ok else "err")
+    b_api   = badge("API pronta" if api_ok else "API offline", "ok" if api_ok else "err")
     b_llm   = badge("LLM ok" if llm_ok else "LLM carregando…", "ok" if llm_ok else "warn")
     b_chrm  = badge("Chroma ok" if chroma_ok else "Chroma indisponível", "ok" if chroma_ok else "warn")
 
     st.markdown(f'<div class="badges">{b_api}{b_llm}{b_chrm}</div>', unsafe_allow_html=True)
+    if not st.session_state.get("ready"):
+        detail = info.get("detail") or info.get("llm", {}).get("detail") or ""
+        st.caption(f"⏳ Serviços inicializando — ações de IA ficam desativadas até tudo ficar pronto. {detail}")
+
+@st.experimental_fragment(run_every=UI_READY_REFRESH_S if st.session_state.get("ready") else UI_READY_POLL_S)
+def readiness_fragment():
+    """Revalida /ready (em cache na API) sem reexecutar a página; se o estado mudar, reexecuta tudo."""
+    was_ready = st.session_state.get("ready", False)
+    interval = UI_READY_REFRESH_S if was_ready else UI_READY_POLL_S
+    # o fragmento também roda em toda reexecução da página (cliques): aí só desenha o último estado,
+    # e a rede fica para as execuções periódicas do próprio fragmento
+    if time.time() - st.session_state.get("ready_checked_at", 0) >= interval * 0.8:
+        info = check_api_ready()
+        if "detail" in info:
+            # API fora do ar: mostra o estado de vLLM/Chroma sondando direto
+            direct = probe_direct()
+            info = {**info, "llm": direct["llm"], "chroma": direct["chroma"]}
+        st.session_state["ready_info"] = info
+        st.session_state["ready_checked_at"] = time.time()
+        st.session_state["ready"] = bool(info.get("ready"))
+        if st.session_state["ready"] != was_ready:
+            st.rerun()
+    render_status_badges(st.session_state["ready_info"])
+
+# Cabeçalho "hero"
+col_logo, col_status = st.columns([0.6, 0.4])
+with col_logo:
+    st.markdown("### ✍️ **Copiloto de Escrita**")
+    st.caption("vLLM + RAG • editor com memória • ideias e análise em um só lugar")
+
+with col_status:
+    readiness_fragment()
 
 # ========================
 # Abas principais
@@ -357,6 +437,7 @@ with st.sidebar:
     # Botão de debug para forçar atualização
     if st.sidebar.button("🔄 Atualizar Lista de Livros", type="secondary"):
         st.sidebar.info("🔄 Atualizando lista...")
+        invalidate_book_cache()
         st.rerun()
     
     if existing_books:
@@ -395,7 +476,7 @@ with st.sidebar:
                 
                 if chapters:
                     # Dropdown para selecionar capítulo
-                    chapter_options = [f"{ch['title']} ({ch['id'][:8]}...)" for ch in chapters]
+                    chapter_options = [f"{i + 1}. {ch['title']} ({ch['id'][:8]}...)" for i, ch in enumerate(chapters)]
                     selected_chapter_idx = st.selectbox(
                         "Selecione um capítulo:",
                         range(len(chapters)),
@@ -404,7 +485,10 @@ with st.sidebar:
                     )
                     
                     if st.button("📂 Carregar Capítulo", type="secondary"):
-                        selected_chapter = chapters[selected_chapter_idx]
+                        selected_chapter = load_chapter(book_id, chapters[selected_chapter_idx]["id"])
+                    else:
+                        selected_chapter = None
+                    if selected_chapter:
                         st.session_state["editing_chapter"] = selected_chapter
                         st.session_state["editing_chapter_id"] = selected_chapter["id"]
                         # Preenche os campos editáveis
@@ -413,6 +497,50 @@ with st.sidebar:
                         # Habilita modo sobrescrever (será feito no rerun)
                         st.success(f"✅ Capítulo '{selected_chapter['title']}' carregado para edição!")
                         st.rerun()
+
+                    # Ordem narrativa (usada no contexto "Capítulos anteriores")
+                    with st.expander("🔢 Ordem dos capítulos", expanded=False):
+                        new_pos = st.number_input("Mover o capítulo selecionado para a posição", min_value=1,
+                                                  max_value=len(chapters), value=selected_chapter_idx + 1)
+                        if st.button("↕️ Mover", type="secondary", disabled=new_pos == selected_chapter_idx + 1):
+                            if move_chapter(book_id, chapters[selected_chapter_idx]["id"], int(new_pos) - 1):
+                                st.rerun()
+
+                    # Versões anteriores do capítulo selecionado
+                    with st.expander("🕘 Histórico de revisões", expanded=False):
+                        hist_chapter_id = chapters[selected_chapter_idx]["id"]
+                        revisions = get_chapter_history(book_id, hist_chapter_id)
+                        if not revisions:
+                            st.caption("Sem revisões registradas (o histórico começa na próxima gravação).")
+                        else:
+                            rev_n = st.selectbox(
+                                "Revisão:",
+                                [r["n"] for r in revisions],
+                                format_func=lambda n: next(
+                                    f"#{r['n']} · {r['saved_at'].replace('T', ' ')} · {r['source']} · {r['chars']} car."
+                                    for r in revisions if r["n"] == n),
+                                key=f"rev_select_{hist_chapter_id}",
+                            )
+                            rev = get_chapter_revision(book_id, hist_chapter_id, rev_n)
+                            if rev:
+                                if rev.get("diff"):
+                                    st.code(rev["diff"], language="diff")
+                                else:
+                                    st.text_area("Texto da revisão", rev["text"], height=200, disabled=True)
+                                col_load, col_restore = st.columns(2)
+                                if col_load.button("📝 Abrir no editor", key="rev_load"):
+                                    st.session_state["editing_chapter"] = {
+                                        "id": hist_chapter_id, "title": rev["title"], "content": rev["text"]}
+                                    st.session_state["editing_chapter_id"] = hist_chapter_id
+                                    st.session_state["shared_chapter_title"] = rev["title"]
+                                    st.session_state["shared_chapter_text"] = rev["text"]
+                                    st.rerun()
+                                if col_restore.button("⏪ Restaurar", key="rev_restore", disabled=rev["latest"]):
+                                    with st.spinner("Restaurando revisão..."):
+                                        res = restore_chapter_revision(book_id, hist_chapter_id, rev_n)
+                                    if res:
+                                        st.success(f"✅ Revisão {rev_n} restaurada como revisão {res['revision']}")
+                                        st.rerun()
                 
                 # Botão para visualizar metadados
                 if st.button("🎭 Visualizar Metadados", type="secondary"):
@@ -492,6 +620,56 @@ with st.sidebar:
         if st.form_submit_button("📚 Criar Livro"):
             if create_new_book(new_book_id, new_book_name):
                 st.rerun()  # lista atualiza e o editor já habilita
+
+    # Importar manuscrito inteiro (no livro selecionado)
+    with st.expander("📥 Importar manuscrito", expanded=False):
+        target = st.session_state.get("selected_book")
+        if not target:
+            st.info("Selecione ou crie um livro para importar capítulos nele.")
+        else:
+            uploaded = st.file_uploader(
+                "Arquivo (.md com um capítulo por '# Título', .zip de .md, .jsonl ou backup .tar.gz)",
+                type=["md", "markdown", "txt", "zip", "jsonl", "gz"],
+                key="import_file",
+            )
+            if st.button("📥 Importar", type="secondary", disabled=uploaded is None):
+                with st.spinner("Enviando capítulos..."):
+                    result = import_manuscript(target["id"], uploaded)
+                if result:
+                    st.session_state["import_job"] = (result.get("job") or {}).get("id")
+                    st.success(f"✅ {len(result['chapters'])} capítulo(s) importado(s) para '{target['id']}'")
+                    if result.get("restored"):
+                        st.caption("Backup restaurado sem reprocessar: " +
+                                   ", ".join(f"{k}: {v}" for k, v in result["restored"].items()))
+                    for err in result["errors"]:
+                        st.warning(err)
+            job_id = st.session_state.get("import_job")
+            if job_id:
+                try:
+                    job = requests.get(f"{API_BASE}/jobs/{job_id}", timeout=5).json()
+                    prog = job["progress"]
+                    done = prog["done"] + prog["failed"]
+                    st.progress(done / prog["total"] if prog["total"] else 0.0,
+                                text=f"Resumos e indexação: {done}/{prog['total']} ({job['status']})")
+                    if job["status"] not in ("done", "failed", "cancelled"):
+                        st.button("🔄 Atualizar progresso", type="secondary", key="import_refresh")
+                except Exception as e:
+                    st.caption(f"Progresso indisponível: {_short_err(e)}")
+
+    # Backup do livro selecionado (snapshot .tar.gz; restaura pelo "Importar manuscrito")
+    with st.expander("💾 Backup do livro", expanded=False):
+        target = st.session_state.get("selected_book")
+        if not target:
+            st.info("Selecione um livro para exportar.")
+        else:
+            with_emb = st.checkbox("Incluir embeddings (restaura sem recalcular)", value=True, key="export_emb")
+            if st.button("📦 Preparar backup", type="secondary"):
+                with st.spinner("Gerando arquivo..."):
+                    st.session_state["export_data"] = (target["id"], export_book(target["id"], with_emb))
+            book_id, data = st.session_state.get("export_data") or (None, None)
+            if data and book_id == target["id"]:
+                st.download_button("⬇️ Baixar .tar.gz", data=data, file_name=f"{book_id}.tar.gz",
+                                   mime="application/gzip")
     
     # Configurações gerais
     st.divider()
@@ -589,6 +767,7 @@ with col1:
                     try:
                         r = requests.put(f"{API_BASE}/chapter/update", json=payload, timeout=600)
                         if r.ok:
+                            invalidate_book_cache()
                             data = r.json()
                             st.success("✅ Capítulo atualizado (sobrescrito) com sucesso!")
                             st.info(f"📁 ID: {data['chapter_id']}")
@@ -613,6 +792,7 @@ with col1:
                     try:
                         r = requests.post(f"{API_BASE}/chapter/save", json=payload, timeout=600)
                         if r.ok:
+                            invalidate_book_cache()
                             data = r.json()
                             st.success("✅ Capítulo salvo como NOVO com sucesso!")
                             st.info(f"📁 ID: {data['chapter_id']}")
@@ -640,21 +820,19 @@ with col2:
                     "book_id": book_id,
                     "current_chapter_title": chapter_title,
                     "current_chapter_text": chapter_text,
-                    "k": k
+                    "k": k,
+                    "chapter_id": st.session_state.get("editing_chapter_id"),
+                    # capítulo salvo carregado: a janela termina antes dele (sem repetir o texto do editor)
+                    "use_memory": "previous" if st.session_state.get("editing_chapter_id") else "none",
                 }
                 try:
-                    r = requests.post(f"{API_BASE}/suggest", json=payload, timeout=600)
-                    if r.ok:
-                        data = r.json()
-                        st.success("✅ Sugestões geradas com sucesso!")
-                        st.info(f"📁 Arquivo salvo: {data.get('suggestions_file', 'N/A')}")
-                        
-                        st.subheader("🎭 Sugestões do co-roteirista")
-                        st.write(data["suggestions"])
-                    else:
-                        st.error(f"❌ Erro ao gerar sugestões: {r.text}")
+                    st.subheader("🎭 Sugestões do co-roteirista")
+                    data = stream_generation("/suggest", payload, "suggest")
+                    invalidate_book_cache()
+                    st.success("✅ Sugestões geradas com sucesso!")
+                    st.info(f"📁 Arquivo salvo: {data.get('suggestions_file', 'N/A')}")
                 except Exception as e:
-                    st.error(f"❌ Erro de conexão: {str(e)}")
+                    st.error(f"❌ Erro ao gerar sugestões: {str(e)}")
         else:
             st.error("❌ Preencha o título e o texto do capítulo")
 
@@ -666,21 +844,17 @@ with col3:
                     "book_id": book_id,
                     "current_chapter_title": chapter_title,
                     "current_chapter_text": chapter_text,
-                    "k": k
+                    "k": k,
+                    "chapter_id": st.session_state.get("editing_chapter_id"),
                 }
                 try:
-                    r = requests.post(f"{API_BASE}/critique", json=payload, timeout=600)
-                    if r.ok:
-                        data = r.json()
-                        st.success("✅ Crítica gerada com sucesso!")
-                        st.info(f"📁 Arquivo salvo: {data.get('critique_file', 'N/A')}")
-                        
-                        st.subheader("📝 Feedback editorial")
-                        st.write(data["critique"])
-                    else:
-                        st.error(f"❌ Erro ao gerar crítica: {r.text}")
+                    st.subheader("📝 Feedback editorial")
+                    data = stream_generation("/critique", payload, "critique")
+                    invalidate_book_cache()
+                    st.success("✅ Crítica gerada com sucesso!")
+                    st.info(f"📁 Arquivo salvo: {data.get('critique_file', 'N/A')}")
                 except Exception as e:
-                    st.error(f"❌ Erro de conexão: {str(e)}")
+                    st.error(f"❌ Erro ao gerar crítica: {str(e)}")
         else:
             st.error("❌ Preencha o título e o texto do capítulo")
     
@@ -707,6 +881,8 @@ with tab_copilot:
         ask_k = st.slider("Top-K", 3, 15, 8, key="ask_k_tab1")
     with colC:
         ask_incl_cur = st.checkbox("Incluir capítulo atual", value=bool(chapter_text.strip()), key="ask_incl_cur_tab1")
+    ask_tree = st.checkbox("Usar sinopse/arcos do livro (perguntas sobre o livro todo)", value=False, key="ask_tree_tab1")
+    ask_entities = st.checkbox("Incluir capítulos dos personagens citados (continuidade)", value=True, key="ask_entities_tab1")
     ask_show = st.checkbox("Mostrar prompt final (debug)", value=False, key="ask_show_tab1")
     if st.button("🤖 Perguntar", use_container_width=True, type="primary", key="ask_button_tab1"):
         if not ask_q.strip():
@@ -717,24 +893,21 @@ with tab_copilot:
                 "question": ask_q,
                 "k": ask_k,
                 "use_memory": ask_use_mem,
+                "use_summary_tree": ask_tree,
+                "use_entities": ask_entities,
                 "include_current": ask_incl_cur,
                 "current_title": chapter_title if ask_incl_cur else None,
                 "current_text": chapter_text if ask_incl_cur else None,
                 "show_prompt": ask_show
             }
             try:
-                r = requests.post(f"{API_BASE}/ask", json=payload, timeout=600)
-                if r.ok:
-                    data = r.json()
-                    st.success("✅ Resposta do copiloto")
-                    st.write(data["answer"])
-                    if data.get("prompt_preview"):
-                        with st.expander("📦 Prompt enviado (debug)", expanded=False):
-                            st.code(data["prompt_preview"])
-                else:
-                    st.error(f"Erro: {r.text}")
+                st.success("✅ Resposta do copiloto")
+                data = stream_generation("/ask", payload, "ask")
+                if data.get("prompt_preview"):
+                    with st.expander("📦 Prompt enviado (debug)", expanded=False):
+                        st.code(data["prompt_preview"])
             except Exception as e:
-                st.error(f"Erro de conexão: {e}")
+                st.error(f"Erro: {e}")
     
     st.markdown('</div>', unsafe_allow_html=True)
     
@@ -811,13 +984,15 @@ with tab_copilot:
     with colA:
         mode = st.radio("Gerar a partir de:", ["Ideia", "Capítulo existente"], horizontal=True, key="expand_mode_unique")
     with colB:
-        ctx = st.radio("Contexto:", ["Sem memória", "Memória do livro", "Somente capítulo atual", "Livro + capítulo atual"], index=1, key="expand_ctx_unique")
+        ctx = st.radio("Contexto:", ["Sem memória", "Memória do livro", "Capítulos anteriores", "Somente capítulo atual", "Livro + capítulo atual", "Sinopse/arcos + memória"], index=1, key="expand_ctx_unique")
     
     use_memory_map = {
         "Sem memória": "none",
         "Memória do livro": "book",
+        "Capítulos anteriores": "previous",         # resumos dos anteriores + íntegra do último
         "Somente capítulo atual": "none",            # só injeta o atual
         "Livro + capítulo atual": "book+current",
+        "Sinopse/arcos + memória": "tree+book",    # árvore de resumos + Top-K
     }
     include_current = (ctx in ["Somente capítulo atual", "Livro + capítulo atual"])
     
@@ -829,19 +1004,17 @@ with tab_copilot:
         idea_prefill = st.session_state.get("selected_idea_text", "")
         idea_text = st.text_area("Descreva a ideia base", value=idea_prefill, height=160, placeholder="Ex.: Um escritor decide se isolar na serra para romper o bloqueio...")
     else:
-        # buscar capítulos do livro atual
-        try:
-            resp = requests.get(f"{API_BASE}/chapters/{book_id}", timeout=10)
-            chs = resp.json().get("chapters", []) if resp.ok else []
-        except Exception:
-            chs = []
+        # capítulos do livro atual (lista leve em cache)
+        chs = get_book_chapters(book_id)
         if not chs:
             st.warning("Nenhum capítulo encontrado para este livro.")
         else:
-            chapter_pick = st.selectbox("Escolha o capítulo para expandir", chs, format_func=lambda c: f"{c['title']} ({c['id'][:8]})")
+            chapter_pick = st.selectbox("Escolha o capítulo para expandir", chs, format_func=lambda c: f"{c['position'] + 1}. {c['title']} ({c['id'][:8]})")
     
     length = st.select_slider("Tamanho desejado", options=["300-500 palavras","500-800 palavras","800-1200 palavras"], value="500-800 palavras")
-    save_flag = st.checkbox("Salvar como novo capítulo")
+    n_candidates = st.number_input("Alternativas", min_value=1, max_value=8, value=1,
+                                   help="Várias cenas numa só geração; a melhor (tamanho e repetição) vem primeiro")
+    save_flag = st.checkbox("Salvar como novo capítulo" + (" (a melhor alternativa)" if n_candidates > 1 else ""))
     save_title = st.text_input("Título (se salvar)", value="Cena gerada", disabled=not save_flag)
     
     if st.button("✍️ Gerar Cena", use_container_width=True, type="primary"):
@@ -862,33 +1035,42 @@ with tab_copilot:
                 "length": length,
                 "save_as_chapter": save_flag,
                 "title": (save_title if save_flag else None),
-                "show_prompt": False
+                "show_prompt": False,
+                "n": int(n_candidates),
             }
             try:
-                r = requests.post(f"{API_BASE}/expand", json=payload, timeout=600)
-                if r.ok:
+                if n_candidates > 1:
+                    # várias alternativas só fazem sentido prontas e ranqueadas: sem streaming
+                    r = requests.post(f"{API_BASE}/expand", json=payload, timeout=600)
+                    if not r.ok:
+                        raise RuntimeError(r.text)
                     data = r.json()
-                    st.success("✅ Cena gerada!")
-                    if data.get("saved"):
-                        st.info(f"💾 Salvo como capítulo **{data['saved']['title']}** (id: {data['saved']['chapter_id']})")
-
                     st.markdown("### 📄 Resultado")
                     st.text_area("Cena", value=data["scene"], height=400, disabled=True)
-
-                    # Atalho: enviar para o editor
-                    if st.button("⬇️ Usar como rascunho no editor", key="use_as_draft"):
-                        st.session_state["editing_chapter"] = {
-                            "id": "rascunho",
-                            "title": save_title or "Cena gerada",
-                            "content": data["scene"],
-                            "file_path": "",
-                            "size": len(data["scene"]),
-                            "modified": time.time(),
-                        }
-                        st.session_state["editing_mode"] = "continue"
-                        st.success("Rascunho carregado no editor!")
                 else:
-                    st.error(f"Erro: {r.text}")
+                    st.markdown("### 📄 Resultado")
+                    data = stream_generation("/expand", payload, "expand")
+                invalidate_book_cache()
+                st.success("✅ Cena gerada!")
+                if data.get("saved"):
+                    st.info(f"💾 Salvo como capítulo **{data['saved']['title']}** (id: {data['saved']['chapter_id']})")
+
+                for i, cand in enumerate((data.get("candidates") or [])[1:], start=2):
+                    with st.expander(f"Alternativa {i} — nota {cand['score']:.2f} · {cand['words']} palavras"):
+                        st.write(cand["text"])
+
+                # Atalho: enviar para o editor
+                if st.button("⬇️ Usar como rascunho no editor", key="use_as_draft"):
+                    st.session_state["editing_chapter"] = {
+                        "id": "rascunho",
+                        "title": save_title or "Cena gerada",
+                        "content": data["scene"],
+                        "file_path": "",
+                        "size": len(data["scene"]),
+                        "modified": time.time(),
+                    }
+                    st.session_state["editing_mode"] = "continue"
+                    st.success("Rascunho carregado no editor!")
             except Exception as e:
                 st.error(f"Falha na requisição: {e}")
 
@@ -1036,4 +1218,4 @@ with tab_maint:
 
 # (opcional) rodapé
 st.divider()
-st.caption("💡 Dica: arquivos em /data/chapters/ → capítulos: livro__id.md | sugestões: sugest_titulo__id.md | críticas: critica_titulo__id.md")
\ No newline at end of file
+st.caption("💡 Dica: arquivos em /data/chapters/<livro>/ → capítulos: chapters/id.md | sugestões: suggestions/titulo__id.md | críticas: critiques/titulo__id.md")
\ No newline at end of file